@@ -14,6 +14,7 @@
 from __future__ import absolute_import, division, print_function
 
 # Python libraries
+import binascii
 import numpy as np
 import six
 from collections import defaultdict, deque, Counter
@@ -22,12 +23,63 @@ from collections import defaultdict, deque, Counter
 from constants import *
 
 
+# weights 2^i for packing knowledge vectors with up to 62 concepts using int64 arithmetic
+_BIT_WEIGHTS = np.left_shift(1, np.arange(62, dtype=np.int64))
+
+
+def knowledge_to_mask(knowledge):
+    '''
+    Packs a binary knowledge vector into an integer bitmask, where bit i is set iff concept i is learned.
+    '''
+    bits = np.asarray(knowledge) > 0.5
+    n = bits.shape[0]
+    if n <= _BIT_WEIGHTS.shape[0]:
+        return int(np.dot(bits, _BIT_WEIGHTS[:n]))
+    # pack into big-endian bytes with concept 0 as the lowest bit, then parse as one big integer
+    n_bytes = (n + 7) // 8
+    padded = np.zeros((8 * n_bytes,), dtype=bool)
+    padded[:n] = bits
+    return int(binascii.hexlify(np.packbits(padded[::-1]).tobytes()), 16)
+
+
+def mask_to_knowledge(mask, n):
+    '''
+    Unpacks an integer bitmask into a float knowledge vector of length n.
+    '''
+    if n <= _BIT_WEIGHTS.shape[0]:
+        return ((np.int64(mask) & _BIT_WEIGHTS[:n]) != 0).astype(np.float64)
+    n_bytes = (n + 7) // 8
+    packed = np.frombuffer(binascii.unhexlify('{:0{}x}'.format(mask, 2 * n_bytes)), dtype=np.uint8)
+    return np.unpackbits(packed)[::-1][:n].astype(np.float64)
+
+
+def iter_mask_bits(mask):
+    '''
+    Yields the indices of the set bits of mask in increasing order.
+    '''
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+def count_mask_bits(mask):
+    '''
+    Number of set bits, e.g. the number of learned concepts.
+    '''
+    return bin(mask).count('1')
+
+
 class ConceptDependencyGraph(object):
     def __init__(self):
         self.root = None
         self.children = defaultdict(list) # edges go from parent (e.g. prerequisite) to child
         self.parents = defaultdict(list)
-        self.prereq_map = defaultdict(set)
+        self.prereq_masks = None
+        self.prereq_matrix = None
+        self._prereq_map = None
 
 
     def init_default_tree(self, n):
@@ -58,36 +110,195 @@ class ConceptDependencyGraph(object):
                 self.children[i].append(2 * i + 2)
                 self.parents[2 * i + 2].append(i)
         self._create_prereq_map()
-        # cache the prerequisites
-        self.prereqs = []
-        for s in six.moves.range(n):
-            self.prereqs.append(self._compute_prereqs(s))
 
 
-    def _create_prereq_map(self):
-        queue = deque()
-        queue.append(self.root)
-        while len(queue) > 0:
-            cur = queue.popleft()
-            self._add_prereqs(cur)
-            children = self.children[cur]
-            queue.extend(children)
+    def init_from_edges(self, n, edges):
+        '''
+        Creates an arbitrary DAG on the concepts 0..n-1.
+        :param edges: iterable of (prerequisite, concept) pairs
+        '''
+        self.n = n
+        assert (n > 0), "Graph must have at least one node."
+        self.children = defaultdict(list)
+        self.parents = defaultdict(list)
+        for p, c in edges:
+            assert 0 <= p < n and 0 <= c < n, "Edge ({}, {}) out of range.".format(p, c)
+            self.children[p].append(c)
+            self.parents[c].append(p)
+        self._create_prereq_map()
+        # the first concept without prerequisites
+        self.root = next(c for c in six.moves.range(n) if not self.parents[c])
+
+
+    def init_from_adjacency(self, adjacency):
+        '''
+        Creates an arbitrary DAG from an adjacency structure, either a dict mapping every concept
+        to the list of concepts that directly depend on it, or an (n, n) 0/1 matrix
+        where adjacency[p][c] = 1 iff p is a direct prerequisite of c.
+        '''
+        if isinstance(adjacency, dict):
+            concepts = set(adjacency.keys())
+            for cs in six.itervalues(adjacency):
+                concepts.update(cs)
+            edges = [(p, c) for p, cs in six.iteritems(adjacency) for c in cs]
+            self.init_from_edges(max(concepts) + 1, edges)
+        else:
+            adjacency = np.asarray(adjacency)
+            ps, cs = np.nonzero(adjacency)
+            self.init_from_edges(adjacency.shape[0], list(six.moves.zip(ps.tolist(), cs.tolist())))
+
+
+    def _topological_order(self):
+        '''
+        Kahn's algorithm over the concepts, ignoring the pseudo edges of leaves.
+        '''
+        n_parents = [len(self.parents[c]) for c in six.moves.range(self.n)]
+        order = [c for c in six.moves.range(self.n) if n_parents[c] == 0]
+        i = 0
+        while i < len(order):
+            for child in self.get_children(order[i]):
+                n_parents[child] -= 1
+                if n_parents[child] == 0:
+                    order.append(child)
+            i += 1
+        assert len(order) == self.n, "Concept dependency graph has a cycle."
+        return order
 
 
-    def _add_prereqs(self, cur):
-        # get parents of cur
-        parents = self.parents[cur]
+    def _create_prereq_map(self):
+        '''
+        Computes the transitive closure of the prerequisites as bitmasks: in topological order,
+        the prerequisites of a concept are its parents together with their prerequisites.
+        Dense representations (prereq_map, prereqs, prereq_matrix) are derived from the masks on demand.
+        '''
+        self.prereq_masks = [0] * self.n
+        for c in self._topological_order():
+            mask = 0
+            for p in self.parents[c]:
+                mask |= self.prereq_masks[p] | (1 << p)
+            self.prereq_masks[c] = mask
+        self.prereq_matrix = None
+        self._prereq_map = None
+
+    @property
+    def prereq_map(self):
+        # concept -> set of all its prerequisites
+        if self._prereq_map is None:
+            self._prereq_map = defaultdict(set)
+            for c in six.moves.range(self.n):
+                self._prereq_map[c] = set(iter_mask_bits(self.prereq_masks[c]))
+        return self._prereq_map
 
-        self.prereq_map[cur] = self.prereq_map[cur].union(set(parents))
+    @property
+    def prereqs(self):
+        # row c is the dense 0/1 prerequisite vector of c
+        return self.get_prereq_matrix()
 
-        for p in parents:
-            self.prereq_map[cur] = self.prereq_map[cur].union(self.prereq_map[p])
-    
     def _compute_prereqs(self, concept):
-        prereqs = np.zeros((self.n,),dtype=np.int)
-        for p in self.prereq_map[concept]:
-            prereqs[p] = 1
-        return prereqs
+        return mask_to_knowledge(self.prereq_masks[concept], self.n).astype(np.int)
 
     def get_prereqs(self, concept):
-        return self.prereqs[concept]
+        return self._compute_prereqs(concept)
+
+    def get_prereq_mask(self, concept):
+        '''
+        Returns the prerequisites of concept as an integer bitmask (see knowledge_to_mask).
+        '''
+        return self.prereq_masks[concept]
+
+    def fulfilled_prereqs_mask(self, kmask, concept):
+        '''
+        Checks whether all prerequisites of concept are set in the knowledge bitmask kmask.
+        '''
+        prereq_mask = self.prereq_masks[concept]
+        return kmask & prereq_mask == prereq_mask
+
+    def get_children(self, concept):
+        '''
+        Returns the children of concept, without the pseudo edge to -1 of leaf nodes.
+        '''
+        return [c for c in self.children[concept] if c >= 0]
+
+    def learnable_mask(self, kmask):
+        '''
+        Returns the bitmask of the concepts that are not in the knowledge bitmask kmask
+        but whose prerequisites all are, i.e. the concepts an expert would teach next.
+        '''
+        learnable = 0
+        for c in six.moves.range(self.n):
+            if not (kmask >> c) & 1 and self.fulfilled_prereqs_mask(kmask, c):
+                learnable |= 1 << c
+        return learnable
+
+    def get_prereq_matrix(self):
+        '''
+        Returns the prerequisites of all concepts stacked as an (n, n) array,
+        where row c is get_prereqs(c). Used by the vectorized simulators.
+        '''
+        if self.prereq_matrix is None:
+            self.prereq_matrix = np.array([self._compute_prereqs(c) for c in six.moves.range(self.n)])
+        return self.prereq_matrix
+
+
+class ConceptFrontier(object):
+    '''
+    The set of learnable concepts (see ConceptDependencyGraph.learnable_mask) for one student,
+    maintained incrementally as concepts get learned instead of rescanning the whole graph.
+    Learning a concept can only make its descendants learnable, and only those reachable through
+    already learned concepts, so an update costs O(children) when knowledge respects the prerequisites.
+    The frontier is kept as a bitmask, and the sorted list of its concepts is only rebuilt after it changed,
+    which happens at most once per learned concept, so querying it at every step is O(1).
+    '''
+    def __init__(self, graph, kmask=0):
+        self.graph = graph
+        self.reset(kmask)
+
+    def reset(self, kmask):
+        '''
+        Recomputes the frontier from scratch for the knowledge bitmask kmask.
+        '''
+        self.kmask = kmask
+        self.mask = self.graph.learnable_mask(kmask)
+        self._sorted = None
+
+    def learn(self, concept):
+        '''
+        Updates the frontier after concept has been learned.
+        '''
+        if (self.kmask >> concept) & 1:
+            return
+        self.kmask |= 1 << concept
+        self.mask &= ~(1 << concept)
+        self._sorted = None
+        stack = self.graph.get_children(concept)
+        while stack:
+            c = stack.pop()
+            if (self.kmask >> c) & 1:
+                # learned before its prerequisites, so its own children may have become learnable
+                stack.extend(self.graph.get_children(c))
+            elif self.graph.fulfilled_prereqs_mask(self.kmask, c):
+                self.mask |= 1 << c
+
+    def update(self, kmask):
+        '''
+        Updates the frontier to the knowledge bitmask kmask, which must be a superset of the current one.
+        '''
+        for c in iter_mask_bits(kmask & ~self.kmask):
+            self.learn(c)
+
+    def copy(self):
+        frontier = ConceptFrontier.__new__(ConceptFrontier)
+        frontier.graph = self.graph
+        frontier.kmask = self.kmask
+        frontier.mask = self.mask
+        # the sorted list is never modified, so it can be shared
+        frontier._sorted = self._sorted
+        return frontier
+
+    def sorted_concepts(self):
+        '''
+        :return: the learnable concepts in increasing order. The list is shared, don't modify it.
+        '''
+        if self._sorted is None:
+            self._sorted = list(iter_mask_bits(self.mask))
+        return self._sorted
@@ -22,6 +22,7 @@
 from __future__ import absolute_import, division, print_function
 
 # Python libraries
+import os
 import numpy as np
 import random
 import pickle
@@ -34,9 +35,12 @@ from collections import defaultdict, deque, Counter
 from filepaths import *
 from constants import *
 import dataset_utils
+from trajectory_dataset import TrajectoryDataset
 import concept_dependency_graph as cdg
 import student as st
 
+from joblib import Parallel, delayed, effective_n_jobs
+
 
 def fulfilled_prereqs(concept_tree, knowledge, concepts):
     '''
@@ -44,30 +48,24 @@ def fulfilled_prereqs(concept_tree, knowledge, concepts):
     if prereqs for at least one concept are not fulfilled, then function returns False.
     :return: bool
     '''
-
-    for i in six.moves.range(len(concepts)):
-        c = concepts[i]
-        if c == 1:
-            prereqs = concept_tree.get_prereqs(i)
-            if np.sum(np.multiply(knowledge, prereqs)) != np.sum(prereqs):
-                return False
+    kmask = cdg.knowledge_to_mask(knowledge)
+    for c in cdg.iter_mask_bits(cdg.knowledge_to_mask(concepts)):
+        if not concept_tree.fulfilled_prereqs_mask(kmask, c):
+            return False
     return True
 
-def sample_expert_action(concept_tree, knowledge):
+def sample_expert_action(concept_tree, knowledge, frontier=None):
     '''
     Samples an optimal action given the current knowledge and the concept tree.
     Samples uniformly from all optimal actions.
+    :param frontier: optional cdg.ConceptFrontier kept up to date with knowledge, saves rescanning the graph
     Returns a StudentAction
     '''
-    next_concepts = []
-    
     # find all possible concepts that have not been learned yet but whose prereq are fulfilled
-    for i in six.moves.range(concept_tree.n):
-        if not knowledge[i]:
-            cur_concept = np.zeros((concept_tree.n,),dtype=np.int)
-            cur_concept[i] = 1
-            if fulfilled_prereqs(concept_tree, knowledge, cur_concept):
-                next_concepts.append(i)
+    if frontier is None:
+        next_concepts = list(cdg.iter_mask_bits(concept_tree.learnable_mask(cdg.knowledge_to_mask(knowledge))))
+    else:
+        next_concepts = frontier.sorted_concepts()
     
     if not next_concepts:
         # nothing new can be learned, then just be random
@@ -79,7 +77,7 @@ def sample_expert_action(concept_tree, knowledge):
     next_c[next_action] = 1
     return st.StudentAction(next_action, next_c)
 
-def egreedy_expert(concept_tree, knowledge, epsilon):
+def egreedy_expert(concept_tree, knowledge, epsilon, frontier=None):
     '''
     egreedy over the expert policy
     '''
@@ -90,9 +88,118 @@ def egreedy_expert(concept_tree, knowledge, epsilon):
         next_c[next_action] = 1
         next_act = st.StudentAction(next_action,next_c)
     else:
-        next_act = sample_expert_action(concept_tree, knowledge)
+        next_act = sample_expert_action(concept_tree, knowledge, frontier=frontier)
     return next_act
 
+############ batch action selectors for the vectorized cohort simulators ############
+
+def sample_expert_actions_batch(concept_tree, knowledge, rng=np.random, learnable=None):
+    '''
+    Batch version of sample_expert_action.
+    :param knowledge: array of shape (n_students, n_concepts)
+    :param rng: np.random.RandomState or the np.random module
+    :param learnable: optional st.learnable_concepts_batch of knowledge kept up to date by the cohort
+        (see st.StudentCohort.learnable_concepts), saves recomputing it from the prerequisite matrix
+    :return: int array of shape (n_students,) of concepts, sampled uniformly from the optimal ones
+    '''
+    if learnable is None:
+        learnable = st.learnable_concepts_batch(concept_tree, knowledge)
+    # argmax over random keys restricted to the learnable concepts is a uniform pick among them
+    keys = rng.random_sample(learnable.shape)
+    keys[~learnable] = -1.0
+    actions = np.argmax(keys, axis=1)
+    # nothing new can be learned, then just be random
+    stuck = ~np.any(learnable, axis=1)
+    actions[stuck] = rng.randint(0, concept_tree.n, size=np.sum(stuck))
+    return actions
+
+
+def egreedy_expert_batch(concept_tree, knowledge, epsilon, rng=np.random, learnable=None):
+    '''
+    Batch version of egreedy_expert.
+    '''
+    n_students = knowledge.shape[0]
+    actions = sample_expert_actions_batch(concept_tree, knowledge, rng=rng, learnable=learnable)
+    explore = rng.random_sample(n_students) < epsilon
+    actions[explore] = rng.randint(0, concept_tree.n, size=np.sum(explore))
+    return actions
+
+
+def select_actions_batch(concept_tree, knowledge, policy, step, epsilon=None, rng=np.random, learnable=None):
+    '''
+    Chooses the next concept for every student of a cohort.
+    :param policy: 'expert', 'egreedy', 'modulo' or 'random'
+    :param step: the current timestep, used by the modulo policy
+    :param rng: np.random.RandomState or the np.random module
+    :param learnable: optional learnable concepts of the students, see sample_expert_actions_batch
+    :return: int array of shape (n_students,)
+    '''
+    n_students = knowledge.shape[0]
+    if policy == 'expert':
+        return sample_expert_actions_batch(concept_tree, knowledge, rng=rng, learnable=learnable)
+    elif policy == 'egreedy':
+        return egreedy_expert_batch(concept_tree, knowledge, epsilon, rng=rng, learnable=learnable)
+    elif policy == 'modulo':
+        return np.full((n_students,), step % concept_tree.n, dtype=int)
+    elif policy == 'random':
+        return rng.randint(concept_tree.n, size=n_students)
+    else:
+        raise ValueError('Unknown policy {}'.format(policy))
+
+
+def generate_cohort_sample(concept_tree, cohort, seqlen=100, initial_knowledge=None, policy=None, epsilon=None):
+    '''
+    Vectorized counterpart of generate_student_sample which simulates all students of a cohort at once.
+    The behavior policy draws from the same random stream as the cohort.
+    :param cohort: a vectorized student simulator, e.g. st.StudentCohort
+    :return: tuple of arrays (exercises, performance, knowledge, states) with shapes
+    (n_students, seqlen, n_concepts), (n_students, seqlen), (n_students, seqlen, n_concepts),
+    (n_students, seqlen, state_dim). Same timestep semantics as generate_student_sample.
+    '''
+    n_concepts = concept_tree.n
+    if initial_knowledge is None:
+        initial_knowledge = np.zeros((n_concepts,))
+        initial_knowledge[0] = 1
+    cohort.reset(initial_knowledge)
+    n_students = cohort.n_students
+
+    exercises = np.zeros((n_students, seqlen, n_concepts), dtype=int)
+    performance = np.zeros((n_students, seqlen), dtype=int)
+    knowledge = np.zeros((n_students, seqlen, n_concepts))
+    states = None
+    rows = np.arange(n_students)
+    for i in six.moves.range(seqlen):
+        state = cohort.get_state()
+        if states is None:
+            states = np.zeros((n_students, seqlen, state.shape[1]), dtype=int)
+        states[:, i, :] = state
+        learnable = None
+        if policy in ('expert', 'egreedy') and hasattr(cohort, 'learnable_concepts'):
+            # maintained by the cohort as concepts get learned
+            learnable = cohort.learnable_concepts(concept_tree)
+        concepts = select_actions_batch(concept_tree, cohort.knowledge, policy, i, epsilon=epsilon, rng=cohort.rng,
+                                        learnable=learnable)
+        performance[:, i] = cohort.do_exercise(concept_tree, concepts)
+        exercises[rows, i, concepts] = 1
+        knowledge[:, i, :] = cohort.knowledge
+    return exercises, performance, knowledge, states
+
+
+def cohort_sample_to_data(cohort_sample, filter_mastery=False):
+    '''
+    Converts the arrays from generate_cohort_sample into the list of per-student samples returned by generate_data.
+    :param filter_mastery: if True, drop trajectories that end in full mastery
+    '''
+    exercises, performance, knowledge, states = cohort_sample
+    data = []
+    for i in six.moves.range(exercises.shape[0]):
+        if filter_mastery and np.mean(knowledge[i, -1]) >= 0.999:
+            continue
+        student_sample = tuple(six.moves.zip(exercises[i], performance[i].tolist(), knowledge[i], states[i]))
+        data.append(student_sample)
+    return data
+
+
 def generate_student_sample(concept_tree, seqlen=100, student=None, initial_knowledge=None, policy=None, epsilon=None, verbose=False):
     '''
     :param n: number of concepts; if None use N_CONCEPTS
@@ -142,20 +249,25 @@ def generate_student_sample(concept_tree, seqlen=100, student=None, initial_know
     student_state = []
     n_exercises_to_mastery = -1
     exercises = [] # so we can store sequence of exercises as numpy arrays (instead of arrays of exercise objects)
+    frontier = None
+    if policy == 'expert' or policy == 'egreedy':
+        frontier = cdg.ConceptFrontier(concept_tree, s.kmask)
     for i in six.moves.range(seqlen):
         # print (s.knowledge)
         # store current states
         student_state.append(s.get_state())
         if policy == 'expert':
-            ex = sample_expert_action(concept_tree, s.knowledge)
+            ex = sample_expert_action(concept_tree, s.knowledge, frontier=frontier)
         elif policy == 'egreedy':
-            ex = egreedy_expert(concept_tree, s.knowledge, epsilon)
+            ex = egreedy_expert(concept_tree, s.knowledge, epsilon, frontier=frontier)
         else:
             ex = exercise_seq[i]
         result = s.do_exercise(concept_tree, ex)
         exercises.append(ex.conceptvec) # makes the assumption that an exercise is equivalent to the concepts it practices)
         student_performance.append(result)
         student_knowledge.append(copy.deepcopy(s.knowledge))
+        if frontier is not None:
+            frontier.update(s.kmask)
         if np.sum(s.knowledge) == n_concepts and n_exercises_to_mastery == -1:
             # if verbose and n_exercises_to_mastery == -1:
             n_exercises_to_mastery = i + 1
@@ -170,10 +282,106 @@ def generate_student_sample(concept_tree, seqlen=100, student=None, initial_know
     return student_sample
 
 
-def generate_data(concept_tree, student=None, filter_mastery=False, n_students=100, seqlen=100, policy='modulo', epsilon=0.0, filename=None, verbose=False):
+def make_cohort(concept_tree, student, n_students, rng=None):
+    '''
+    Returns the vectorized cohort simulator for the given student environment,
+    or None if there is no vectorized version of it.
+    '''
+    if student is None:
+        student = st.Student()
+    return st.make_student_cohort(student, n_students, concept_tree.n, rng=rng)
+
+
+def make_shard_seeds(seed, n_shards):
+    '''
+    Derives one seed per shard from the master seed. Shard i always gets the same seed for a given
+    master seed, independently of how many shards or workers there are.
+    '''
+    return np.random.RandomState(seed).randint(0, 2**31 - 1, size=n_shards)
+
+
+def _generate_data_shard(concept_tree, student, filter_mastery, n_students, seqlen, policy, epsilon, verbose, cohort_size, seed):
+    '''
+    Generates the trajectories for one shard of students, see generate_data.
+    :param seed: seed of the shard's own random stream, or None to draw from the global numpy stream
+    '''
+    data = []
+    rng = np.random.RandomState(seed) if seed is not None else None
+    if make_cohort(concept_tree, student, 1) is not None:
+        # vectorized simulation, cohort by cohort
+        for start in six.moves.range(0, n_students, cohort_size):
+            curr_size = min(cohort_size, n_students - start)
+            if verbose:
+                print ("Creating samples for students {} to {}".format(start, start + curr_size - 1))
+            cohort = make_cohort(concept_tree, student, curr_size, rng=rng)
+            cohort_sample = generate_cohort_sample(concept_tree, cohort, seqlen=seqlen, policy=policy, epsilon=epsilon)
+            data.extend(cohort_sample_to_data(cohort_sample, filter_mastery=filter_mastery))
+        return data
+
+    # the per-student simulators draw from the global numpy stream, so run the shard on its own seed
+    # and give the caller its stream back afterwards
+    if seed is not None:
+        global_state = np.random.get_state()
+        np.random.seed(seed)
+    try:
+        for i in six.moves.range(n_students):
+            if verbose:
+                print ("Creating sample for {}th student".format(i))
+            student_sample = generate_student_sample(concept_tree, student=student, seqlen=seqlen, initial_knowledge=None,
+                                                     policy=policy, epsilon=epsilon, verbose=verbose)
+            if filter_mastery:
+                final_knowledge = student_sample[-1][2]
+                if np.mean(final_knowledge) < 0.999:
+                    data.append(student_sample)
+            else:
+                data.append(student_sample)
+    finally:
+        if seed is not None:
+            np.random.set_state(global_state)
+    return data
+
+
+def generate_data_chunks(concept_tree, student=None, filter_mastery=False, n_students=100, seqlen=100, policy='modulo', epsilon=0.0, verbose=False, cohort_size=10000, n_jobs=1, seed=None, shard_size=10000, start_shard=0):
+    """
+    Generator version of generate_data. Students are split into shards of shard_size which are yielded
+    as soon as they are generated, so at most n_jobs shards are held in memory at a time.
+    See generate_data for the other parameters.
+
+    :param start_shard: index of the first shard to generate, e.g. to resume an interrupted run
+    :return: yields (shard index, list of trajectories of the shard)
+    """
+    shard_starts = list(six.moves.range(0, n_students, shard_size))
+    n_shards = len(shard_starts)
+    if n_jobs != 1 and seed is None:
+        # forked workers would otherwise share the same global numpy stream
+        seed = np.random.randint(0, 2**31 - 1)
+    if seed is not None:
+        shard_seeds = make_shard_seeds(seed, n_shards)
+    else:
+        shard_seeds = [None] * n_shards
+
+    def shard_args(i):
+        return (concept_tree, student, filter_mastery, min(shard_size, n_students - shard_starts[i]), seqlen, policy,
+                epsilon, verbose, cohort_size, shard_seeds[i])
+
+    if n_jobs == 1:
+        for i in six.moves.range(start_shard, n_shards):
+            yield i, _generate_data_shard(*shard_args(i))
+        return
+
+    with Parallel(n_jobs=n_jobs) as parallel:
+        batch_size = effective_n_jobs(n_jobs)
+        for batch_start in six.moves.range(start_shard, n_shards, batch_size):
+            batch = list(six.moves.range(batch_start, min(batch_start + batch_size, n_shards)))
+            shards = parallel(delayed(_generate_data_shard)(*shard_args(i)) for i in batch)
+            for i, shard in six.moves.zip(batch, shards):
+                yield i, shard
+
+
+def generate_data(concept_tree, student=None, filter_mastery=False, n_students=100, seqlen=100, policy='modulo', epsilon=0.0, filename=None, verbose=False, cohort_size=10000, n_jobs=1, seed=None, shard_size=10000):
     """
     This is the main data generation function.
-    
+
     :param concept_tree: Concept dependency graph
     :param student: Student environment
     :param filter_mastery: boolean indicating whether want to remove trajectories that end in full mastery
@@ -181,34 +389,117 @@ def generate_data(concept_tree, student=None, filter_mastery=False, n_students=1
     :param policy: which policy to use to generate data. can be 'expert', 'modulo', 'random', 'egreedy'
     :param epsilon: epsilon for egreedy policy only; not used by other policies
     :param filename: where to store the generated data. If None, will not save to file.
+    For large data sets use write_data_stream instead, which does not keep the data in memory.
     :param verbose: if True, prints debugging statements
+    :param cohort_size: max number of students simulated at once by the vectorized simulator
+    :param n_jobs: number of worker processes. Students are split into shards of shard_size which are
+    generated in parallel and merged in shard order.
+    :param seed: master seed. If given, every shard gets its own random stream derived from it,
+    so the output only depends on the seed and shard_size, not on n_jobs.
+    If None and n_jobs == 1, the global numpy stream is used as before.
+    :param shard_size: number of students per shard
     :return:
     """
 
-    data = []
     print ("Generating data for {} students with behavior policy {} and sequence length {}.".format(n_students, policy, seqlen))
-    for i in six.moves.range(n_students):
-        if verbose:
-            print ("Creating sample for {}th student".format(i))
-        student_sample = generate_student_sample(concept_tree, student=student, seqlen=seqlen, initial_knowledge=None,
-                                                 policy=policy, epsilon=epsilon, verbose=verbose)
-        if filter_mastery:
-            final_knowledge = student_sample[-1][2]
-            if np.mean(final_knowledge) < 0.999:
-                data.append(student_sample)
-        else:
-            data.append(student_sample)
+    data = []
+    for _, shard in generate_data_chunks(concept_tree, student=student, filter_mastery=filter_mastery,
+                                         n_students=n_students, seqlen=seqlen, policy=policy, epsilon=epsilon,
+                                         verbose=verbose, cohort_size=cohort_size, n_jobs=n_jobs, seed=seed,
+                                         shard_size=shard_size):
+        data.extend(shard)
     if filename:
         pickle.dump(data, open(filename, 'wb+'))
     return data
 
 
+# student attributes recorded in the header of a trajectory stream, so a resumed run can't mix students
+STREAM_STUDENT_PARAMS = ('p_trans_satisfied', 'p_trans_not_satisfied', 'p_get_ex_correct_if_concepts_learned',
+                         'transition_after')
+
+
+def stream_student_params(student):
+    return dict((name, getattr(student, name)) for name in STREAM_STUDENT_PARAMS if hasattr(student, name))
+
+
+def write_data_stream(concept_tree, filename, student=None, filter_mastery=False, n_students=100, seqlen=100, policy='modulo', epsilon=0.0, verbose=False, cohort_size=10000, n_jobs=1, seed=None, shard_size=10000, resume=True):
+    """
+    Generates data like generate_data but appends every shard to filename as soon as it is produced,
+    so memory stays flat regardless of n_students. The file holds a pickled header dict followed by one
+    pickled (shard index, trajectories) record per shard; read it with dataset_utils.load_data or
+    dataset_utils.iter_data_chunks.
+
+    :param resume: if True and filename already holds an interrupted stream with the same parameters,
+    the complete shards are kept and generation continues with the next shard. Otherwise the file is overwritten.
+    Resuming a file that is not a trajectory stream raises a ValueError.
+    :param seed: master seed, see generate_data. If None, one is drawn and stored in the header
+    so that a resumed run continues the same shard streams; resuming with seed None uses the stored seed.
+    :return: number of shards in the file
+    """
+    if student is None:
+        student = st.Student()
+    header = {
+        'format': dataset_utils.DATA_STREAM_FORMAT,
+        'n_concepts': concept_tree.n,
+        'student': type(student).__name__,
+        'student_params': stream_student_params(student),
+        'filter_mastery': filter_mastery,
+        'n_students': n_students,
+        'seqlen': seqlen,
+        'policy': policy,
+        'epsilon': epsilon,
+        'shard_size': shard_size,
+    }
+    n_shards = (n_students + shard_size - 1) // shard_size
+
+    start_shard = 0
+    if resume and os.path.exists(filename):
+        if not dataset_utils.is_data_stream(filename):
+            raise ValueError("Cannot resume {}: it is not a trajectory stream, e.g. data in the old single list format. "
+                             "Pass resume=False to regenerate it.".format(filename))
+        old_header, n_done, end_pos = dataset_utils.scan_data_stream(filename)
+        if seed is None:
+            # continue the shard streams of the interrupted run
+            seed = old_header.get('seed')
+        header['seed'] = int(seed) if seed is not None else None
+        if old_header != header:
+            raise ValueError("Cannot resume {}: it was generated with different parameters {}.".format(filename, old_header))
+        # drop a partially written shard
+        with open(filename, 'rb+') as f:
+            f.truncate(end_pos)
+        start_shard = n_done
+        print ("Resuming {} at shard {} of {}.".format(filename, start_shard, n_shards))
+    else:
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        header['seed'] = int(seed)
+        with open(filename, 'wb') as f:
+            pickle.dump(header, f, protocol=2)
+
+    print ("Generating data for {} students with behavior policy {} and sequence length {}.".format(n_students, policy, seqlen))
+    with open(filename, 'ab') as f:
+        for i, shard in generate_data_chunks(concept_tree, student=student, filter_mastery=filter_mastery,
+                                             n_students=n_students, seqlen=seqlen, policy=policy, epsilon=epsilon,
+                                             verbose=verbose, cohort_size=cohort_size, n_jobs=n_jobs, seed=seed,
+                                             shard_size=shard_size, start_shard=start_shard):
+            pickle.dump((i, shard), f, protocol=2)
+            f.flush()
+            os.fsync(f.fileno())
+            if verbose:
+                print ("Wrote shard {} of {}".format(i + 1, n_shards))
+    return n_shards
+
+
 # def load_data(filename=None):
 #     data = pickle.load(open(filename, 'rb+'))
 #     return data
 
 
 def get_data_stats(data):
+    if isinstance(data, TrajectoryDataset):
+        # trajectories in a dataset all have the same length
+        print ("Average number of exercises needed to get all concepts learned: {}".format(float(data.seqlen)))
+        return
     average_n_exercises = 0
     for i, sample in enumerate(data):
         n_exercises = len(sample)
@@ -263,8 +554,12 @@ def init_synthetic_data():
     n_students = 10000
     seqlen = 100
     for policy in ['random', 'expert', 'modulo']:
-        filename = "{}stud_{}seq_{}.pickle".format(n_students, seqlen, policy)
-        generate_data(concept_tree, n_students=n_students, seqlen=seqlen, policy=policy, filename="{}{}".format(SYN_DATA_DIR, filename))
+        filename = "{}{}stud_{}seq_{}.pickle".format(SYN_DATA_DIR, n_students, seqlen, policy)
+        # files in the old single list format can't be resumed, regenerate them
+        resume = not os.path.exists(filename) or dataset_utils.is_data_stream(filename)
+        if not resume:
+            print ("Regenerating {}, it is not a trajectory stream.".format(filename))
+        write_data_stream(concept_tree, filename, n_students=n_students, seqlen=seqlen, policy=policy, resume=resume)
     print ("Data generation completed. ")
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests for the sharded data generation and the streaming data files.
+#===============================================================================
+# USAGE: python data_generator_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import six
+
+import concept_dependency_graph as cdg
+import data_generator as dg
+import dataset_utils
+import student as st
+
+
+class _PerStudent(st.Student):
+    '''
+    A Student without a vectorized cohort, so generation goes through the per-student simulators.
+    '''
+    pass
+
+
+def _same_data(data1, data2):
+    if len(data1) != len(data2):
+        return False
+    for traj1, traj2 in six.moves.zip(data1, data2):
+        if len(traj1) != len(traj2):
+            return False
+        for step1, step2 in six.moves.zip(traj1, traj2):
+            if not all(np.array_equal(a, b) for a, b in six.moves.zip(step1, step2)):
+                return False
+    return True
+
+
+def test_seed_independent_of_n_jobs(n_concepts=4, n_students=60, seqlen=6):
+    '''
+    The same seed gives the same data with one or several workers, for both the vectorized
+    and the per-student simulators, and leaves the caller's random stream alone.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    for student in (st.Student2(n_concepts, True), _PerStudent(n=n_concepts)):
+        np.random.seed(3)
+        data1 = dg.generate_data(dgraph, student=student, n_students=n_students, seqlen=seqlen, policy='expert',
+                                 n_jobs=1, seed=7, shard_size=25)
+        after = np.random.random_sample()
+        np.random.seed(3)
+        expected = np.random.random_sample()
+        assert after == expected, type(student).__name__
+        data2 = dg.generate_data(dgraph, student=student, n_students=n_students, seqlen=seqlen, policy='expert',
+                                 n_jobs=2, seed=7, shard_size=25)
+        assert _same_data(data1, data2), type(student).__name__
+        data3 = dg.generate_data(dgraph, student=student, n_students=n_students, seqlen=seqlen, policy='expert',
+                                 n_jobs=1, seed=8, shard_size=25)
+        assert not _same_data(data1, data3), type(student).__name__
+
+
+def _shard_ends(filename):
+    with open(filename, 'rb') as f:
+        pickle.load(f)
+        return [pos for _, pos in dataset_utils._read_stream_records(f)]
+
+
+def test_resume_interrupted_stream(n_concepts=4, n_students=100, seqlen=5, shard_size=20):
+    '''
+    A stream cut in the middle of a shard is resumed with the default seed=None and ends up
+    with the same data as the uninterrupted run.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    student = st.Student2(n_concepts, True)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'stream.pickle')
+        params = dict(student=student, n_students=n_students, seqlen=seqlen, policy='random', shard_size=shard_size)
+        dg.write_data_stream(dgraph, filename, resume=False, **params)
+        expected = dataset_utils.load_data(filename)
+        assert len(expected) == n_students
+
+        # interrupt the writer in the middle of the fourth shard
+        ends = _shard_ends(filename)
+        with open(filename, 'rb+') as f:
+            f.truncate((ends[2] + ends[3]) // 2)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert len(dataset_utils.load_data(filename)) == 3 * shard_size
+        assert len(caught) == 1 and 'truncated' in str(caught[0].message)
+
+        dg.write_data_stream(dgraph, filename, **params)
+        assert _same_data(dataset_utils.load_data(filename), expected)
+
+        # a different student can't be resumed into the file
+        try:
+            dg.write_data_stream(dgraph, filename, **dict(params, student=st.Student2(n_concepts, False)))
+            assert False, 'resumed with a different student'
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_corrupt_and_old_format_files(n_concepts=4, n_students=60, seqlen=5, shard_size=20):
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'stream.pickle')
+        dg.write_data_stream(dgraph, filename, student=st.Student2(n_concepts, True), n_students=n_students,
+                             seqlen=seqlen, shard_size=shard_size, seed=1)
+        # damage the middle shard: reading must fail instead of returning fewer trajectories
+        ends = _shard_ends(filename)
+        with open(filename, 'rb+') as f:
+            f.seek(ends[0])
+            f.write(b'garbage')
+        for read in (dataset_utils.load_data, dataset_utils.scan_data_stream):
+            try:
+                read(filename)
+                assert False, 'read a corrupt stream'
+            except ValueError:
+                pass
+
+        # data in the old single list format is not a stream and can't be resumed
+        old_filename = os.path.join(tmpdir, 'old.pickle')
+        dg.generate_data(dgraph, n_students=5, seqlen=seqlen, filename=old_filename)
+        assert not dataset_utils.is_data_stream(old_filename) and dataset_utils.is_data_stream(filename)
+        try:
+            dg.write_data_stream(dgraph, old_filename, n_students=5, seqlen=seqlen)
+            assert False, 'resumed an old format file'
+        except ValueError:
+            pass
+        dg.write_data_stream(dgraph, old_filename, n_students=5, seqlen=seqlen, resume=False)
+        assert len(dataset_utils.load_data(old_filename)) == 5
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_seed_independent_of_n_jobs()
+    test_resume_interrupted_stream()
+    test_corrupt_and_old_format_files()
+    six.print_('All tests passed.')
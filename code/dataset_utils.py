@@ -17,128 +17,539 @@ from __future__ import division
 from __future__ import print_function
 
 
+import os
+import hashlib
 import pickle
+import threading
+import warnings
 import six
 import numpy as np
-import tensorflow as tf
+from collections import namedtuple
 
 # Custom Modules
 from filepaths import *
 from constants import *
+from trajectory_dataset import TrajectoryDataset, TrajectoryDatasetWriter, is_trajectory_dataset
+
+
+# marker stored in the header of trajectory files written shard by shard (see data_generator.write_data_stream)
+DATA_STREAM_FORMAT = 'trajectory-stream-v1'
 
 
 def load_data(filename=None):
-    data = pickle.load(open(filename, 'rb+'))
+    """
+    Loads the trajectories stored in filename.
+    Works both for a single pickled list and for trajectory streams written by data_generator.write_data_stream.
+    If filename is a trajectory dataset directory, it is opened memory-mapped and returned as a TrajectoryDataset.
+    """
+    if is_trajectory_dataset(filename):
+        return TrajectoryDataset(filename)
+    data = []
+    for chunk in iter_data_chunks(filename):
+        data.extend(chunk)
     return data
 
 
+def _read_stream_records(f):
+    """
+    Yields (record, file position after the record) for the pickled records following the current position,
+    stopping at the end of the file. A truncated last record, as left by an interrupted writer, is skipped
+    with a warning; a record that cannot be read anywhere else raises a ValueError.
+    """
+    size = os.fstat(f.fileno()).st_size
+    while True:
+        start = f.tell()
+        if start >= size:
+            return
+        try:
+            record = pickle.load(f)
+        except Exception as e:
+            # a truncated record makes the unpickler run out of data at the end of the file
+            if isinstance(e, (EOFError, pickle.UnpicklingError)) and f.tell() >= size:
+                warnings.warn("Ignoring the truncated last record of {} at byte {} (interrupted writer?).".format(
+                    f.name, start))
+                return
+            six.raise_from(ValueError("Corrupt record in {} at byte {}: {!r}".format(f.name, start, e)), e)
+        yield record, f.tell()
+
+
+def is_data_stream(filename):
+    """
+    :return: True if filename is a trajectory stream written by data_generator.write_data_stream,
+    False for any other file, e.g. a single pickled list of trajectories
+    """
+    with open(filename, 'rb') as f:
+        try:
+            header = pickle.load(f)
+        except Exception:
+            return False
+    return isinstance(header, dict) and header.get('format') == DATA_STREAM_FORMAT
+
+
+def iter_data_chunks(filename, chunk_size=10000):
+    """
+    Yields the trajectories stored in filename one chunk (list of trajectories) at a time, so that a
+    trajectory stream never has to be held in memory at once.
+    A single pickled list (the format generate_data used to write) cannot be read incrementally: it is unpickled
+    at once, then handed out in chunks that are dropped from the list as they go.
+    """
+    if is_trajectory_dataset(filename):
+        dataset = TrajectoryDataset(filename)
+        for start in six.moves.range(0, len(dataset), chunk_size):
+            yield dataset[start:start + chunk_size]
+        return
+    with open(filename, 'rb') as f:
+        first = pickle.load(f)
+        if not (isinstance(first, dict) and first.get('format') == DATA_STREAM_FORMAT):
+            # reversed so every chunk can be popped off the end without shifting the rest
+            first.reverse()
+            while first:
+                chunk = first[-chunk_size:]
+                del first[-chunk_size:]
+                chunk.reverse()
+                yield chunk
+            return
+        for (shard_ix, trajectories), _ in _read_stream_records(f):
+            yield trajectories
+
+
+def scan_data_stream(filename):
+    """
+    Finds the complete shards of a trajectory stream, e.g. to resume an interrupted run.
+    :return: (header dict, number of complete shards, file position right after the last complete shard)
+    """
+    with open(filename, 'rb') as f:
+        header = pickle.load(f)
+        if not (isinstance(header, dict) and header.get('format') == DATA_STREAM_FORMAT):
+            raise ValueError("{} is not a trajectory stream.".format(filename))
+        n_shards = 0
+        end_pos = f.tell()
+        for (shard_ix, trajectories), pos in _read_stream_records(f):
+            if shard_ix != n_shards:
+                raise ValueError("Shards in {} are out of order.".format(filename))
+            n_shards += 1
+            end_pos = pos
+    return header, n_shards, end_pos
+
+
+def convert_to_trajectory_dataset(filename, path):
+    """
+    Converts a pickled data file (single list or trajectory stream) into a trajectory dataset directory.
+    Streams are converted chunk by chunk; a single pickled list has to be unpickled at once (see iter_data_chunks).
+    :return: the opened TrajectoryDataset
+    """
+    writer = None
+    for chunk in iter_data_chunks(filename):
+        if len(chunk) == 0:
+            continue
+        if writer is None:
+            first_step = chunk[0][0]
+            state_dim = len(first_step[3]) if len(first_step) > 3 else 0
+            writer = TrajectoryDatasetWriter(path, len(first_step[0]), len(chunk[0]), state_dim)
+        writer.append(chunk)
+    assert writer is not None, "{} holds no trajectories.".format(filename)
+    writer.close()
+    return TrajectoryDataset(path)
+
+
+def convert_synthetic_data(data_dir=SYN_DATA_DIR):
+    """
+    Converts every .pickle file in data_dir into a trajectory dataset directory next to it,
+    e.g. foo.pickle -> foo.traj, skipping those already converted.
+    Only trajectory streams are converted with bounded memory. The older single-list pickles are unpickled whole,
+    so converting one needs about as much memory as loading it with load_data did.
+    """
+    for name in sorted(os.listdir(data_dir)):
+        if not name.endswith('.pickle'):
+            continue
+        path = os.path.join(data_dir, name[:-len('.pickle')] + '.traj')
+        if is_trajectory_dataset(path):
+            continue
+        print ("Converting {} to {}".format(name, path))
+        convert_to_trajectory_dataset(os.path.join(data_dir, name), path)
+
+
+def gather_trajectory_arrays(data, with_knowledge=False):
+    """
+    Collects the per-step fields of all trajectories into arrays in one pass.
+    :param data: list of trajectories (as returned by generate_data) or a TrajectoryDataset
+    :param with_knowledge: if True, also return the knowledge after every step
+    :return: (actions, outcomes, n_concepts) or (actions, outcomes, knowledge, n_concepts), where actions is an
+    int array (n_students, seqlen) of exercised concepts, outcomes a 0/1 array (n_students, seqlen)
+    and knowledge a 0/1 array (n_students, seqlen, n_concepts)
+    """
+    if isinstance(data, TrajectoryDataset):
+        actions = np.asarray(data.actions, dtype=int)
+        outcomes = data.outcomes()
+        n_concepts = data.n_concepts
+        knowledge = data.knowledge() if with_knowledge else None
+    else:
+        n_concepts = len(data[0][0][0])
+        exercises = np.array([[step[0] for step in trajectory] for trajectory in data])
+        actions = np.argmax(exercises, axis=2)
+        outcomes = np.array([[step[1] for step in trajectory] for trajectory in data])
+        knowledge = None
+        if with_knowledge:
+            knowledge = np.array([[step[2] for step in trajectory] for trajectory in data])
+    if with_knowledge:
+        return actions, outcomes, knowledge, n_concepts
+    return actions, outcomes, n_concepts
+
+
+def encode_observations(actions, outcomes, n_concepts, dtype=np.float64):
+    """
+    One-hot encodes (exercise, result) pairs: correct answers go in the first half of the vector,
+    wrong answers in the second.
+    :return: array of shape actions.shape + (2 * n_concepts,)
+    """
+    actions = np.asarray(actions, dtype=int)
+    obs = np.zeros(actions.shape + (2 * n_concepts,), dtype=dtype)
+    ix = actions + n_concepts * (np.asarray(outcomes) != 1)
+    students, timesteps = np.indices(actions.shape)
+    obs[students, timesteps, ix] = 1
+    return obs
+
+
 def preprocess_data_for_dqn(data, reward_model="sparse"):
     """
-    Creates n_students traces of (s,a,r,s') tuples which can be loaded into the experience replay buffer.
+    Creates n_students traces of (s,a,r,s') transitions which can be loaded into the experience replay buffer.
     Each student yields one trace
-    :param data:
+    :param data: list of trajectories or a TrajectoryDataset
     :param reward_model: "dense", "sparse" or "semisparse".
-    If "sparse", then reward = percentage of skills learned at last timestep, 0 everywhere else
+    If "sparse", then reward = 1 if all skills are learned at the last timestep, 0 everywhere else
+    If "semisparse", then reward = number of skills learned at the last timestep, 0 everywhere else
     If "dense", reward = percentage of skills learned at every timestep
-    :return:
+    :return: tuple of contiguous arrays (s, a, r, sp) with shapes (n_students, seqlen-1, 2*n_concepts),
+    (n_students, seqlen-1, n_concepts), (n_students, seqlen-1), (n_students, seqlen-1, 2*n_concepts).
+    Transition t goes from the observation of step t via the exercise of step t+1 to the observation of step t+1.
+    """
+    actions, outcomes, knowledge, n_concepts = gather_trajectory_arrays(data, with_knowledge=True)
+    n_students, n_timesteps = actions.shape
+
+    obs = encode_observations(actions, outcomes, n_concepts)
+    s = np.ascontiguousarray(obs[:, :-1])
+    sp = np.ascontiguousarray(obs[:, 1:])
+    a = np.zeros((n_students, n_timesteps - 1, n_concepts))
+    students, timesteps = np.indices((n_students, n_timesteps - 1))
+    a[students, timesteps, actions[:, 1:]] = 1
+
+    r = np.zeros((n_students, n_timesteps - 1))
+    # the knowledge after the next exercise
+    next_knowl = knowledge[:, 1:]
+    if reward_model == "dense":
+        r[:, :] = np.mean(next_knowl, axis=2)
+    elif reward_model == "sparse":
+        r[:, -1] = np.prod(next_knowl[:, -1], axis=1)
+    elif reward_model == "semisparse":
+        r[:, -1] = np.sum(next_knowl[:, -1], axis=1)
+    return s, a, r, sp
+
+
+def dqn_arrays_to_episodes(dqn_arrays):
+    """
+    Converts the arrays returned by preprocess_data_for_dqn into one list of [s, a, r, sp] steps per student,
+    the episode format of experience_buffer.ExperienceBuffer and drqn.stack_batch.
     """
-    n_students = len(data)
-    n_timesteps = len(data[0])
-    exer = data[0][0][0]
-    n_concepts = len(exer)
-
-    all_traces = []
-    for i in six.moves.range(n_students):
-        trace = []
-        for t in six.moves.range(n_timesteps - 1):
-            cur_sample = data[i][t]
-            next_sample = data[i][t + 1]
-            exer, perf, knowl = cur_sample
-            next_exer, next_perf, next_knowl = next_sample
-            next_exer_ix = np.argmax(next_exer)
-
-            s = np.zeros(2 * len(exer))
-            if perf == 1:
-                s[:len(exer)] = exer
-            else:
-                s[len(exer):] = exer
-
-            a = np.array(next_exer)
-            r = 0.0
-            if reward_model == "dense":
-                # t = n_timesteps - 2 is last timestep we are considering, since next_knowl is from t+1
-                r = np.mean(next_knowl)
-            elif reward_model == "sparse" and t == (n_timesteps - 2):
-                r = np.prod(next_knowl)
-            elif reward_model == "semisparse" and t == (n_timesteps - 2):
-                r = np.sum(next_knowl)
-
-
-            sp = np.zeros(2 * len(next_exer))
-            if next_perf == 1:
-                sp[:len(next_exer)] = next_exer
-            else:
-                sp[len(exer):] = next_exer
-
-            trace.append([s,a,r,sp])
-        all_traces.append(trace)
-    return all_traces
+    s, a, r, sp = dqn_arrays
+    return [[[s[i, t], a[i, t], float(r[i, t]), sp[i, t]] for t in six.moves.range(s.shape[1])]
+            for i in six.moves.range(s.shape[0])]
 
 
 def preprocess_data_for_rnn(data):
     """
     converts the data (sequence of (exercise, performance, knowledge) triples) into the input and output format
      for the RNN in DKT.
-    :param data:
+    :param data: list of trajectories or a TrajectoryDataset
     :return:
     """
-    n_students = len(data)
-    n_timesteps = len(data[0])-1
+    actions, outcomes, n_concepts = gather_trajectory_arrays(data)
+    return _preprocess_arrays_for_rnn(actions, outcomes, n_concepts)
+
+
+def _preprocess_arrays_for_rnn(actions, outcomes, n_concepts, dtype=np.float64):
+    """
+    Same as preprocess_data_for_rnn but for trajectories given as an int array (n_students, seqlen)
+    of concept indices and a 0/1 array (n_students, seqlen) of results.
+    """
+    actions = np.asarray(actions, dtype=int)
+    outcomes = np.asarray(outcomes)
+    n_students, seqlen = actions.shape
+    n_timesteps = seqlen - 1
     assert n_timesteps > 0
-    exer = data[0][0][0]
-    n_concepts = len(exer)
-    n_inputdim = 2 * n_concepts
-    n_exercises = n_concepts
-    n_outputdim = n_exercises
-
-    input_data = np.zeros((n_students, n_timesteps, n_inputdim))
-    output_mask = np.zeros((n_students, n_timesteps, n_outputdim))
-    target_data = np.zeros((n_students, n_timesteps, n_outputdim))
-    for i in six.moves.range(n_students):
-        for t in six.moves.range(n_timesteps):
-            cur_sample = data[i][t]
-            next_sample = data[i][t+1]
-            exer, perf, knowl = cur_sample[0], cur_sample[1], cur_sample[2]
-            next_exer, next_perf, next_knowl = next_sample[0], next_sample[1], next_sample[2]
-            next_exer_ix = np.argmax(next_exer)
-
-            observ = np.zeros(2*len(exer))
-            if perf == 1:
-                observ[:len(exer)] = exer
-            else:
-                observ[len(exer):] = exer
-
-            input_data[i,t,:] = observ[:]
-
-            output_mask[i,t,next_exer_ix] = 1
-            target_data[i,t,next_exer_ix] = next_perf
 
+    input_data = encode_observations(actions[:, :-1], outcomes[:, :-1], n_concepts, dtype=dtype)
+
+    students = np.arange(n_students)[:, np.newaxis]
+    timesteps = np.arange(n_timesteps)[np.newaxis, :]
+    output_mask = np.zeros((n_students, n_timesteps, n_concepts), dtype=dtype)
+    target_data = np.zeros((n_students, n_timesteps, n_concepts), dtype=dtype)
+    output_mask[students, timesteps, actions[:, 1:]] = 1
+    target_data[students, timesteps, actions[:, 1:]] = outcomes[:, 1:]
     return input_data, output_mask, target_data
 
 
-def save_rnn_data(input_data, output_mask, target_data, filename):
-    np.save("{}{}_input_data.npy".format(RNN_DATA_DIR, filename), input_data)
-    np.save("{}{}_output_mask.npy".format(RNN_DATA_DIR, filename), output_mask)
-    np.save("{}{}_target_data.npy".format(RNN_DATA_DIR, filename), target_data)
+# Compact DKT training data: the exercised concept (int8, or int16 for more than 127 concepts) and the result (uint8)
+# of every step, both of shape (n_students, seqlen). The dense one-hot tensors of preprocess_data_for_rnn are
+# about 2 * n_concepts * 8 times larger; expand_rnn_batch builds them for one minibatch at a time.
+RnnIndexData = namedtuple('RnnIndexData', ['actions', 'outcomes'])
+
+
+def preprocess_data_for_rnn_compact(data):
+    """
+    Compact counterpart of preprocess_data_for_rnn, see RnnIndexData.
+    :param data: list of trajectories or a TrajectoryDataset
+    :return: (RnnIndexData, n_concepts)
+    """
+    actions, outcomes, n_concepts = gather_trajectory_arrays(data)
+    action_dtype = np.int8 if n_concepts <= np.iinfo(np.int8).max else np.int16
+    return RnnIndexData(actions.astype(action_dtype), outcomes.astype(np.uint8)), n_concepts
+
+
+def expand_rnn_batch(index_data, n_concepts, ix=slice(None), dtype=np.float32):
+    """
+    Builds the dense (input_data, output_mask, target_data) of preprocess_data_for_rnn for the rows ix
+    of index_data only.
+    :param index_data: RnnIndexData
+    :param ix: slice or index array of the students in the batch
+    """
+    return _preprocess_arrays_for_rnn(index_data.actions[ix], index_data.outcomes[ix], n_concepts, dtype=dtype)
+
+
+class _PrefetchError(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class MinibatchPrefetcher(object):
+    """
+    Iterates over the minibatches of one epoch while a background thread shuffles, slices and augments
+    the next ones, so that assembling batches in Python overlaps with the training step.
+    :param make_batch: function mapping a sorted index array of rows to a batch, e.g. a tuple of arrays
+    :param index_array: the rows to iterate over
+    :param n_prefetch: number of batches staged ahead
+    """
+    def __init__(self, make_batch, index_array, batch_size, shuffle=True, n_prefetch=4):
+        self.make_batch = make_batch
+        self.index_array = np.asarray(index_array)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_prefetch = n_prefetch
+
+    def __len__(self):
+        return (len(self.index_array) + self.batch_size - 1) // self.batch_size
+
+    def _produce(self, batches, q, stop):
+        for ix in batches:
+            try:
+                item = self.make_batch(ix)
+            except Exception as e:
+                item = _PrefetchError(e)
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except six.moves.queue.Full:
+                    pass
+            if stop.is_set() or isinstance(item, _PrefetchError):
+                return
+
+    def __iter__(self):
+        order = np.random.permutation(self.index_array) if self.shuffle else self.index_array
+        # sorted rows read memory-mapped data sequentially
+        batches = [np.sort(order[start:start + self.batch_size]) for start in six.moves.range(0, len(order), self.batch_size)]
+        q = six.moves.queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, q, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            for _ in six.moves.range(len(batches)):
+                item = q.get()
+                if isinstance(item, _PrefetchError):
+                    raise item.exc
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
 
+def save_rnn_data(input_data, output_mask, target_data, filename, data_dir=RNN_DATA_DIR):
+    np.save("{}{}_input_data.npy".format(data_dir, filename), input_data)
+    np.save("{}{}_output_mask.npy".format(data_dir, filename), output_mask)
+    np.save("{}{}_target_data.npy".format(data_dir, filename), target_data)
 
-def load_rnn_data(filename):
-    input_data = np.load("{}{}_input_data.npy".format(RNN_DATA_DIR, filename))
-    output_mask = np.load("{}{}_output_mask.npy".format(RNN_DATA_DIR, filename))
-    target_data = np.load("{}{}_target_data.npy".format(RNN_DATA_DIR, filename))
+
+def load_rnn_data(filename, data_dir=RNN_DATA_DIR, mmap_mode=None):
+    input_data = np.load("{}{}_input_data.npy".format(data_dir, filename), mmap_mode=mmap_mode)
+    output_mask = np.load("{}{}_output_mask.npy".format(data_dir, filename), mmap_mode=mmap_mode)
+    target_data = np.load("{}{}_target_data.npy".format(data_dir, filename), mmap_mode=mmap_mode)
     return input_data, output_mask, target_data
 
 
+# bump whenever the output of preprocess_data_for_rnn changes, so stale cache entries are not served
+RNN_CACHE_VERSION = 1
+RNN_DATA_FIELDS = ('input_data', 'output_mask', 'target_data')
+
+
+def hash_data_source(filename):
+    """
+    Content hash of a data file or trajectory dataset directory.
+    """
+    h = hashlib.sha1()
+    for path in _data_source_paths(filename):
+        h.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def _data_source_paths(filename):
+    if is_trajectory_dataset(filename):
+        return [os.path.join(filename, f) for f in sorted(os.listdir(filename)) if not f.endswith('.tmp')]
+    return [filename]
+
+
+def data_source_stamp(filename):
+    """
+    Cheap fingerprint of a data file or trajectory dataset directory: its path and the size and
+    modification time of its files. Used to find the content hash without reading the data.
+    """
+    stamp = [os.path.abspath(filename)]
+    for path in _data_source_paths(filename):
+        info = os.stat(path)
+        stamp.append((os.path.basename(path), info.st_size, info.st_mtime))
+    return stamp
+
+
+def rnn_cache_key(filename, **params):
+    """
+    Cache key of the preprocessed RNN tensors of the data in filename, given the preprocessing parameters.
+    """
+    h = hashlib.sha1()
+    h.update(hash_data_source(filename).encode('utf-8'))
+    h.update(repr(sorted(params.items()) + [('version', RNN_CACHE_VERSION)]).encode('utf-8'))
+    return h.hexdigest()[:20]
+
+
+def _stamp_path(cache_dir, filename, **params):
+    h = hashlib.sha1()
+    h.update(repr(data_source_stamp(filename)).encode('utf-8'))
+    h.update(repr(sorted(params.items()) + [('version', RNN_CACHE_VERSION)]).encode('utf-8'))
+    return "{}stamp-{}.txt".format(cache_dir, h.hexdigest()[:20])
+
+
+def _save_npy_atomic(path, array):
+    # write to a private temp file first so that concurrent readers never see a partial file
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    _rename_atomic(tmp, path)
+
+
+def _save_text_atomic(path, text):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    _rename_atomic(tmp, path)
+
+
+def _rename_atomic(tmp, path):
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another worker got there first (rename does not overwrite on windows)
+        os.remove(tmp)
+
+
+class _CacheLock(object):
+    """
+    Exclusive lock on a lock file, so that concurrent cache misses build an entry only once.
+    Where fcntl is not available (windows) it does not lock, and concurrent builders
+    write the same entry, each file replaced atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self._f = open(self.path, 'a')
+        fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._f is not None:
+            import fcntl
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+        return False
+
+
+def load_rnn_data_cached(filename, cache_dir=RNN_DATA_DIR, mmap_mode='r', compact=False):
+    """
+    Returns preprocess_data_for_rnn(load_data(filename)), cached as .npy files in cache_dir under a key derived
+    from the content of filename. The first caller preprocesses and writes the cache; every later call, including
+    from other processes, just maps the files, so parallel workers share a single page-cache copy.
+    The content of filename is only hashed when its path, size or modification time changed since the
+    last call, and concurrent misses wait for one builder instead of each preprocessing the data.
+    :param mmap_mode: passed to np.load; use None to get private in-memory arrays
+    :param compact: if True, cache and return preprocess_data_for_rnn_compact instead
+    :return: (input_data, output_mask, target_data), or (RnnIndexData, n_concepts) if compact
+    """
+    preprocess = 'rnn_compact' if compact else 'rnn'
+    fields = RnnIndexData._fields if compact else RNN_DATA_FIELDS
+
+    def entry_paths(name):
+        paths = ["{}{}_{}.npy".format(cache_dir, name, field) for field in fields]
+        if compact:
+            # the number of concepts is not recoverable from the indices, so keep it in the cache too
+            paths.append("{}{}_n_concepts.npy".format(cache_dir, name))
+        return paths
+
+    def cached_name():
+        # the content key of the data, if the data did not change since it was computed
+        if not os.path.exists(stamp_path):
+            return None
+        with open(stamp_path) as f:
+            name = f.read().strip()
+        return name if all(os.path.exists(path) for path in entry_paths(name)) else None
+
+    stamp_path = _stamp_path(cache_dir, filename, preprocess=preprocess)
+    name = cached_name()
+    if name is None:
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created concurrently
+                pass
+        with _CacheLock("{}cache.lock".format(cache_dir)):
+            name = cached_name()
+            if name is None:
+                name = 'cache-{}'.format(rnn_cache_key(filename, preprocess=preprocess))
+                paths = entry_paths(name)
+                if not all(os.path.exists(path) for path in paths):
+                    if compact:
+                        index_data, n_concepts = preprocess_data_for_rnn_compact(load_data(filename))
+                        tensors = list(index_data) + [np.array(n_concepts)]
+                    else:
+                        tensors = preprocess_data_for_rnn(load_data(filename))
+                    for path, tensor in six.moves.zip(paths, tensors):
+                        _save_npy_atomic(path, tensor)
+                _save_text_atomic(stamp_path, name)
+    paths = entry_paths(name)
+    if compact:
+        index_data = RnnIndexData(*[np.load(path, mmap_mode=mmap_mode) for path in paths[:-1]])
+        return index_data, int(np.load(paths[-1]))
+    return load_rnn_data(name, data_dir=cache_dir, mmap_mode=mmap_mode)
+
+
 def convert_to_rnn_input(action, observation):
     concept_vec = action.conceptvec
     input = np.zeros(2  * len(concept_vec))
@@ -0,0 +1,130 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests for the cache of preprocessed RNN tensors and the conversion of pickled data files.
+#===============================================================================
+# USAGE: python dataset_utils_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import six
+
+import concept_dependency_graph as cdg
+import data_generator as dg
+import dataset_utils
+import student as st
+
+
+def _write_data(filename, n_students, seed):
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(4)
+    return dg.generate_data(dgraph, student=st.Student2(4, True), n_students=n_students, seqlen=5,
+                            policy='random', seed=seed, filename=filename)
+
+
+def _count_calls(module, name, log):
+    '''
+    Wraps module.name so that every call appends a line to the file log.
+    '''
+    original = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        with open(log, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        return original(*args, **kwargs)
+    setattr(module, name, wrapper)
+
+
+def _n_calls(log):
+    if not os.path.exists(log):
+        return 0
+    with open(log) as f:
+        return len(f.readlines())
+
+
+def _cached_worker(filename, cache_dir, log, barrier):
+    _count_calls(dataset_utils, 'preprocess_data_for_rnn', log)
+    barrier.wait()
+    dataset_utils.load_rnn_data_cached(filename, cache_dir=cache_dir)
+
+
+def test_cache_hits_skip_hashing():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'data.pickle')
+        cache_dir = os.path.join(tmpdir, 'cache') + os.sep
+        data = _write_data(filename, 20, seed=1)
+        hash_log = os.path.join(tmpdir, 'hash.log')
+        hash_data_source = dataset_utils.hash_data_source
+        _count_calls(dataset_utils, 'hash_data_source', hash_log)
+        try:
+            expected = dataset_utils.preprocess_data_for_rnn(data)
+            for _ in six.moves.range(3):
+                tensors = dataset_utils.load_rnn_data_cached(filename, cache_dir=cache_dir)
+                assert all(np.array_equal(a, b) for a, b in six.moves.zip(tensors, expected))
+            assert _n_calls(hash_log) == 1
+
+            # new content is noticed through the size and modification time
+            data = _write_data(filename, 30, seed=2)
+            tensors = dataset_utils.load_rnn_data_cached(filename, cache_dir=cache_dir)
+            assert tensors[0].shape[0] == 30
+            assert _n_calls(hash_log) == 2
+        finally:
+            dataset_utils.hash_data_source = hash_data_source
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_concurrent_misses_build_once(n_workers=4):
+    if not hasattr(os, 'fork'):
+        return
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'data.pickle')
+        cache_dir = os.path.join(tmpdir, 'cache') + os.sep
+        _write_data(filename, 200, seed=3)
+        log = os.path.join(tmpdir, 'build.log')
+        ctx = mp.get_context('fork')
+        barrier = ctx.Barrier(n_workers)
+        workers = [ctx.Process(target=_cached_worker, args=(filename, cache_dir, log, barrier))
+                   for _ in six.moves.range(n_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        assert _n_calls(log) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_single_list_chunks():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'data.pickle')
+        data = _write_data(filename, 23, seed=4)
+        chunks = list(dataset_utils.iter_data_chunks(filename, chunk_size=10))
+        assert [len(chunk) for chunk in chunks] == [10, 10, 3]
+        chunked = [trajectory for chunk in chunks for trajectory in chunk]
+        for actual, expected in six.moves.zip(dataset_utils.gather_trajectory_arrays(chunked),
+                                              dataset_utils.gather_trajectory_arrays(data)):
+            assert np.array_equal(actual, expected)
+
+        dataset = dataset_utils.convert_to_trajectory_dataset(filename, os.path.join(tmpdir, 'data.traj'))
+        assert len(dataset) == 23
+        for actual, expected in six.moves.zip(dataset_utils.gather_trajectory_arrays(dataset),
+                                              dataset_utils.gather_trajectory_arrays(data)):
+            assert np.array_equal(actual, expected)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_cache_hits_skip_hashing()
+    test_single_list_chunks()
+    test_concurrent_misses_build_once()
+    six.print_('All tests passed.')
@@ -30,7 +30,7 @@ def test_drqn_single(dgraph, student, horizon, model, DEBUG=False):
 
     # create the model and simulators
     student.reset()
-    student.knowledge[0] = 1  # initialize the first concept to be known
+    student.learn(0)  # initialize the first concept to be known
     sim = st.StudentExactSim(student, dgraph)
 
     # initialize state (or alternatively choose random first action)
@@ -49,7 +49,7 @@ def test_drqn_single(dgraph, student, horizon, model, DEBUG=False):
 
         # debug check for whether action is optimal
         if DEBUG:
-            opt_acts = compute_optimal_actions(sim.dgraph, sim.student.knowledge) # put function code into shared file
+            opt_acts = compute_optimal_actions(sim.dgraph, sim.student.knowledge, frontier=sim.frontier) # put function code into shared file
             is_opt = action.concept in opt_acts
             if not is_opt:
                 print('ERROR {} executed non-optimal action {}'.format(sim.student.knowledge,
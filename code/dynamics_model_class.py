@@ -5,6 +5,7 @@
 #===============================================================================
 # DESCRIPTION:
 # exports dynamics model class, allows training and predicts next observation
+# The student simulators live in student_sim and are re-exported here.
 #
 #===============================================================================
 # CURRENT STATUS: In progress
@@ -28,6 +29,8 @@ from helpers import *
 import utils
 import dataset_utils as d_utils
 import models_dict_utils
+import numpy_dynamics_model
+from student_sim import RnnStudentSim, RnnStudentSimMemEnsemble, RnnStudentSimSparseMem, RnnStudentSimEnsemble, load_mem_student_sim
 FLAGS = tf.flags.FLAGS
 
 class DynamicsModel(object):
@@ -78,6 +81,11 @@ class DynamicsModel(object):
                                                                                      output_dropout=output_dropout)
             else:
                 assert(False)
+            # inference graphs for each history length, see predict()
+            self._length_graphs = {}
+            # single step inference graph sharing the weights, see step()
+            self._build_step_graph(self.model_dict["architecture"], n_inputdim=self.model_dict["n_inputdim"],
+                                   n_hidden=self.model_dict["n_hidden"], n_outputdim=self.model_dict["n_outputdim"])
 
             tensorboard_dir = '../tensorboard_logs/' + model_id + '/'
             checkpoint_dir = '../checkpoints/' + model_id + '/'
@@ -103,7 +111,8 @@ class DynamicsModel(object):
             #print('Model loaded.')
 
     def _build_regression_lstm_net(self, n_timesteps=1, n_inputdim=None, n_hidden=None,
-                                           n_outputdim=None, dropout=1.0):
+                                           n_outputdim=None, dropout=1.0, output_dropout=1.0):
+        # output_dropout is only used by the grusimple architecture
         net = tflearn.input_data([None, n_timesteps, n_inputdim],dtype=tf.float32, name='input_data')
         output_mask = tflearn.input_data([None, n_timesteps, n_outputdim], dtype=tf.float32, name='output_mask')
         net, hidden_states_1 = tflearn.lstm(net, n_hidden, weights_init='xavier', return_seq=True, return_state=True, dropout=dropout, name="lstm_1")
@@ -115,11 +124,12 @@ class DynamicsModel(object):
         return net, hidden_states_1, hidden_states_2
     
     def _build_regression_lstm_net2(self, n_timesteps=1, n_inputdim=None, n_hidden=None,
-                                           n_outputdim=None, dropout=1.0):
+                                           n_outputdim=None, dropout=1.0, output_dropout=1.0):
         # don't have 2 lstms, just have a shared output layer
         # this alternative doesn't seem to work as well
         net = tflearn.input_data([None, n_timesteps, n_inputdim],dtype=tf.float32, name='input_data')
         output_mask = tflearn.input_data([None, n_timesteps, n_outputdim], dtype=tf.float32, name='output_mask')
+        # output_dropout is only used by the grusimple architecture
         net, hidden_states_1 = tflearn.lstm(net, n_hidden, weights_init='xavier', return_seq=True, return_state=True, dropout=dropout, name="lstm_1")
         net = [tflearn.fully_connected(net[i], n_outputdim, activation='sigmoid', weights_init='xavier', scope='output_shared', reuse=(i>0)) for i in six.moves.range(n_timesteps)]
         net = tf.stack(net, axis=1)
@@ -129,7 +139,8 @@ class DynamicsModel(object):
         return net, hidden_states_1, None
 
     def _build_regression_lstm_net_gru(self, n_timesteps=1, n_inputdim=None, n_hidden=None,
-                                           n_outputdim=None, dropout=1.0):
+                                           n_outputdim=None, dropout=1.0, output_dropout=1.0):
+        # output_dropout is only used by the grusimple architecture
         net = tflearn.input_data([None, n_timesteps, n_inputdim],dtype=tf.float32, name='input_data')
         output_mask = tflearn.input_data([None, n_timesteps, n_outputdim], dtype=tf.float32, name='output_mask')
         net, hidden_states_1 = tflearn.gru(net, n_hidden, weights_init='xavier', return_seq=True, return_state=True, dropout=dropout, name="gru_1")
@@ -156,6 +167,61 @@ class DynamicsModel(object):
                                  loss='mean_square') # mean square works
         return net, hidden_states_1, None
     
+    def _build_step_graph(self, architecture, n_inputdim=None, n_hidden=None, n_outputdim=None):
+        '''
+        Builds a graph that advances the recurrent layers by a single step from given hidden states,
+        reusing the variables of the training graph. Dropout is left out since it is off at inference anyway.
+        '''
+        layers = numpy_dynamics_model.recurrent_layers(architecture, n_hidden, n_outputdim)
+        self.step_input = tf.placeholder(tf.float32, [None, n_inputdim], name='step_input')
+        self.step_states_in = []
+        self.step_states_out = []
+        net = self.step_input
+        for cell, n_units, activation, scope in layers:
+            if cell == 'lstm':
+                c = tf.placeholder(tf.float32, [None, n_units], name='{}_step_c'.format(scope))
+                h = tf.placeholder(tf.float32, [None, n_units], name='{}_step_h'.format(scope))
+                net, state = tflearn.lstm(tf.expand_dims(net, 1), n_units, activation=activation, weights_init='xavier',
+                                          return_state=True, initial_state=tf.contrib.rnn.LSTMStateTuple(c, h),
+                                          reuse=True, scope=scope)
+                self.step_states_in.extend([c, h])
+                self.step_states_out.extend([state.c, state.h])
+            else:
+                h = tf.placeholder(tf.float32, [None, n_units], name='{}_step_h'.format(scope))
+                net, state = tflearn.gru(tf.expand_dims(net, 1), n_units, activation=activation, weights_init='xavier',
+                                         return_state=True, initial_state=h, reuse=True, scope=scope)
+                self.step_states_in.append(h)
+                self.step_states_out.append(state)
+        if len(layers) == 1:
+            # shared output layer
+            net = tflearn.fully_connected(net, n_outputdim, activation='sigmoid', weights_init='xavier',
+                                          scope='output_shared', reuse=True)
+        self.step_output = net
+
+    def initial_states(self, n_samples):
+        '''
+        The hidden states before the first step: zeros, as in the training graph.
+        :return: list of arrays of shape (n_samples, n_units), one per state tensor
+        '''
+        return [np.zeros((n_samples, int(state.get_shape()[1])), dtype=np.float32) for state in self.step_states_in]
+
+    def step(self, inputs, states=None):
+        '''
+        Advances the model by one step for a batch of histories, without rerunning the histories.
+        :param inputs: array of shape (n_samples, n_inputdim), the next input of every history
+        :param states: hidden states of the histories returned by the previous step, or None at the start
+        :return: (predictions of shape (n_samples, n_outputdim), new hidden states)
+        Predictions agree with predict() on the whole history as long as it is at most timesteps long.
+        '''
+        with self._tfgraph.as_default():
+            inputs = np.asarray(inputs, dtype=np.float32)
+            if states is None:
+                states = self.initial_states(inputs.shape[0])
+            feed_dict = {self.step_input: inputs}
+            feed_dict.update(zip(self.step_states_in, states))
+            results = self._model.session.run([self.step_output] + self.step_states_out, feed_dict=feed_dict)
+            return results[0], results[1:]
+
     def load(self, s):
         with self._tfgraph.as_default():
             #tf.reset_default_graph()
@@ -166,44 +232,168 @@ class DynamicsModel(object):
             #tf.reset_default_graph()
             self._model.save(s)
 
-    def train(self, train_data, n_epoch=1, callbacks=[], shuffle=None, load_checkpoint=True, validation_set=0.1, batch_size=None):
+    def train(self, train_data, n_epoch=1, callbacks=[], shuffle=None, load_checkpoint=True, validation_set=0.1, batch_size=None, noise=0.0):
         """
 
-        :param train_data: tuple (input_data, output_mask, output_data)
+        :param train_data: tuple (input_data, output_mask, output_data), or a dataset_utils.RnnIndexData
+        whose dense tensors are built one minibatch at a time. The arrays may be memory-mapped.
         :param n_epoch: number of epochs to train for
         :param load_checkpoint: whether to train from checkpoint or from scratch
+        :param validation_set: fraction of the data held out to compute the validation loss after every epoch,
+        or separate validation data in the same format as train_data, as for tflearn's fit
+        :param noise: std of the gaussian noise added to the inputs of every training minibatch
         :return:
         """
         with self._tfgraph.as_default():
             #tf.reset_default_graph()
-            input_data, output_mask, output_data = train_data
-            date_time_string = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
-            run_id = "{}".format(date_time_string)
-            self._model.fit([input_data, output_mask], output_data, n_epoch=n_epoch, validation_set=validation_set, run_id=run_id, callbacks=callbacks, shuffle=shuffle, batch_size=batch_size)
-
-
-    def predict(self, input_data):
+            make_batch, n_samples = self._batch_maker(train_data, noise)
+            if isinstance(validation_set, tuple):
+                # RnnIndexData is a tuple too
+                validation_set = self._batch_maker(validation_set, 0.0)
+            self._train_minibatches(make_batch, n_samples, n_epoch=n_epoch, callbacks=callbacks, shuffle=shuffle,
+                                    validation_set=validation_set, batch_size=batch_size)
+
+    def _batch_maker(self, data, noise):
         """
-        :param input_data: of shape (n_samples, n_timesteps, n_inputdim).
-        :return:
+        :param data: tuple (input_data, output_mask, output_data) or a dataset_utils.RnnIndexData, see train
+        :return: (function (sorted row indices, whether to augment) -> (input, mask, target) arrays, number of samples)
+        """
+        if isinstance(data, d_utils.RnnIndexData):
+            n_concepts = self.model_dict["n_outputdim"]
+            assert data.actions.shape[1] - 1 == self.timesteps, "sequence length of data doesn't match the model."
+
+            def make_batch(ix, add_noise):
+                input_data, output_mask, output_data = d_utils.expand_rnn_batch(data, n_concepts, ix)
+                if add_noise and noise:
+                    input_data += noise * np.random.randn(*input_data.shape)
+                return input_data, output_mask, output_data
+            return make_batch, data.actions.shape[0]
+
+        input_data, output_mask, output_data = data
+
+        def make_batch(ix, add_noise):
+            batch_input = input_data[ix]
+            if add_noise and noise:
+                batch_input = batch_input + noise * np.random.randn(*batch_input.shape)
+            return batch_input, output_mask[ix], output_data[ix]
+        return make_batch, input_data.shape[0]
+
+    def _train_minibatches(self, make_batch, n_samples, n_epoch, callbacks, shuffle, validation_set, batch_size):
+        """
+        Training loop: runs the tflearn train op on minibatches assembled by a background
+        d_utils.MinibatchPrefetcher. Reports to the callbacks like tflearn's fit, i.e. the last batch
+        of every epoch carries the validation loss, averaged over the validation samples.
+        This drives tflearn's TrainOp and TrainingState directly, as laid out in tflearn 0.3, and unlike
+        fit it writes no TensorBoard summaries.
+        :param make_batch: function (sorted row indices, whether to augment) -> (input, mask, target) arrays
+        :param validation_set: fraction of the samples to hold out, or (make_batch, n_samples) of separate validation data
+        """
+        train_op = self._model.trainer.train_ops[0]
+        sess = self._model.session
+        input_ph, mask_ph = self._model.inputs[0], self._model.inputs[1]
+        target_ph = self._model.targets[0]
+        batch_size = batch_size or train_op.batch_size
+        shuffle = True if shuffle is None else shuffle
+        if not isinstance(callbacks, list):
+            callbacks = [callbacks]
+
+        def feed(batch):
+            return {input_ph: batch[0], mask_ph: batch[1], target_ph: batch[2]}
+
+        index_array = np.arange(n_samples)
+        if isinstance(validation_set, tuple):
+            make_val_batch, n_val = validation_set
+            val_array = np.arange(n_val)
+        else:
+            # split off a random validation set once, as tflearn does for a float validation_set
+            make_val_batch = make_batch
+            n_val = int(validation_set * n_samples) if validation_set else 0
+            if n_val > 0:
+                np.random.shuffle(index_array)
+            val_array = index_array[n_samples - n_val:]
+            index_array = index_array[:n_samples - n_val]
+        n_train = len(index_array)
+        train_batches = d_utils.MinibatchPrefetcher(lambda ix: make_batch(ix, True), index_array, batch_size, shuffle=shuffle)
+        val_batches = d_utils.MinibatchPrefetcher(lambda ix: make_val_batch(ix, False), val_array, batch_size, shuffle=False)
+
+        def validation_loss():
+            # the loss is a mean over the batch, so weight every batch by its size
+            total = 0.0
+            for val_batch in val_batches:
+                total += sess.run(train_op.loss, feed_dict=feed(val_batch)) * len(val_batch[0])
+            return float(total / n_val)
+
+        state = tflearn.helpers.trainer.TrainingState()
+        for cb in callbacks:
+            cb.on_train_begin(state)
+        for _ in six.moves.range(n_epoch):
+            state.increaseEpoch()
+            for cb in callbacks:
+                cb.on_epoch_begin(state)
+            n_batches = len(train_batches)
+            for b, batch in enumerate(train_batches):
+                state.increaseStep()
+                state.resetGlobal()
+                for cb in callbacks:
+                    cb.on_batch_begin(state)
+                tflearn.is_training(True, session=sess)
+                _, loss = sess.run([train_op.train, train_op.loss], feed_dict=feed(batch))
+                tflearn.is_training(False, session=sess)
+                state.loss_value = loss
+                state.global_loss = loss
+                state.current_iter = min((b + 1) * batch_size, n_train)
+                snapshot = b == n_batches - 1
+                if snapshot and n_val > 0:
+                    state.val_loss = validation_loss()
+                for cb in callbacks:
+                    cb.on_batch_end(state, snapshot)
+            for cb in callbacks:
+                cb.on_epoch_end(state)
+        for cb in callbacks:
+            cb.on_train_end(state)
+
+    def _build_length_graph(self, n_timesteps):
+        '''
+        Builds an inference graph for histories of exactly n_timesteps, reusing the variables of the training graph.
+        Like the step graph it leaves out dropout and the output mask.
+        :return: (input placeholder of shape (None, n_timesteps, n_inputdim), predictions of shape (None, n_timesteps, n_outputdim))
+        '''
+        n_inputdim = self.model_dict["n_inputdim"]
+        n_outputdim = self.model_dict["n_outputdim"]
+        layers = numpy_dynamics_model.recurrent_layers(self.model_dict["architecture"], self.model_dict["n_hidden"], n_outputdim)
+        input_data = tf.placeholder(tf.float32, [None, n_timesteps, n_inputdim], name='input_data_{}'.format(n_timesteps))
+        net = input_data
+        for cell, n_units, activation, scope in layers:
+            rnn = tflearn.lstm if cell == 'lstm' else tflearn.gru
+            net = rnn(net, n_units, activation=activation, weights_init='xavier', return_seq=True, reuse=True, scope=scope)
+        if len(layers) == 1:
+            # shared output layer
+            net = [tflearn.fully_connected(net[i], n_outputdim, activation='sigmoid', weights_init='xavier',
+                                           scope='output_shared', reuse=True) for i in six.moves.range(n_timesteps)]
+        return input_data, tf.stack(net, axis=1)
+
+    def predict(self, input_data=None, actions=None, outcomes=None):
+        """
+        Runs the model on histories of any length up to timesteps. Each length gets its own unrolled graph,
+        built on first use and shared with later calls, so short histories don't pay for the full unroll
+        and no padding is needed.
+        :param input_data: of shape (n_samples, n_timesteps, n_inputdim). Histories longer than timesteps are truncated.
+        :param actions, outcomes: instead of input_data, the index-encoded inputs as int arrays of shape
+        (n_samples, n_timesteps) of exercised concepts and 0/1 results; they are one-hot encoded here.
+        :return: predictions of shape (n_samples, min(n_timesteps, timesteps), n_outputdim)
         """
         with self._tfgraph.as_default():
+            if input_data is None:
+                input_data = d_utils.encode_observations(actions, outcomes, self.model_dict["n_outputdim"], dtype=np.float32)
             n_samples, n_timesteps, n_inputdim = input_data.shape
             assert(n_inputdim == self.model_dict["n_inputdim"]), "input dimension of data doesn't match the model."
-            n_outputdim = self.model_dict["n_outputdim"]
-            output_mask = np.ones((n_samples, n_timesteps, n_outputdim))
-            if n_timesteps < self.timesteps:  # pad inputs and mask
-                padded_input = np.zeros((n_samples, self.timesteps, n_inputdim))
-                padded_input[:, :n_timesteps, :] = input_data[:, :, :]
-                input_data = padded_input
-                padded_mask = np.zeros((n_samples, self.timesteps, n_outputdim))
-                padded_mask[:,:n_timesteps,:] = output_mask[:,:,:]
-                output_mask = padded_mask
-            elif n_timesteps > self.timesteps: # truncate inputs and mask
+            if n_timesteps > self.timesteps: # truncate inputs
                 input_data = input_data[:, :self.timesteps, :]
-                output_mask = output_mask[:, :self.timesteps, :]
-            #tf.reset_default_graph()
-            return self._model.predict([input_data, output_mask])
+                n_timesteps = self.timesteps
+            if n_timesteps not in self._length_graphs:
+                self._length_graphs[n_timesteps] = self._build_length_graph(n_timesteps)
+            input_ph, output = self._length_graphs[n_timesteps]
+            return self._model.session.run(output, feed_dict={input_ph: input_data})
     
     def get_timesteps(self):
         return self.timesteps
@@ -216,163 +406,3 @@ class DMCManager(BaseManager):
     pass
 
 DMCManager.register('DynamicsModel', DynamicsModel)
-
-class RnnStudentSim(object):
-    '''
-    A model-based simulator for a student. Maintains its own internal hidden state.
-    Currently model can be shared because only the history matters
-    '''
-
-    def __init__(self, model):
-        self.model = model
-        self.seq_max_len = model.get_timesteps()
-        self.sequence = [] # will store up to seq_max_len
-        pass
-
-
-    def sample_observations(self):
-        """
-        Returns list of probabilities
-        """
-        # special case when self.sequence is empty
-        if not self.sequence:
-            return None
-        else:
-            # turns the list of input vectors, into a numpy matrix of shape (1, n_timesteps, 2*n_concepts)
-            # We need the first dimension since the network expects a batch.
-            rnn_input_sequence = np.expand_dims(np.array(self.sequence), axis=0)
-            pred = self.model.predict(rnn_input_sequence)
-            t = len(self.sequence)
-
-            prob_success_action = pred[0][t-1]
-            # observation is a probability
-            return prob_success_action
-
-
-    def advance_simulator(self, action, observation):
-        '''
-        Given next action and observation, advance the internal hidden state of the simulator.
-        '''
-        input = d_utils.convert_to_rnn_input(action, observation)
-        if len(self.sequence) == self.seq_max_len:
-            self.sequence = self.sequence[1:] + [input]
-        else:
-            self.sequence.append(input)
-
-
-    def copy(self):
-        '''
-        Make a copy of the current simulator.
-
-        '''
-        sim_copy = RnnStudentSim(self.model)
-        sim_copy.sequence = self.sequence[:] # deep copy
-        return sim_copy
-
-class RnnStudentSimMemEnsemble(object):
-    '''
-    A model-based simulator for a student. Maintains its own internal hidden state.
-    Currently model can be shared because only the history matters
-    Uses an ensemble of memoized models.
-    '''
-
-    def __init__(self, n_concepts, mem_arrays_list):
-        self.n_concepts = n_concepts
-        self.mem_arrays_list = mem_arrays_list
-        self.seq_max_len = len(mem_arrays_list[0])-1
-        # story the current state
-        self.step = 0
-        self.history_ix = 0
-
-
-    def sample_observations(self):
-        """
-        Returns next probabilities
-        """
-        # special case when self.sequence is empty
-        if self.step == 0:
-            return None
-        else:
-            pred_list = []
-            for mem_arrays in self.mem_arrays_list:
-                pred_list.append(mem_arrays[self.step][self.history_ix,:])
-            return np.mean(pred_list,axis=0)
-
-
-    def advance_simulator(self, action, observation):
-        '''
-        Given next action and observation, advance the internal hidden state of the simulator.
-        action is StudentAction
-        observation is 0 or 1
-        '''
-        self.step += 1
-        next_branch = action_ob_encode(self.n_concepts, action.concept, observation)
-        self.history_ix = history_ix_append(self.n_concepts, self.history_ix, next_branch)
-
-
-    def copy(self):
-        '''
-        Make a copy of the current simulator.
-        '''
-        sim_copy = RnnStudentSimMemEnsemble(self.n_concepts, self.mem_arrays_list)
-        sim_copy.step = self.step
-        sim_copy.history_ix = self.history_ix
-        return sim_copy
-
-class RnnStudentSimEnsemble(object):
-    '''
-    A model-based simulator for a student.
-    It's an ensemble of many models and averages their predictions.
-    '''
-
-    def __init__(self, model_list):
-        self.model_list = model_list
-        self.seq_max_len = model_list[0].get_timesteps()
-        self.sequence = [] # will store up to seq_max_len
-        pass
-
-
-    def sample_observations(self):
-        """
-        Returns list of probabilities
-        """
-        # special case when self.sequence is empty
-        if not self.sequence:
-            return None
-        else:
-            # turns the list of input vectors, into a numpy matrix of shape (1, n_timesteps, 2*n_concepts)
-            # We need the first dimension since the network expects a batch.
-            rnn_input_sequence = np.expand_dims(np.array(self.sequence), axis=0)
-            t = len(self.sequence)
-            
-            # average the predictions
-            pred_list = []
-            for curr_model in self.model_list:
-                pred_list.append(curr_model.predict(rnn_input_sequence)[0][t-1])
-            
-            prob_success_action = np.mean(pred_list,axis=0)
-            #six.print_('prob success action shape {}'.format(prob_success_action.shape))
-            
-            # observation is a probability
-            return prob_success_action
-
-
-    def advance_simulator(self, action, observation):
-        '''
-        Given next action and observation, advance the internal hidden state of the simulator.
-        '''
-        input = d_utils.convert_to_rnn_input(action, observation)
-        if len(self.sequence) == self.seq_max_len:
-            self.sequence = self.sequence[1:] + [input]
-        else:
-            self.sequence.append(input)
-
-
-    def copy(self):
-        '''
-        Make a copy of the current simulator.
-
-        '''
-        sim_copy = RnnStudentSimEnsemble(self.model_list) #list of models is shared
-        sim_copy.sequence = self.sequence[:] # deep copy
-        return sim_copy
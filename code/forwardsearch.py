@@ -26,11 +26,12 @@ import dataset_utils
 
 from simple_mdp import SimpleMDP
 from joblib import Parallel, delayed
+from memo_tables import MEM_DTYPES, load_mem_arrays, quantization_error, SparseMemArrays
 
 from helpers import * # helper functions
 from simple_mdp import create_custom_dependency
 
-def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len):
+def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len, dkt_probs=None, sim_probs=None):
     '''
     Given the current history, compute the q-values of the optimal policy according to the dkt
     under both SEMISPARSE and SPARSE rewards. Also, a list of optimal actions and q-values
@@ -41,6 +42,8 @@ def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len)
     :param sim: an RnnStudentSim-like object
     :param horizon: the horizon
     :param history_len: length of current history
+    :param dkt_probs, sim_probs: the sample_observations of dkt and sim if already known. The children of a node
+    are queried together in one batch and passed down this way.
     Return (
         learned semisparse value,
         learned sparse value,
@@ -54,10 +57,15 @@ def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len)
     #six.print_('history len {}'.format(history_len))
     
     assert history_len <= horizon
+    if dkt_probs is None:
+        dkt_probs = dkt.sample_observations()
+    if sim_probs is None:
+        sim_probs = sim.sample_observations()
+
     if history_len == horizon:
         # we have now finished running horizon number of actions, it's time for the final reward
-        dkt_probs = sanitize_probs(n_concepts, dkt.sample_observations())
-        sim_probs = sanitize_probs(n_concepts, sim.sample_observations())
+        dkt_probs = sanitize_probs(n_concepts, dkt_probs)
+        sim_probs = sanitize_probs(n_concepts, sim_probs)
         
         semisparse_reward = np.mean(dkt_probs)
         sparse_reward = np.prod(dkt_probs)
@@ -86,8 +94,22 @@ def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len)
     sim_ssqvalues = np.zeros((n_concepts,))
     sim_sqvalues = np.zeros((n_concepts,))
     
-    next_probs = sanitize_probs(n_concepts, dkt.sample_observations())
-    sim_next_probs = sanitize_probs(n_concepts, sim.sample_observations())
+    next_probs = sanitize_probs(n_concepts, dkt_probs)
+    sim_next_probs = sanitize_probs(n_concepts, sim_probs)
+    
+    # advance the dkt and sim by every next action and observation, and query all of them at once
+    next_dkts = []
+    next_sims = []
+    for next_action in six.moves.range(n_concepts):
+        for next_ob in (0,1):
+            next_dkt = dkt.copy()
+            next_dkt.advance_simulator(st.make_student_action(n_concepts,next_action), next_ob)
+            next_dkts.append(next_dkt)
+            next_sim = sim.copy()
+            next_sim.advance_simulator(st.make_student_action(n_concepts,next_action), next_ob)
+            next_sims.append(next_sim)
+    next_dkt_probs = sample_observations_batch(next_dkts)
+    next_sim_probs = sample_observations_batch(next_sims)
     
     next_ss_list = [[] for _ in six.moves.range(n_concepts)]
     next_s_list = [[] for _ in six.moves.range(n_concepts)]
@@ -106,14 +128,12 @@ def dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, history_len)
         curr_sim_sq = 0.0
         
         for next_ob in (0,1):
-            # advance the state
-            next_dkt = dkt.copy()
-            next_dkt.advance_simulator(st.make_student_action(n_concepts,next_action), next_ob)
-            next_sim = sim.copy()
-            next_sim.advance_simulator(st.make_student_action(n_concepts,next_action), next_ob)
+            # the advanced state
+            child = 2 * next_action + next_ob
             
             next_ssv,next_sv,next_sim_ssv,next_sim_sv,ss_list,s_list,sim_ss_list,sim_s_list = dkt_forwardsearch_single_recurse(
-                n_concepts, next_dkt, next_sim, horizon, history_len+1)
+                n_concepts, next_dkts[child], next_sims[child], horizon, history_len+1,
+                dkt_probs=next_dkt_probs[child], sim_probs=next_sim_probs[child])
             
             next_ss_list[next_action].append(ss_list)
             next_s_list[next_action].append(s_list)
@@ -182,11 +202,7 @@ def dkt_forwardsearch_single(n_concepts, model_id, checkpoints, horizon, use_mem
             model_list.append(model)
         dkt = dmc.RnnStudentSimEnsemble(model_list)
     else:
-        mem_array_list = []
-        for chkpt in checkpoints:
-            mem_arrays = np.load(chkpt)['mem_arrays']
-            mem_array_list.append(mem_arrays)
-        dkt = dmc.RnnStudentSimMemEnsemble(n_concepts, mem_array_list)
+        dkt = dmc.load_mem_student_sim(n_concepts, checkpoints, horizon)
     
     concept_tree = cdg.ConceptDependencyGraph()
     concept_tree.init_default_tree(n_concepts)
@@ -205,6 +221,48 @@ def dkt_forwardsearch_single(n_concepts, model_id, checkpoints, horizon, use_mem
     return dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, 0)
 
 
+def memo_quantization_report(n_concepts, mem_paths, horizon=None, dtypes=MEM_DTYPES[1:]):
+    '''
+    Compares storing the memo tables of an ensemble quantized against the full precision tables:
+    the deviation of the memoized probabilities, and of the forward search values and policy.
+    :param mem_paths: the memo files of the ensemble members, dense and stored as float64 since they are the reference
+    :param horizon: the forward search horizon, by default the memoized horizon
+    :param dtypes: the storage types to compare, see memo_tables.MEM_DTYPES
+    :return: dict from dtype to dict of the deviations
+    '''
+    mem_array_list = [load_mem_arrays(path) for path in mem_paths]
+    for path, mem_arrays in six.moves.zip(mem_paths, mem_array_list):
+        if isinstance(mem_arrays, SparseMemArrays) or any(level.dtype != np.float64 for level in mem_arrays):
+            raise ValueError('The memo tables at {} are not dense float64 tables and cannot be the reference; '
+                             'memoize the models with dtype=None and without a threshold.'.format(path))
+    if horizon is None:
+        horizon = len(mem_array_list[0]) - 1
+    
+    concept_tree = cdg.ConceptDependencyGraph()
+    concept_tree.init_default_tree(n_concepts)
+    
+    def search(dkt):
+        sim = st.RnnStudent2SimExact(concept_tree)
+        return dkt_forwardsearch_single_recurse(n_concepts, dkt, sim, horizon, 0)
+    
+    ssv, sv, _, _, ss_list, s_list, _, _ = search(dmc.RnnStudentSimMemEnsemble(n_concepts, mem_array_list))
+    report = {}
+    for dtype in dtypes:
+        errors = [quantization_error(mem_arrays, dtype) for mem_arrays in mem_array_list]
+        q_ssv, q_sv, _, _, q_ss_list, q_s_list, _, _ = search(dmc.RnnStudentSimMemEnsemble(n_concepts, mem_array_list, dtype=dtype))
+        report[dtype] = {
+            'max_prob_error': max(max_error for max_error, _ in errors),
+            'mean_prob_error': float(np.mean([mean_error for _, mean_error in errors])),
+            'semisparse_value_error': float(abs(q_ssv - ssv)),
+            'sparse_value_error': float(abs(q_sv - sv)),
+            # whether the optimal actions along the sim trajectory are unchanged
+            'same_semisparse_policy': [a for a, _ in q_ss_list] == [a for a, _ in ss_list],
+            'same_sparse_policy': [a for a, _ in q_s_list] == [a for a, _ in s_list],
+        }
+        six.print_('{:>8}: {}'.format(dtype, report[dtype]))
+    return report
+
+
 def dkt_forwardsearch_single_wrapper(runs, ep, n_concepts, model_id, checkpoints, horizon, use_mem):
     print('=====================================')
     print('Started Runs {} Epoch {}'.format(runs, ep))
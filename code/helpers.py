@@ -3,24 +3,17 @@
 import six
 import numpy as np
 import data_generator as dg
+import concept_dependency_graph as cdg
+from trajectory_dataset import TrajectoryDataset
 
 def k2i(knowledge):
-    # converts a knowledge numpy array to a state index
-    ix = 0
-    acc = 1
-    for i in xrange(knowledge.shape[0]):
-        ix += acc * knowledge[i]
-        acc *= 2
-    return int(ix)
+    # converts a knowledge numpy array to a state index, which is its bitmask
+    return cdg.knowledge_to_mask(knowledge)
 
 
 def i2k(ix, n_concepts):
     # converts a state index to a knowledge numpy array
-    knowledge = np.zeros((n_concepts,))
-    for i in xrange(n_concepts):
-        knowledge[i] = ix % 2
-        ix //= 2
-    return knowledge
+    return cdg.mask_to_knowledge(ix, n_concepts)
 
 
 def argmaxlist(xs):
@@ -28,20 +21,15 @@ def argmaxlist(xs):
     return [i for i in xrange(len(xs)) if xs[i] == m]
 
 
-def compute_optimal_actions(concept_tree, knowledge):
+def compute_optimal_actions(concept_tree, knowledge, frontier=None):
     """
     Compute a list of optimal actions (concepts) for the current knowledge.
+    :param frontier: optional cdg.ConceptFrontier kept up to date with knowledge, saves rescanning the graph
     """
-    opt_acts = []
-    for i in xrange(concept_tree.n):
-        if not knowledge[i]:
-            # if student hasn't learned concept yet:
-            # check whether prereqs are fulfilled
-            concepts = np.zeros((concept_tree.n,))
-            concepts[i] = 1
-            if dg.fulfilled_prereqs(concept_tree, knowledge, concepts):
-                # this is one optimal action
-                opt_acts.append(i)
+    if frontier is None:
+        opt_acts = list(cdg.iter_mask_bits(concept_tree.learnable_mask(k2i(knowledge))))
+    else:
+        opt_acts = frontier.sorted_concepts()
     if not opt_acts:
         # if no optimal actions, then it means everything is already learned
         # so all actions are optimal
@@ -54,6 +42,8 @@ def expected_reward(data):
     :param data: output from generate_data
     :return: the sample mean of the posttest reward
     '''
+    if isinstance(data, TrajectoryDataset):
+        return float(np.mean(data.final_knowledge()))
     avg = 0.0
     for i in six.moves.range(len(data)):
         avg += np.mean(data[i][-1][2])
@@ -65,6 +55,8 @@ def percent_complete(data):
     :param data: output from generate_data
     :return: the percentage of trajectories with perfect posttest
     '''
+    if isinstance(data, TrajectoryDataset):
+        return float(np.mean(np.all(data.final_knowledge(), axis=1)))
     count = 0.0
     for i in six.moves.range(len(data)):
         if int(np.sum(data[i][-1][2])) == data[i][-1][2].shape[0]:
@@ -77,6 +69,19 @@ def sanitize_probs(n_concepts, probs):
         probs[0] = 1.0
     return probs
 
+def sample_observations_batch(sims):
+    '''
+    Calls sample_observations on a list of simulators of the same kind. Simulators that define a
+    sample_observations_batch staticmethod answer all the histories at once with one model query.
+    :return: list of the results of sample_observations, in the order of sims
+    '''
+    if not sims:
+        return []
+    batch_fn = getattr(type(sims[0]), 'sample_observations_batch', None)
+    if batch_fn is None:
+        return [sim.sample_observations() for sim in sims]
+    return batch_fn(sims)
+
 ############ converting histories to indices ##############################
 
 def num_histories(index_base, horizon):
@@ -96,3 +101,11 @@ def history_ix_append(n_concepts, history_ix, next_branch):
     History is encoded where the last tuple is the least significant digit.
     '''
     return history_ix * n_concepts * 2 + next_branch
+
+def history_key_append(n_concepts, history_key, next_branch):
+    '''
+    Compact cache key of a history: like history_ix_append but with digits 1..2*n_concepts,
+    so histories of different lengths get different keys. The empty history has key 0, and
+    history_key % (2*n_concepts+1)**k is the key of the last k steps.
+    '''
+    return history_key * (n_concepts * 2 + 1) + next_branch + 1
@@ -0,0 +1,366 @@
+# inference_server.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Local inference server for the DKT models, shared by many planning workers.
+# The model lives in one server process. Clients (one per worker process) send
+# predict and step requests over a local socket (multiprocessing.connection),
+# the server gathers the requests that arrive within a small latency window,
+# answers them with one forward pass and sends every client its rows back.
+# Unlike DMCManager, where every predict is its own round trip through the
+# model, concurrent queries of many workers are batched together, and the
+# workers don't each load a copy of the model.
+# The server keeps throughput and queueing latency metrics.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from inference_server import InferenceServer, load_dynamics_model
+#   server = InferenceServer(load_dynamics_model, (model_id, checkpoint, timesteps))
+#   server.start()
+#   model = server.client()  # predict/step/get_timesteps like a DynamicsModel, picklable
+#   dkt = ssim.RnnStudentSim(model)
+#   ...
+#   six.print_(server.client().metrics())
+#   server.shutdown()
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import six
+from six.moves import queue
+
+import dataset_utils as d_utils
+
+DEFAULT_AUTHKEY = b'dkt-inference'
+
+
+def load_dynamics_model(model_id, checkpoint=None, timesteps=1, backend='tf'):
+    '''
+    Model factory for the server process.
+    :param checkpoint: checkpoint to load, or None for the latest checkpoint of model_id
+    :param backend: 'tf' for a DynamicsModel, 'numpy' for a numpy_dynamics_model.NumpyDynamicsModel
+    '''
+    if backend == 'numpy':
+        from numpy_dynamics_model import NumpyDynamicsModel
+        return NumpyDynamicsModel.from_checkpoint(model_id, checkpoint, timesteps=timesteps)
+    import dynamics_model_class as dmc
+    model = dmc.DynamicsModel(model_id=model_id, timesteps=timesteps, load_checkpoint=checkpoint is None)
+    if checkpoint is not None:
+        model.load(checkpoint)
+    return model
+
+
+class ServerMetrics(object):
+    '''
+    Counters of the server: requests and histories answered, forward passes and their time,
+    and how long requests waited in the queue before their batch started.
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.requests = 0
+        self.histories = 0
+        self.batches = 0
+        self.forward_time = 0.0
+        self.queue_latency_total = 0.0
+        self.queue_latency_max = 0.0
+
+    def record(self, received_times, n_histories, batch_start, forward_time):
+        latencies = [batch_start - t for t in received_times]
+        self.requests += len(received_times)
+        self.histories += n_histories
+        self.batches += 1
+        self.forward_time += forward_time
+        self.queue_latency_total += sum(latencies)
+        self.queue_latency_max = max([self.queue_latency_max] + latencies)
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'requests': self.requests,
+            'histories': self.histories,
+            'batches': self.batches,
+            'mean_batch_histories': self.histories / self.batches if self.batches else 0.0,
+            'histories_per_sec': self.histories / elapsed if elapsed > 0 else 0.0,
+            'mean_forward_ms': 1000.0 * self.forward_time / self.batches if self.batches else 0.0,
+            'mean_queue_latency_ms': 1000.0 * self.queue_latency_total / self.requests if self.requests else 0.0,
+            'max_queue_latency_ms': 1000.0 * self.queue_latency_max,
+        }
+
+
+def _predict_batch(model, inputs):
+    '''
+    Answers predict requests with one predict call: the histories are padded to the longest one,
+    which leaves the predictions of the shorter ones unchanged since the model is causal.
+    :param inputs: the input_data of every request
+    '''
+    n_rows = [x.shape[0] for x in inputs]
+    lengths = [x.shape[1] for x in inputs]
+    batch = np.zeros((sum(n_rows), max(lengths), inputs[0].shape[2]), dtype=np.float32)
+    row = 0
+    for x in inputs:
+        batch[row:row + x.shape[0], :x.shape[1], :] = x
+        row += x.shape[0]
+    preds = np.asarray(model.predict(batch))
+    results = []
+    row = 0
+    for n, t in six.moves.zip(n_rows, lengths):
+        results.append(preds[row:row + n, :min(t, preds.shape[1]), :])
+        row += n
+    return results
+
+
+def _step_batch(model, requests):
+    '''
+    Answers step requests with one step call on the concatenated inputs and hidden states.
+    :param requests: the (inputs, states) of every request
+    '''
+    n_rows = [inputs.shape[0] for inputs, states in requests]
+    inputs = np.concatenate([inputs for inputs, states in requests], axis=0)
+    states = [np.concatenate(parts, axis=0) for parts in six.moves.zip(*[states for _, states in requests])]
+    preds, states = model.step(inputs, states)
+    results = []
+    row = 0
+    for n in n_rows:
+        results.append((preds[row:row + n], [state[row:row + n] for state in states]))
+        row += n
+    return results
+
+
+def _request_error(msg):
+    '''
+    :return: why msg is not a valid request, None if it is
+    '''
+    if not (isinstance(msg, tuple) and len(msg) == 2):
+        return 'Malformed request {!r}'.format(msg)
+    kind, args = msg
+    if kind == 'predict':
+        if not (isinstance(args, np.ndarray) and args.ndim == 3):
+            return 'predict expects an array of shape (n_samples, n_timesteps, n_inputdim)'
+    elif kind == 'step':
+        if not (isinstance(args, tuple) and len(args) == 2 and isinstance(args[0], np.ndarray) and args[0].ndim == 2
+                and isinstance(args[1], (list, tuple))
+                and all(isinstance(state, np.ndarray) and state.shape[:1] == args[0].shape[:1] for state in args[1])):
+            return 'step expects (inputs of shape (n_samples, n_inputdim), list of states with n_samples rows)'
+    elif kind not in ('info', 'metrics', 'shutdown'):
+        return 'Unknown request {!r}'.format(kind)
+    return None
+
+
+def _n_histories(kind, args):
+    return (args if kind == 'predict' else args[0]).shape[0]
+
+
+def _serve(model_fn, model_args, batch_window, max_requests, authkey, address_conn):
+    try:
+        model = model_fn(*model_args)
+    except Exception as e:
+        address_conn.send(e)
+        raise
+    listener = Listener(authkey=authkey)
+    info = {
+        'timesteps': model.get_timesteps(),
+        'n_outputdim': model.model_dict['n_outputdim'],
+        'state_shapes': [state.shape[1:] for state in model.initial_states(1)],
+    }
+    address_conn.send(listener.address)
+    address_conn.close()
+
+    requests = queue.Queue()
+    # every client waits for its answer, so once all the connected clients sent a request there is no point waiting
+    n_clients = [0]
+    clients_lock = threading.Lock()
+
+    def read(conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError):
+                conn.close()
+                with clients_lock:
+                    n_clients[0] -= 1
+                return
+            error = _request_error(msg)
+            if error is not None:
+                # answered with the error by the main loop
+                msg = (None, error)
+            requests.put((time.time(), conn, msg))
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, IOError):
+                return
+            with clients_lock:
+                n_clients[0] += 1
+            reader = threading.Thread(target=read, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    acceptor = threading.Thread(target=accept)
+    acceptor.daemon = True
+    acceptor.start()
+
+    metrics = ServerMetrics()
+    while True:
+        batch = [requests.get()]
+        deadline = time.time() + batch_window
+        while len(batch) < min(max_requests, n_clients[0]):
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        shutdown = False
+        for kind, batch_fn in (('predict', _predict_batch), ('step', _step_batch)):
+            group = [(received, conn, msg[1]) for received, conn, msg in batch if msg[0] == kind]
+            if not group:
+                continue
+            batch_start = time.time()
+            try:
+                results = batch_fn(model, [args for _, _, args in group])
+                n_histories = sum(_n_histories(kind, args) for _, _, args in group)
+                metrics.record([received for received, _, _ in group], n_histories, batch_start, time.time() - batch_start)
+            except Exception:
+                # answer the requests one at a time, so that only a bad one gets an error
+                results = []
+                for received, _, args in group:
+                    request_start = time.time()
+                    try:
+                        results.extend(batch_fn(model, [args]))
+                        metrics.record([received], _n_histories(kind, args), request_start, time.time() - request_start)
+                    except Exception as e:
+                        results.append(e)
+            for (_, conn, _), result in six.moves.zip(group, results):
+                conn.send(result)
+        for received, conn, msg in batch:
+            if msg[0] == 'info':
+                conn.send(info)
+            elif msg[0] == 'metrics':
+                conn.send(metrics.summary())
+            elif msg[0] == 'shutdown':
+                conn.send(metrics.summary())
+                shutdown = True
+            elif msg[0] is None:
+                # the client waits for an answer
+                conn.send(ValueError(msg[1]))
+        if shutdown:
+            listener.close()
+            return
+
+
+class InferenceServer(object):
+    '''
+    Runs a model in a separate process and serves batched predict/step requests to InferenceClients.
+    '''
+
+    def __init__(self, model_fn, model_args=(), batch_window=0.002, max_requests=1024, authkey=DEFAULT_AUTHKEY):
+        '''
+        :param model_fn: picklable function creating the model in the server process, e.g. load_dynamics_model
+        :param model_args: the arguments of model_fn
+        :param batch_window: seconds to wait for more requests after the first one of a batch
+        :param max_requests: the maximal number of requests answered by one forward pass
+        '''
+        self.model_fn = model_fn
+        self.model_args = model_args
+        self.batch_window = batch_window
+        self.max_requests = max_requests
+        self.authkey = authkey
+        self.address = None
+        self._process = None
+
+    def start(self):
+        parent_conn, child_conn = mp.Pipe()
+        self._process = mp.Process(target=_serve, args=(self.model_fn, self.model_args, self.batch_window,
+                                                         self.max_requests, self.authkey, child_conn))
+        self._process.daemon = True
+        self._process.start()
+        address = parent_conn.recv()
+        if isinstance(address, Exception):
+            self._process.join()
+            raise address
+        self.address = address
+        return self
+
+    def client(self):
+        return InferenceClient(self.address, self.authkey)
+
+    def shutdown(self):
+        '''
+        Stops the server.
+        :return: the final metrics
+        '''
+        metrics = self.client()._call(('shutdown', None))
+        self._process.join()
+        return metrics
+
+
+class InferenceClient(object):
+    '''
+    DynamicsModel-like handle on an InferenceServer. Pickling it only keeps the address, so it can be
+    passed to worker processes, which connect on first use. Not thread safe: use one client per thread.
+    '''
+
+    def __init__(self, address, authkey=DEFAULT_AUTHKEY):
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._info = None
+
+    def __getstate__(self):
+        return {'address': self.address, 'authkey': self.authkey}
+
+    def __setstate__(self, state):
+        self.__init__(state['address'], state['authkey'])
+
+    def _call(self, msg):
+        if self._conn is None:
+            self._conn = Client(self.address, authkey=self.authkey)
+        self._conn.send(msg)
+        result = self._conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _get_info(self):
+        if self._info is None:
+            self._info = self._call(('info', None))
+        return self._info
+
+    def predict(self, input_data=None, actions=None, outcomes=None):
+        '''
+        Same as DynamicsModel.predict, answered by the server.
+        '''
+        if input_data is None:
+            input_data = d_utils.encode_observations(actions, outcomes, self._get_info()['n_outputdim'], dtype=np.float32)
+        return self._call(('predict', np.asarray(input_data, dtype=np.float32)))
+
+    def step(self, inputs, states=None):
+        '''
+        Same as DynamicsModel.step, answered by the server.
+        '''
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if states is None:
+            states = self.initial_states(inputs.shape[0])
+        return self._call(('step', (inputs, states)))
+
+    def initial_states(self, n_samples):
+        return [np.zeros((n_samples,) + tuple(shape), dtype=np.float32) for shape in self._get_info()['state_shapes']]
+
+    def get_timesteps(self):
+        return self._get_info()['timesteps']
+
+    def metrics(self):
+        '''
+        :return: dict of the server metrics, see ServerMetrics.summary
+        '''
+        return self._call(('metrics', None))
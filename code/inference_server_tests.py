@@ -0,0 +1,107 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests that the inference server answers concurrent clients like the model itself.
+#===============================================================================
+# USAGE: python inference_server_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+import numpy as np
+import six
+from joblib import Parallel, delayed
+
+import dataset_utils as d_utils
+from inference_server import InferenceServer
+from random_dynamics_model import MODEL_DICT, TIMESTEPS, make_random_model
+
+
+def _random_inputs(seed, n_samples, n_timesteps):
+    rng = np.random.RandomState(seed)
+    n_concepts = MODEL_DICT['n_outputdim']
+    actions = rng.randint(n_concepts, size=(n_samples, n_timesteps))
+    outcomes = rng.randint(2, size=(n_samples, n_timesteps))
+    return d_utils.encode_observations(actions, outcomes, n_concepts, dtype=np.float32)
+
+
+def _client_job(client, seed, n_queries):
+    model = make_random_model()
+    # plain range: cloudpickle cannot ship six.moves to the workers when this runs as __main__
+    for i in range(n_queries):
+        input_data = _random_inputs(seed * n_queries + i, 1 + i % 3, 1 + (seed + i) % (TIMESTEPS + 2))
+        assert np.allclose(client.predict(input_data), model.predict(input_data), atol=1e-6)
+        pred, states = client.step(input_data[:, 0, :])
+        expected_pred, expected_states = model.step(input_data[:, 0, :])
+        assert np.allclose(pred, expected_pred, atol=1e-6)
+    return n_queries
+
+
+def test_concurrent_clients(n_jobs=4, n_queries=50):
+    server = InferenceServer(make_random_model, batch_window=0.005).start()
+    try:
+        client = server.client()
+        assert client.get_timesteps() == TIMESTEPS
+        done = Parallel(n_jobs=n_jobs)(delayed(_client_job)(server.client(), seed, n_queries) for seed in six.moves.range(n_jobs))
+        assert sum(done) == n_jobs * n_queries
+        metrics = client.metrics()
+        assert metrics['requests'] == 2 * n_jobs * n_queries
+        # concurrent requests got batched together
+        assert metrics['batches'] < metrics['requests']
+    finally:
+        metrics = server.shutdown()
+    six.print_('Server metrics: {}'.format(metrics))
+
+
+def test_model_errors_reach_the_client():
+    # a long window, so that the good and the bad request are answered by the same batch
+    server = InferenceServer(make_random_model, batch_window=0.5).start()
+    try:
+        good, bad = server.client(), server.client()
+        good.get_timesteps()
+        bad.get_timesteps()
+        input_data = _random_inputs(1, 3, 4)
+        answers = {}
+
+        def query(name, client, data):
+            try:
+                answers[name] = client.predict(data)
+            except Exception as e:
+                answers[name] = e
+        # wrong input dimension
+        threads = [threading.Thread(target=query, args=('bad', bad, np.zeros((1, 2, 3), dtype=np.float32))),
+                   threading.Thread(target=query, args=('good', good, input_data))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert isinstance(answers['bad'], AssertionError) and "input dimension" in str(answers['bad'])
+        # only the bad request failed
+        assert np.allclose(answers['good'], make_random_model().predict(input_data), atol=1e-6)
+    finally:
+        server.shutdown()
+
+
+def test_bad_requests_get_an_error():
+    server = InferenceServer(make_random_model).start()
+    try:
+        client = server.client()
+        for msg in (('train', None), 'predict', ('predict', None), ('step', np.zeros((1, 8))),
+                    ('step', (np.zeros((1, 8)), [np.zeros((2, 5))]))):
+            try:
+                client._call(msg)
+                assert False, "expected an error"
+            except ValueError:
+                pass
+        # the server still answers
+        assert client.get_timesteps() == TIMESTEPS
+        input_data = _random_inputs(0, 2, 3)
+        assert np.allclose(client.predict(input_data), make_random_model().predict(input_data), atol=1e-6)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    test_concurrent_clients()
+    test_model_errors_reach_the_client()
+    test_bad_requests_get_an_error()
+    six.print_('All tests passed.')
@@ -8,6 +8,7 @@
 # CURRENT STATUS: Needs to be updated with the new Student with separate dependency graph.
 #===============================================================================
 
+import six
 import numpy as np
 import scipy as sp
 
@@ -15,6 +16,7 @@ from mctslib.graph import *
 from mctslib.mcts import *
 
 import student as st
+from concept_dependency_graph import count_mask_bits
 
 from helpers import * # helper functions
 
@@ -73,14 +75,16 @@ class StudentExactState(object):
     
     def reward(self):
         # for now, just use the model knowledge state for a full posttest at the end
+        # the knowledge bitmask gives the posttest without touching the array view
+        kmask = self.model.student.kmask
         if self.r_type == DENSE:
-            return np.sum(self.model.student.knowledge)
+            return count_mask_bits(kmask)
         elif self.step > self.horizon:
             if self.r_type == SEMISPARSE:
-                return np.sum(self.model.student.knowledge)
+                return count_mask_bits(kmask)
             else:
                 # SPARSE
-                return np.prod(self.model.student.knowledge)
+                return 1 if kmask == (1 << self.n_concepts) - 1 else 0
         else:
             return 0
     
@@ -88,13 +92,12 @@ class StudentExactState(object):
         return self.step > self.horizon
     
     def __eq__(self, other):
-        val = tuple(self.model.student.knowledge)
-        oval = tuple(other.model.student.knowledge)
-        return val == oval
+        return self.model.student.kmask == other.model.student.kmask
     
     def __hash__(self):
         # because this is only used for storing a dictionary of immediate children, we can use whatever
-        return k2i(self.model.student.knowledge)
+        # the knowledge bitmask is the state index already
+        return self.model.student.kmask
     
     def __str__(self):
         return 'K: {}'.format(self.model.student.knowledge)
@@ -156,18 +159,18 @@ class DKTState(object):
     '''
     The belief state to be used in MCTS, implemented using a DKT.
     '''
-    def __init__(self, model, sim, step, horizon, r_type, dktcache, use_real, new_act=None, new_ob=None, histhash=''):
+    def __init__(self, model, sim, step, horizon, r_type, dktcache, use_real, new_act=None, new_ob=None, histhash=0):
         '''
         :param model: RnnStudentSim object
         :param sim: StudentExactSim object
         :param step: int, current step
         :param horizon: int, horizon
         :param r_type: an r_type
-        :param dktcache: a dictionary used for caching the Rnn predictions or None to disable it
+        :param dktcache: a prediction_cache.PredictionCache used for caching the Rnn predictions or None to disable it
         :param use_real: use the sim as the real world, otherwise use model
         :param new_act: immediate action that led to this state
         :param new_ob: immediate observation that led to this state
-        :param histhash: str rep of the current history used for dktcache
+        :param histhash: compact key of the current history used for dktcache, see history_key_append
         '''
         # the model will be passed down when doing real world perform
         self.belief = model
@@ -198,7 +201,7 @@ class DKTState(object):
             self.actions.append(st.StudentAction(i, concepts))
     
     def _next_histhash(self, new_act, new_ob):
-        return self.histhash + '{}{};'.format(new_act, new_ob)
+        return history_key_append(self.n_concepts, self.histhash, action_ob_encode(self.n_concepts, int(new_act), new_ob))
     
     def get_probs(self):
         # computes and caches the probs for the current state
@@ -214,12 +217,35 @@ class DKTState(object):
                 if trycache is None:
                     trycache = np.array([0.0] * self.sim.dgraph.n)
                     trycache[0] = 1.0
-            # cache back if needed
-            if self.dktcache is not None:
-                self.dktcache[self.histhash] = trycache
+                # cache back if needed
+                if self.dktcache is not None:
+                    self.dktcache.put(self.histhash, trycache)
             # cache at this state as well
             self._probs = trycache
         return self._probs
+
+    @staticmethod
+    def get_probs_batch(states):
+        '''
+        get_probs for many states at once: the states that are not cached yet query their
+        models in one batch.
+        :return: list of probs in the order of states
+        '''
+        misses = []
+        for state in states:
+            if state._probs is None and state.dktcache is not None:
+                state._probs = state.dktcache.get(state.histhash, None)
+            if state._probs is None:
+                misses.append(state)
+        preds = sample_observations_batch([state.belief for state in misses])
+        for state, pred in six.moves.zip(misses, preds):
+            if pred is None:
+                pred = np.array([0.0] * state.sim.dgraph.n)
+                pred[0] = 1.0
+            state._probs = pred
+            if state.dktcache is not None:
+                state.dktcache.put(state.histhash, pred)
+        return [state._probs for state in states]
     
     def perform(self, action):
         '''
@@ -316,19 +342,23 @@ class DKTGreedyPolicy(object):
             probs = [0] * self.sim.dgraph.n
             probs[0] = 1
         
+        # the models after every action and observation, queried in one batch
+        new_models = []
         for a in xrange(self.n_concepts):
-            avg_reward = 0.0
             # action
             conceptvec = np.zeros((self.n_concepts,))
             conceptvec[a] = 1.0
             action = st.StudentAction(a, conceptvec)
+            for ob in (1, 0):
+                new_model = self.model.copy()
+                new_model.advance_simulator(action, ob)
+                new_models.append(new_model)
+        new_probs = sample_observations_batch(new_models)
+
+        for a in xrange(self.n_concepts):
             # for each observation, weight reward with probability of seeing observation
-            new_model = self.model.copy()
-            new_model.advance_simulator(action, 1)
-            avg_reward += probs[a] * np.sum(new_model.sample_observations())
-            new_model = self.model.copy()
-            new_model.advance_simulator(action, 0)
-            avg_reward += (1.0-probs[a]) * np.sum(new_model.sample_observations())
+            avg_reward = probs[a] * np.sum(new_probs[2*a])
+            avg_reward += (1.0-probs[a]) * np.sum(new_probs[2*a+1])
             # append next reward
             next_rewards.append(avg_reward)
         return argmaxlist(next_rewards)[0]
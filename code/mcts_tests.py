@@ -54,6 +54,11 @@ from mcts import \
     StudentExactState, \
     DENSE,SEMISPARSE,SPARSE
 
+from prediction_cache import PredictionCache, PredictionCacheManager
+from inference_server import InferenceServer, load_dynamics_model
+
+# memory limit of the caches of DKT predictions shared across MCTS trials
+DKT_CACHE_MAX_BYTES = 256 * 2**20
 
 
 def debug_visiter(node, data):
@@ -77,7 +82,7 @@ def test_student_exact_single(dgraph, stud, horizon, n_rollouts, r_type):
     # create the model and simulators
     student = stud.copy()
     student.reset()
-    student.knowledge[0] = 1 # initialize the first concept to be known
+    student.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(student, dgraph)
     model = sim.copy()
 
@@ -96,7 +101,7 @@ def test_student_exact_single(dgraph, stud, horizon, n_rollouts, r_type):
         # debug check for whether action is optimal
 
         if False:
-            opt_acts = compute_optimal_actions(sim.dgraph, sim.get_knowledge())
+            opt_acts = compute_optimal_actions(sim.dgraph, sim.get_knowledge(), frontier=sim.frontier)
             is_opt = best_action.concept in opt_acts  # check if predicted action is optimal
 
             if not is_opt:
@@ -167,7 +172,7 @@ def test_student_exact():
 def test_dkt_single(dgraph, sim, horizon, n_rollouts, model_list, r_type, use_mem, dktcache, use_real):
     '''
     Performs a single trajectory with MCTS and returns the final true student knowledge.
-    :param dktcache: a dictionary to use for the dkt cache
+    :param dktcache: a PredictionCache to use for the dkt cache
     '''
     n_concepts = dgraph.n
 
@@ -175,7 +180,8 @@ def test_dkt_single(dgraph, sim, horizon, n_rollouts, model_list, r_type, use_me
     if not use_mem:
         model = dmc.RnnStudentSimEnsemble(model_list)
     else:
-        model = dmc.RnnStudentSimMemEnsemble(n_concepts, model_list)
+        # the memo simulator at the empty history
+        model = model_list[0].copy()
 
     #rollout_policy = default_policies.immediate_reward
     rollout_policy = default_policies.RandomKStepRollOut(horizon+1)
@@ -203,31 +209,32 @@ def test_dkt_single(dgraph, sim, horizon, n_rollouts, model_list, r_type, use_me
         #print('Next state: {}'.format(str(new_root.state)))
     return sim.get_knowledge(), best_q_value
 
-def test_dkt_chunk(n_trajectories, dgraph, s, model_id, checkpoints, horizon, n_rollouts, r_type, dktcache=None, use_real=True, use_mem=False):
+def test_dkt_chunk(n_trajectories, dgraph, s, model_id, checkpoints, horizon, n_rollouts, r_type, dktcache=None, use_real=True, use_mem=False, models=None):
     '''
     Runs a bunch of trajectories and returns the avg posttest score.
     For parallelization to run in a separate thread/process.
     Gets a list of checkpoints which means might use ensemble
+    :param models: list of models to use instead of loading the checkpoints, e.g. InferenceClients
     '''
     # load the model
     # add 2 to the horizon since MCTS might look at horizon+1 steps
     model_list = []
-    if checkpoints:
+    if models:
+        model_list = list(models)
+    elif checkpoints and use_mem:
+        # memoized functions, dense or sparse
+        model_list.append(dmc.load_mem_student_sim(dgraph.n, checkpoints, horizon+2))
+    elif checkpoints:
         for chkpt in checkpoints:
-            # either actual checkpoints, or memoized functions
-            if not use_mem:
-                model = dmc.DynamicsModel(model_id=model_id, timesteps=horizon+2, load_checkpoint=False)
-                model.load(chkpt)
-                model_list.append(model)
-            else:
-                mem_arrays = np.load(chkpt)['mem_arrays']
-                model_list.append(mem_arrays)
+            model = dmc.DynamicsModel(model_id=model_id, timesteps=horizon+2, load_checkpoint=False)
+            model.load(chkpt)
+            model_list.append(model)
     else:
         # empty list
         model_list.append(dmc.DynamicsModel(model_id=model_id, timesteps=horizon+2, load_checkpoint=True))
     # initialize the shared dktcache across MCTS trials
     if dktcache is None and not use_mem:
-        dktcache = dict()
+        dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
     
     acc = 0.0
     best_q = 0.0
@@ -243,10 +250,12 @@ def test_dkt_chunk(n_trajectories, dgraph, s, model_id, checkpoints, horizon, n_
         best_q += best_q_value
     return acc, best_q
 
-def test_dkt(model_id, n_concepts, transition_after, horizon, n_rollouts, n_trajectories, r_type, use_real, use_mem, checkpoints=[]):
+def test_dkt(model_id, n_concepts, transition_after, horizon, n_rollouts, n_trajectories, r_type, use_real, use_mem, checkpoints=[], use_server=False):
     '''
     Test DKT+MCTS
     Can accept a number of checkpoints, meaning to use an ensemble if more than one.
+    :param use_server: serve each checkpoint from one InferenceServer shared by all the jobs,
+    instead of loading the models in every job
     '''
     import concept_dependency_graph as cdg
     from simple_mdp import create_custom_dependency
@@ -265,26 +274,36 @@ def test_dkt(model_id, n_concepts, transition_after, horizon, n_rollouts, n_traj
     test_student = student2
     
     test_student.reset()
-    test_student.knowledge[0] = 1 # initialize the first concept to be known
+    test_student.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(test_student.copy(), dgraph)
     
     # create a shared dktcache across all processes
-    dktcache_manager = mp.Manager()
-    dktcache = dktcache_manager.dict()
+    dktcache_manager = PredictionCacheManager()
+    dktcache_manager.start()
+    dktcache = dktcache_manager.PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
 
     print('Testing model: {}'.format(model_id))
     print('horizon: {}'.format(horizon))
     print('rollouts: {}'.format(n_rollouts))
 
-    accs = np.array(Parallel(n_jobs=n_jobs)(delayed(test_dkt_chunk)(traj_per_job, dgraph, sim, model_id, checkpoints, horizon, n_rollouts, r_type, dktcache=dktcache, use_real=use_real, use_mem=use_mem) for _ in range(n_jobs)))
+    servers = []
+    if use_server and not use_mem:
+        # add 2 to the horizon since MCTS might look at horizon+1 steps
+        for chkpt in (checkpoints or [None]):
+            servers.append(InferenceServer(load_dynamics_model, (model_id, chkpt, horizon+2)).start())
+
+    accs = np.array(Parallel(n_jobs=n_jobs)(delayed(test_dkt_chunk)(traj_per_job, dgraph, sim, model_id, checkpoints, horizon, n_rollouts, r_type, dktcache=dktcache, use_real=use_real, use_mem=use_mem, models=[server.client() for server in servers]) for _ in range(n_jobs)))
     results = np.sum(accs,axis=0) / (n_jobs * traj_per_job)
     avg_acc, avg_best_q = results[0], results[1]
 
+    for server in servers:
+        print('Inference server: {}'.format(server.shutdown()))
 
     test_data = dg.generate_data(dgraph, student=test_student, n_students=1000, seqlen=horizon, policy='expert', filename=None, verbose=False)
     print('Average posttest true: {}'.format(expected_reward(test_data)))
     print('Average posttest mcts: {}'.format(avg_acc))
     print('Average best q: {}'.format(avg_best_q))
+    print('DKT cache: {}'.format(dktcache.stats()))
     return avg_acc, avg_best_q
 
 def test_dkt_rme(model_id, n_rollouts, n_trajectories, r_type, dmcmodel, chkpt):
@@ -307,11 +326,12 @@ def test_dkt_rme(model_id, n_rollouts, n_trajectories, r_type, dmcmodel, chkpt):
     dgraph.init_default_tree(n_concepts)
     
     # create a shared dktcache across all processes
-    dktcache_manager = mp.Manager()
+    dktcache_manager = PredictionCacheManager()
+    dktcache_manager.start()
     # for the MCTS model
-    dktcache = dktcache_manager.dict()
+    dktcache = dktcache_manager.PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
     # for the real environment 
-    dktsimcache = dktcache_manager.dict()
+    dktsimcache = dktcache_manager.PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
     
     # create the simulator
     dktsim = st.StudentDKTSim(dgraph, dmcmodel, dktsimcache)
@@ -326,6 +346,7 @@ def test_dkt_rme(model_id, n_rollouts, n_trajectories, r_type, dmcmodel, chkpt):
 
     print('Average posttest mcts: {}'.format(avg_acc))
     print('Average best q: {}'.format(avg_best_q))
+    print('DKT cache: {}'.format(dktcache.stats()))
     return avg_acc, avg_best_q
 
 def test_dkt_qval(model_id, n_concepts, transition_after, horizon, n_rollouts, r_type, chkpt=None):
@@ -353,7 +374,7 @@ def test_dkt_qval(model_id, n_concepts, transition_after, horizon, n_rollouts, r
     else:
         model = dmc.DynamicsModel(model_id=model_id, timesteps=horizon, load_checkpoint=True)
     # initialize the dktcache to speed up DKT queries
-    dktcache = dict()
+    dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
 
     print('Testing model qval: {}'.format(model_id))
     print('horizon: {}'.format(horizon))
@@ -362,7 +383,7 @@ def test_dkt_qval(model_id, n_concepts, transition_after, horizon, n_rollouts, r
     # create the model and simulators
     stu = test_student.copy()
     stu.reset()
-    stu.knowledge[0] = 1 # initialize the first concept to be known
+    stu.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(stu, dgraph)
 
     # make the model
@@ -380,6 +401,7 @@ def test_dkt_qval(model_id, n_concepts, transition_after, horizon, n_rollouts, r
     qval = root.q
     
     six.print_('Initial qval: {}'.format(qval))
+    six.print_('DKT cache: {}'.format(dktcache.stats()))
 
     return qval
 
@@ -409,7 +431,7 @@ def test_dkt_extract_policy(model_id, n_concepts, transition_after, horizon, n_r
     else:
         model = dmc.DynamicsModel(model_id=model_id, timesteps=horizon, load_checkpoint=True)
     # initialize the dktcache to speed up DKT queries
-    dktcache = dict()
+    dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
 
     print('Extracting policy from model: {}'.format(model_id))
     print('horizon: {}'.format(horizon))
@@ -418,7 +440,7 @@ def test_dkt_extract_policy(model_id, n_concepts, transition_after, horizon, n_r
     # create the model and simulators
     stu = test_student.copy()
     stu.reset()
-    stu.knowledge[0] = 1 # initialize the first concept to be known
+    stu.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(stu, dgraph)
 
     # make the model
@@ -470,7 +492,7 @@ def test_dkt_multistep(model_id, dataset, chkpt=None):
     test_student = student2
     stu = test_student.copy()
     stu.reset()
-    stu.knowledge[0] = 1 # initialize the first concept to be known
+    stu.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(stu, dgraph)
     
     # load the model
@@ -480,7 +502,7 @@ def test_dkt_multistep(model_id, dataset, chkpt=None):
     else:
         model = dmc.DynamicsModel(model_id=model_id, timesteps=horizon, load_checkpoint=True)
     # initialize the dktcache to speed up DKT queries
-    dktcache = dict()
+    dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
 
     print('Testing model multstep: {}'.format(model_id))
 
@@ -488,31 +510,36 @@ def test_dkt_multistep(model_id, dataset, chkpt=None):
     dktmodel = dmc.RnnStudentSim(model)
     
     # accumulate error
-    mse_acc = 0.0
-    for i in six.moves.range(len(dataset)):
-        curr_mse = 0.0
-        curr_traj = dataset[i]
-        curr_state = DKTState(dktmodel, sim, 1, horizon, SPARSE, dktcache, False)
-        for t in six.moves.range(horizon-1):
+    # all the trajectories are advanced together so that the DKT is queried once per step for all of them
+    curr_states = [DKTState(dktmodel, sim, 1, horizon, SPARSE, dktcache, False) for _ in six.moves.range(len(dataset))]
+    curr_mses = [0.0] * len(dataset)
+    for t in six.moves.range(horizon-1):
+        next_concepts = []
+        next_obs = []
+        for i in six.moves.range(len(dataset)):
             # advance the DKT, then compare prediction with the data, up to the last prediction
+            curr_traj = dataset[i]
             curr_conceptvec = curr_traj[t][0]
             curr_concept = np.nonzero(curr_conceptvec)[0]
             curr_ob = int(curr_traj[t][1])
             
             next_conceptvec = curr_traj[t+1][0]
-            next_concept = np.nonzero(next_conceptvec)[0]
-            next_ob = int(curr_traj[t+1][1])
+            next_concepts.append(np.nonzero(next_conceptvec)[0])
+            next_obs.append(int(curr_traj[t+1][1]))
             
             # advance the DKT
-            curr_state = curr_state.perform(st.StudentAction(curr_concept,curr_conceptvec))
-            next_probs = curr_state.get_probs()
-            
+            curr_states[i] = curr_states[i].perform(st.StudentAction(curr_concept,curr_conceptvec))
+        all_next_probs = DKTState.get_probs_batch(curr_states)
+        
+        for i in six.moves.range(len(dataset)):
             # compute and accumulate the mse
-            diff = next_probs[next_concept] - next_ob
-            curr_mse += diff * diff
+            diff = all_next_probs[i][next_concepts[i]] - next_obs[i]
+            curr_mses[i] += diff * diff
             
             #debugging
-            #six.print_('traj {} step {} actvec {} act {} ob {} next probs {} diff {}'.format(i,t,curr_conceptvec,curr_concept,curr_ob,next_probs,diff))
+            #six.print_('traj {} step {} next probs {} diff {}'.format(i,t,all_next_probs[i],diff))
+    mse_acc = 0.0
+    for curr_mse in curr_mses:
         # average mse per step
         mse_acc += curr_mse / (horizon - 1)
         
@@ -538,11 +565,11 @@ def dkt_test_policy(model_id, horizon, n_trajectories, r_type, chkpt):
     # create the model and simulators
     student = student2.copy()
     student.reset()
-    student.knowledge[0] = 1 # initialize the first concept to be known
+    student.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(student, dgraph)
     
     # initialize the shared dktcache across the trials
-    dktcache = dict()
+    dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
     
     reward_acc = 0.0
     
@@ -582,11 +609,11 @@ def dkt_test_policies_rme(model_id, n_trajectories, r_type, policies, chkpt):
     # create the model and simulators
     student = student2.copy()
     student.reset()
-    student.knowledge[0] = 1 # initialize the first concept to be known
+    student.learn(0) # initialize the first concept to be known
     sim = st.StudentExactSim(student, dgraph)
     
     # initialize the shared dktcache across the trials
-    dktcache = dict()
+    dktcache = PredictionCache(max_bytes=DKT_CACHE_MAX_BYTES)
     
     num_policies = policies.shape[0]
     rewards = np.zeros((num_policies,))
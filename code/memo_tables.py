@@ -0,0 +1,351 @@
+# memo_tables.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Storage of the memoized DKT predictions (see model_training.dkt_memoize_single).
+# Every history length is stored as its own .npy file next to the memo path,
+# and opened memory-mapped on first use. Workers using the same tables then
+# share the page cache instead of each loading every level of every ensemble
+# member. Memo files written as one npz object array are still read.
+# The probabilities can be stored quantized, as float16 or as uint8/uint16
+# fixed point in [0,1], and are dequantized when looked up.
+# A fixed ensemble can be collapsed into precomputed mean (and variance, min,
+# max) tables, so that querying it costs the same as querying one model.
+# Sparse memo tables only hold some histories of every length (see
+# memoize.dkt_memoize_sparse), as sorted history indices and their rows,
+# together with the model they were memoized from, which answers the other
+# histories (see student_sim.load_mem_student_sim).
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from memo_tables import save_mem_arrays, load_mem_arrays
+#   save_mem_arrays(mem_path, mem_arrays, dtype='uint16')
+#   dkt = ssim.RnnStudentSimMemEnsemble(n_concepts, [load_mem_arrays(path) for path in mem_paths])
+#   save_ensemble_mem_arrays(ensemble_path, [load_mem_arrays(path) for path in mem_paths], stats=('mean', 'var'))
+#   dkt = ssim.RnnStudentSimMemEnsemble(n_concepts, [load_mem_arrays(ensemble_stat_path(ensemble_path, 'mean'))])
+#   dkt = ssim.RnnStudentSimSparseMem(n_concepts, SparseMemArrays(sparse_path), ssim.RnnStudentSim(model))
+#   dkt = ssim.load_mem_student_sim(n_concepts, mem_paths, timesteps)  # dense or sparse
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+
+import numpy as np
+import six
+
+# storage types of the memo tables, from the most to the least precise
+MEM_DTYPES = ('float64', 'float32', 'float16', 'uint16', 'uint8')
+# statistics over the ensemble members that can be precomputed, see ensemble_mem_arrays
+ENSEMBLE_STATS = ('mean', 'var', 'min', 'max')
+
+
+def quantize_probs(probs, dtype):
+    '''
+    Converts probabilities to the storage type dtype. Unsigned integer types store round(p * max),
+    i.e. fixed point with a step of 1/255 for uint8 and 1/65535 for uint16.
+    '''
+    dtype = np.dtype(dtype)
+    # probs may already be quantized
+    probs = dequantize_probs(probs)
+    if dtype.kind == 'u':
+        scale = np.iinfo(dtype).max
+        return np.rint(np.clip(probs, 0.0, 1.0) * scale).astype(dtype)
+    return probs.astype(dtype)
+
+
+def dequantize_probs(probs):
+    '''
+    Inverse of quantize_probs, the scale is implied by the type of probs.
+    :return: float64 probabilities
+    '''
+    probs = np.asarray(probs)
+    if probs.dtype.kind == 'u':
+        return probs / float(np.iinfo(probs.dtype).max)
+    return probs.astype(np.float64)
+
+
+def quantize_mem_arrays(mem_arrays, dtype):
+    return [quantize_probs(level, dtype) for level in mem_arrays]
+
+
+def quantization_error(mem_arrays, dtype):
+    '''
+    :return: the maximal and mean absolute deviation of the probabilities stored as dtype, over all histories
+    '''
+    max_error = 0.0
+    total_error = 0.0
+    count = 0
+    for level in mem_arrays:
+        level = dequantize_probs(level)
+        error = np.abs(dequantize_probs(quantize_probs(level, dtype)) - level)
+        if error.size:
+            max_error = max(max_error, float(np.max(error)))
+            total_error += float(np.sum(error))
+            count += error.size
+    return max_error, total_error / count if count else 0.0
+
+
+def mem_level_path(path, step):
+    '''
+    :param path: the memo path, e.g. params.mem_pat formatted, with or without the .npz extension
+    :return: the path of the .npy file with the predictions of the histories of length step
+    '''
+    root, ext = os.path.splitext(path)
+    if ext != '.npz':
+        root = path
+    return '{}-level{}.npy'.format(root, step)
+
+
+def save_mem_arrays(path, mem_arrays, dtype=None):
+    '''
+    Writes every level of the memo arrays to its own .npy file.
+    :param mem_arrays: a list of memoization arrays per history length
+    :param dtype: one of MEM_DTYPES to store the probabilities quantized, None to keep the type of mem_arrays
+    '''
+    for step, level in enumerate(mem_arrays):
+        if dtype is not None:
+            level = quantize_probs(level, dtype)
+        np.save(mem_level_path(path, step), level)
+
+
+def has_mem_levels(path):
+    return os.path.exists(mem_level_path(path, 0))
+
+
+class MemArrays(object):
+    '''
+    List-like view of the memo arrays saved by save_mem_arrays: mem_arrays[step] is the table of the
+    histories of length step, loaded when first used, in its storage type (see dequantize_probs).
+    Pickling it only keeps the path, so worker processes map the files themselves.
+    '''
+
+    def __init__(self, path, mmap_mode='r'):
+        '''
+        :param mmap_mode: passed to np.load; use None to load the levels into memory
+        '''
+        self.path = path
+        self.mmap_mode = mmap_mode
+        n_levels = 0
+        while os.path.exists(mem_level_path(path, n_levels)):
+            n_levels += 1
+        if n_levels == 0:
+            raise IOError('No memo arrays at {}'.format(path))
+        self._levels = [None] * n_levels
+
+    def __getstate__(self):
+        return {'path': self.path, 'mmap_mode': self.mmap_mode}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['mmap_mode'])
+
+    def __len__(self):
+        return len(self._levels)
+
+    def __getitem__(self, step):
+        level = self._levels[step]
+        if level is None:
+            level = np.load(mem_level_path(self.path, step), mmap_mode=self.mmap_mode)
+            self._levels[step] = level
+        return level
+
+    def __iter__(self):
+        for step in six.moves.range(len(self)):
+            yield self[step]
+
+
+def load_mem_arrays(path, mmap_mode='r'):
+    '''
+    Opens the memo arrays of one model.
+    :param path: the memo path given to save_mem_arrays or save_sparse_mem_arrays, or an npz written
+        with np.savez(path, mem_arrays=...)
+    :return: MemArrays if the levels were saved separately, SparseMemArrays for sparse tables,
+        otherwise the list of arrays of the npz
+    '''
+    if has_mem_levels(path):
+        return MemArrays(path, mmap_mode=mmap_mode)
+    if has_sparse_mem_levels(path):
+        return SparseMemArrays(path, mmap_mode=mmap_mode)
+    with np.load(path, allow_pickle=True) as f:
+        return list(f['mem_arrays'])
+
+
+def ensemble_stat_path(path, stat):
+    '''
+    :param path: the memo path of the collapsed ensemble
+    :return: the memo path of the table of the statistic stat, one of ENSEMBLE_STATS
+    '''
+    root, ext = os.path.splitext(path)
+    if ext != '.npz':
+        root, ext = path, ''
+    return '{}-{}{}'.format(root, stat, ext)
+
+
+def ensemble_mem_arrays(mem_arrays_list, stats=('mean',)):
+    '''
+    Collapses the memo arrays of the ensemble members into tables of statistics over the members,
+    one level at a time so that only one level of one member is read at once.
+    :param mem_arrays_list: the memo arrays of every member, possibly quantized
+    :param stats: which of ENSEMBLE_STATS to compute, the variance is the population variance of the members
+    :return: dict from stat to a list of float64 tables per history length
+    '''
+    for stat in stats:
+        if stat not in ENSEMBLE_STATS:
+            raise ValueError('Unknown ensemble statistic {}'.format(stat))
+    if any(isinstance(mem_arrays, SparseMemArrays) for mem_arrays in mem_arrays_list):
+        raise ValueError('Sparse memo tables cannot be collapsed into ensemble tables.')
+    n_members = len(mem_arrays_list)
+    tables = dict((stat, []) for stat in stats)
+    for step in six.moves.range(len(mem_arrays_list[0])):
+        total = sum_squares = lowest = highest = None
+        for mem_arrays in mem_arrays_list:
+            level = dequantize_probs(mem_arrays[step])
+            if total is None:
+                total = level.copy()
+                sum_squares = np.square(level)
+                lowest = level.copy()
+                highest = level.copy()
+            else:
+                total += level
+                sum_squares += np.square(level)
+                np.minimum(lowest, level, out=lowest)
+                np.maximum(highest, level, out=highest)
+        mean = total / n_members
+        levels = {
+            'mean': mean,
+            # clipped since rounding can make it slightly negative
+            'var': np.maximum(sum_squares / n_members - np.square(mean), 0.0),
+            'min': lowest,
+            'max': highest,
+        }
+        for stat in stats:
+            tables[stat].append(levels[stat])
+    return tables
+
+
+def save_ensemble_mem_arrays(path, mem_arrays_list, stats=('mean',), dtype=None):
+    '''
+    Saves the tables of ensemble_mem_arrays, each at ensemble_stat_path(path, stat).
+    :param dtype: storage type of the tables, see save_mem_arrays
+    '''
+    for stat, mem_arrays in six.iteritems(ensemble_mem_arrays(mem_arrays_list, stats)):
+        save_mem_arrays(ensemble_stat_path(path, stat), mem_arrays, dtype=dtype)
+
+
+def load_ensemble_mem_arrays(path, stats=('mean',), mmap_mode='r'):
+    '''
+    :return: dict from stat to the memo arrays saved by save_ensemble_mem_arrays
+    '''
+    return dict((stat, load_mem_arrays(ensemble_stat_path(path, stat), mmap_mode=mmap_mode)) for stat in stats)
+
+
+def sparse_level_paths(path, step):
+    '''
+    :return: the paths of the .npy files with the sorted history indices and the predictions
+        of the sparse memo level of the histories of length step
+    '''
+    root, ext = os.path.splitext(path)
+    if ext != '.npz':
+        root = path
+    return '{}-sparse-keys{}.npy'.format(root, step), '{}-sparse-level{}.npy'.format(root, step)
+
+
+def sparse_model_path(path):
+    '''
+    :return: the path of the json file with the arguments of inference_server.load_dynamics_model
+        of the model of the sparse memo tables
+    '''
+    root, ext = os.path.splitext(path)
+    if ext != '.npz':
+        root = path
+    return '{}-sparse-model.json'.format(root)
+
+
+def has_sparse_mem_levels(path):
+    return os.path.exists(sparse_level_paths(path, 0)[0])
+
+
+def save_sparse_mem_arrays(path, sparse_levels, dtype=None, model_args=None):
+    '''
+    :param sparse_levels: a list per history length of (history indices, predictions), the indices sorted
+    :param dtype: storage type of the predictions, see save_mem_arrays
+    :param model_args: dict of the arguments of inference_server.load_dynamics_model other than timesteps
+        (model_id, checkpoint, backend), to load the model answering the histories that are not memoized
+    '''
+    if model_args is not None:
+        with open(sparse_model_path(path), 'w') as f:
+            json.dump(model_args, f)
+    for step, (keys, probs) in enumerate(sparse_levels):
+        keys_path, probs_path = sparse_level_paths(path, step)
+        if dtype is not None:
+            probs = quantize_probs(probs, dtype)
+        np.save(keys_path, np.asarray(keys, dtype=np.int64))
+        np.save(probs_path, probs)
+
+
+class SparseMemArrays(object):
+    '''
+    The sparse memo tables saved by save_sparse_mem_arrays. Histories are looked up by binary search
+    of their index among the memoized indices of their length. Levels are loaded when first used,
+    and pickling only keeps the path, like MemArrays.
+    '''
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        n_levels = 0
+        while os.path.exists(sparse_level_paths(path, n_levels)[0]):
+            n_levels += 1
+        if n_levels == 0:
+            raise IOError('No sparse memo arrays at {}'.format(path))
+        self._levels = [None] * n_levels
+        # the arguments of load_dynamics_model of the memoized model, if they were saved
+        self.model_args = None
+        if os.path.exists(sparse_model_path(path)):
+            with open(sparse_model_path(path)) as f:
+                self.model_args = json.load(f)
+
+    def __getstate__(self):
+        return {'path': self.path, 'mmap_mode': self.mmap_mode}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['mmap_mode'])
+
+    def __len__(self):
+        return len(self._levels)
+
+    def level(self, step):
+        '''
+        :return: (sorted history indices, predictions) of the histories of length step
+        '''
+        level = self._levels[step]
+        if level is None:
+            level = tuple(np.load(level_path, mmap_mode=self.mmap_mode) for level_path in sparse_level_paths(self.path, step))
+            self._levels[step] = level
+        return level
+
+    def lookup(self, step, history_ixs):
+        '''
+        :param history_ixs: the indices (see helpers.history_ix_append) of histories of length step
+        :return: (float64 predictions with zero rows for the misses, boolean array of the hits)
+        '''
+        history_ixs = np.asarray(history_ixs, dtype=np.int64)
+        keys, probs = self.level(step)
+        rows = np.minimum(np.searchsorted(keys, history_ixs), max(len(keys) - 1, 0))
+        found = (keys[rows] == history_ixs) if len(keys) else np.zeros(history_ixs.shape, dtype=bool)
+        preds = np.zeros(history_ixs.shape + probs.shape[1:])
+        if np.any(found):
+            preds[found] = dequantize_probs(probs[rows[found]])
+        return preds, found
+
+    def get(self, step, history_ix):
+        '''
+        :return: the prediction of one history, or None if it is not memoized
+        '''
+        if step >= len(self):
+            return None
+        preds, found = self.lookup(step, [history_ix])
+        return preds[0] if found[0] else None
+
+    def n_histories(self):
+        return sum(len(self.level(step)[0]) for step in six.moves.range(len(self)))
@@ -0,0 +1,147 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests for the per-level storage of the memoized DKT predictions.
+#===============================================================================
+# USAGE: python memo_tables_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import six
+
+from memo_tables import MemArrays, load_mem_arrays, save_mem_arrays
+from memo_tables import quantize_probs, dequantize_probs, quantization_error
+from memo_tables import ensemble_stat_path, load_ensemble_mem_arrays, save_ensemble_mem_arrays
+from memo_tables import SparseMemArrays, save_sparse_mem_arrays
+
+
+def _random_mem_arrays(n_concepts, horizon):
+    return [np.random.rand((2 * n_concepts) ** step, n_concepts) for step in six.moves.range(horizon + 1)]
+
+
+def test_levels_round_trip(n_concepts=3, horizon=3):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'mem-test-epoch1.npz')
+        mem_arrays = _random_mem_arrays(n_concepts, horizon)
+        save_mem_arrays(path, mem_arrays)
+        loaded = load_mem_arrays(path)
+        assert isinstance(loaded, MemArrays) and len(loaded) == horizon + 1
+        # nothing is opened before it is used
+        assert all(level is None for level in loaded._levels)
+        assert isinstance(loaded[2], np.memmap)
+        assert loaded._levels[1] is None
+        for expected, level in six.moves.zip(mem_arrays, loaded):
+            assert np.array_equal(expected, level)
+        # pickles without the data, and maps the files again when unpickled
+        copy = pickle.loads(pickle.dumps(loaded))
+        assert all(level is None for level in copy._levels)
+        assert np.array_equal(copy[horizon][[0, 5, 7], :], mem_arrays[horizon][[0, 5, 7], :])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_npz_still_loads(n_concepts=2, horizon=2):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'mem-old.npz')
+        mem_arrays = _random_mem_arrays(n_concepts, horizon)
+        mem_object_array = np.empty((horizon + 1,), dtype=object)
+        mem_object_array[:] = mem_arrays
+        np.savez(path, mem_arrays=mem_object_array)
+        loaded = load_mem_arrays(path)
+        assert len(loaded) == horizon + 1
+        for expected, level in six.moves.zip(mem_arrays, loaded):
+            assert np.array_equal(expected, level)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_quantized_levels(n_concepts=3, horizon=3):
+    '''
+    Quantized tables keep their storage type on disk and read back within the precision of the type.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mem_arrays = _random_mem_arrays(n_concepts, horizon)
+        for dtype, tol in (('float16', 2.0**-11), ('uint16', 0.5 / 65535), ('uint8', 0.5 / 255)):
+            path = os.path.join(tmpdir, 'mem-{}.npz'.format(dtype))
+            save_mem_arrays(path, mem_arrays, dtype=dtype)
+            loaded = load_mem_arrays(path)
+            for expected, level in six.moves.zip(mem_arrays, loaded):
+                assert level.dtype == np.dtype(dtype)
+                assert np.max(np.abs(dequantize_probs(level) - expected)) <= tol + 1e-12, dtype
+            max_error, mean_error = quantization_error(mem_arrays, dtype)
+            assert 0.0 < mean_error <= max_error <= tol + 1e-12, dtype
+            # quantizing again, also to another type, starts from the dequantized values
+            assert np.array_equal(quantize_probs(loaded[1], dtype), loaded[1])
+        assert np.array_equal(quantize_probs(np.array([0.0, 1.0, 1.5, -0.1]), 'uint8'), [0, 255, 255, 0])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_ensemble_tables(n_concepts=2, horizon=3, n_members=5):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        members = [_random_mem_arrays(n_concepts, horizon) for _ in six.moves.range(n_members)]
+        # the members may be quantized
+        members[0] = [quantize_probs(level, 'uint16') for level in members[0]]
+        path = os.path.join(tmpdir, 'mem-ensemble.npz')
+        save_ensemble_mem_arrays(path, members, stats=('mean', 'var', 'min', 'max'))
+        assert os.path.exists(os.path.join(tmpdir, 'mem-ensemble-var-level2.npy'))
+        tables = load_ensemble_mem_arrays(path, stats=('mean', 'var', 'min', 'max'))
+        assert np.array_equal(load_mem_arrays(ensemble_stat_path(path, 'mean'))[1], tables['mean'][1])
+        for step in six.moves.range(horizon + 1):
+            stacked = np.array([dequantize_probs(member[step]) for member in members])
+            assert np.allclose(tables['mean'][step], np.mean(stacked, axis=0))
+            assert np.allclose(tables['var'][step], np.var(stacked, axis=0))
+            assert np.array_equal(tables['min'][step], np.min(stacked, axis=0))
+            assert np.array_equal(tables['max'][step], np.max(stacked, axis=0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sparse_lookup(n_concepts=2, horizon=3):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dense = _random_mem_arrays(n_concepts, horizon)
+        # keep every third history, and none of length 2
+        sparse_levels = []
+        for step, level in enumerate(dense):
+            keys = np.arange(0, level.shape[0], 3) if step != 2 else np.zeros((0,), dtype=np.int64)
+            sparse_levels.append((keys, level[keys]))
+        path = os.path.join(tmpdir, 'mem-sparse.npz')
+        model_args = {'model_id': 'test2_modelgrusimple_small', 'checkpoint': 'model.ckpt', 'backend': 'numpy'}
+        save_sparse_mem_arrays(path, sparse_levels, model_args=model_args)
+        sparse_mem = pickle.loads(pickle.dumps(load_mem_arrays(path)))
+        assert isinstance(sparse_mem, SparseMemArrays) and sparse_mem.model_args == model_args
+        assert len(sparse_mem) == horizon + 1
+        assert sparse_mem.n_histories() == sum(len(keys) for keys, _ in sparse_levels)
+        history_ixs = np.arange(dense[horizon].shape[0])
+        preds, found = sparse_mem.lookup(horizon, history_ixs)
+        assert np.array_equal(found, history_ixs % 3 == 0)
+        assert np.array_equal(preds[found], dense[horizon][found])
+        assert np.all(preds[~found] == 0.0)
+        assert not np.any(sparse_mem.lookup(2, [0, 1, 2])[1])
+        assert np.array_equal(sparse_mem.get(1, 3), dense[1][3])
+        assert sparse_mem.get(1, 2) is None and sparse_mem.get(horizon + 1, 0) is None
+        try:
+            save_ensemble_mem_arrays(os.path.join(tmpdir, 'mem-ensemble.npz'), [sparse_mem, dense])
+            assert False, "expected an error"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_levels_round_trip()
+    test_npz_still_loads()
+    test_quantized_levels()
+    test_ensemble_tables()
+    test_sparse_lookup()
+    six.print_('All tests passed.')
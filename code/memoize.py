@@ -0,0 +1,132 @@
+# memoize.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Memoization of the DKT predictions for all (or all likely) histories up to
+# a planning horizon, level by level with batched model.step calls.
+# Works on anything with the step/initial_states interface of a DynamicsModel,
+# e.g. a NumpyDynamicsModel, and does not import tensorflow.
+# model_training.dkt_memoize_single runs it on a checkpoint and saves the
+# tables with memo_tables.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from memoize import dkt_memoize_levels, dkt_memoize_sparse
+#   mem_arrays = dkt_memoize_levels(n_concepts, model, horizon)
+#   sparse_levels = dkt_memoize_sparse(n_concepts, model, horizon, threshold)
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import six
+
+from helpers import num_histories, sanitize_probs, action_ob_encode
+
+
+def _branch_inputs(n_concepts):
+    '''
+    :return: the rnn input of every branch (see action_ob_encode), as in dataset_utils.encode_observations:
+        a correct observation is a one-hot in the first half of the input, a wrong one in the second half
+    '''
+    index_base = n_concepts * 2
+    branch_inputs = np.zeros((index_base, index_base), dtype=np.float32)
+    for next_action in six.moves.range(n_concepts):
+        for next_ob in (0,1):
+            next_branch = action_ob_encode(n_concepts, next_action, next_ob)
+            branch_inputs[next_branch, next_action if next_ob == 1 else n_concepts + next_action] = 1.0
+    return branch_inputs
+
+def _check_history_ixs(n_concepts, horizon):
+    # the memo tables index the histories with int64 history_ix_append indices
+    assert (n_concepts * 2) ** horizon < 2**63, \
+        'The history indices of {} concepts overflow int64 past horizon {}.'.format(n_concepts, horizon)
+
+def dkt_memoize_levels(n_concepts, model, horizon, max_batch=2**16):
+    '''
+    Compute the predictions of the model for all histories up to and including the horizon, level by level.
+    The hidden states of all histories of length t are kept, and all of their children are computed
+    with a few model.step calls, instead of one predict per history.
+    :param model: anything with step and initial_states like a DynamicsModel, e.g. a NumpyDynamicsModel
+    :param horizon: the horizon of planning
+    :param max_batch: the maximal number of histories per step call, bounds the memory of one call
+    :return: a list of memoization arrays per history length, with nothing at index 0
+    '''
+    # compute the number of branches i.e |num actions|*2
+    index_base = n_concepts * 2
+    _check_history_ixs(n_concepts, horizon)
+    branch_inputs = _branch_inputs(n_concepts)
+    
+    mem_arrays = [None] * (horizon+1)
+    mem_arrays[0] = np.zeros((num_histories(index_base,0),n_concepts))
+    # hidden states of all histories of the previous level, rows in history index order
+    states = model.initial_states(1)
+    parents_per_batch = max(1, max_batch // index_base)
+    for step in six.moves.range(1, horizon+1):
+        n_parents = num_histories(index_base, step-1)
+        mem_arrays[step] = np.zeros((num_histories(index_base,step),n_concepts))
+        keep_states = step < horizon
+        if keep_states:
+            next_states = [np.zeros((n_parents*index_base,) + state.shape[1:], dtype=state.dtype) for state in states]
+        for start in six.moves.range(0, n_parents, parents_per_batch):
+            stop = min(start + parents_per_batch, n_parents)
+            # history_ix_append(parent, branch) = parent*index_base + branch, so repeating every parent
+            # index_base times and tiling the branches gives the children in history index order
+            inputs = np.tile(branch_inputs, (stop-start, 1))
+            parent_states = [np.repeat(state[start:stop], index_base, axis=0) for state in states]
+            preds, child_states = model.step(inputs, parent_states)
+            mem_arrays[step][start*index_base:stop*index_base,:] = preds
+            if keep_states:
+                for next_state, child_state in six.moves.zip(next_states, child_states):
+                    next_state[start*index_base:stop*index_base] = child_state
+        if keep_states:
+            states = next_states
+    return mem_arrays
+
+def dkt_memoize_sparse(n_concepts, model, horizon, threshold, policy=None, max_batch=2**16):
+    '''
+    Like dkt_memoize_levels, but only memoizes the histories whose path probability is at least threshold,
+    so the tables grow with the number of likely histories instead of (2*n_concepts)**horizon.
+    The path probability of a history is the product over its steps of the probability of the observation
+    predicted by the model, times the probability of the action under the policy. As in the planners,
+    the prediction of the empty history is sanitize_probs(n_concepts, None).
+    :param threshold: the minimal path probability of a memoized history, 0 memoizes every history
+    :param policy: function from the predictions of m histories (m, n_concepts) to the action probabilities
+        of a behavior policy (m, n_concepts). None weights every action by 1, like a planner that tries all of them.
+    :return: a list per history length of (sorted history indices, predictions)
+    '''
+    index_base = n_concepts * 2
+    _check_history_ixs(n_concepts, horizon)
+    branch_inputs = _branch_inputs(n_concepts)
+    
+    # the memoized histories of the previous level, their path probabilities, predictions and hidden states
+    history_ixs = np.zeros((1,), dtype=np.int64)
+    path_probs = np.ones((1,))
+    preds = sanitize_probs(n_concepts, None)[np.newaxis,:]
+    states = model.initial_states(1)
+    sparse_levels = [(history_ixs, np.zeros((1,n_concepts)))]
+    for step in six.moves.range(1, horizon+1):
+        # probability of every branch, laid out as in action_ob_encode
+        branch_probs = np.concatenate([1.0 - preds, preds], axis=1)
+        if policy is not None:
+            branch_probs *= np.tile(policy(preds), 2)
+        child_probs = path_probs[:,np.newaxis] * branch_probs
+        # rows in order of the parents then the branches, so the history indices stay sorted
+        parents, branches = np.nonzero(child_probs >= threshold)
+        child_ixs = history_ixs[parents] * index_base + branches
+        child_preds = np.zeros((len(child_ixs),n_concepts))
+        keep_states = step < horizon
+        if keep_states:
+            child_states = [np.zeros((len(child_ixs),) + state.shape[1:], dtype=state.dtype) for state in states]
+        for start in six.moves.range(0, len(child_ixs), max_batch):
+            stop = min(start + max_batch, len(child_ixs))
+            rows = parents[start:stop]
+            batch_preds, batch_states = model.step(branch_inputs[branches[start:stop]], [state[rows] for state in states])
+            child_preds[start:stop,:] = batch_preds
+            if keep_states:
+                for child_state, batch_state in six.moves.zip(child_states, batch_states):
+                    child_state[start:stop] = batch_state
+        sparse_levels.append((child_ixs, child_preds))
+        history_ixs, path_probs, preds = child_ixs, child_probs[parents, branches], child_preds
+        if keep_states:
+            states = child_states
+    return sparse_levels
@@ -0,0 +1,138 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests of the memoization of the DKT predictions, on numpy models with random weights.
+#===============================================================================
+# USAGE: python memoize_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import six
+
+import student_sim as ssim
+import memoize
+import student as st
+from helpers import num_histories, action_ob_encode, history_ix_append, sample_observations_batch
+from memo_tables import SparseMemArrays, load_mem_arrays, save_mem_arrays, save_sparse_mem_arrays
+from random_dynamics_model import make_random_model
+
+
+def _memoize_recurse(n_concepts, dkt, horizon, step, history_ix, mem_arrays):
+    '''
+    Recursively populate mem_arrays with the predictions of the dkt, depth first.
+    :param dkt: the RnnStudentSim at the current history state
+    :param step: the next time step about to be memoized
+    :param history_ix: the index of the current history
+    :param mem_arrays: a list of memoization arrays per history length, with nothing at index 0
+    '''
+    if step > horizon:
+        return
+    next_dkts = []
+    next_history_ixs = []
+    for next_action in six.moves.range(n_concepts):
+        for next_ob in (0,1):
+            next_branch = action_ob_encode(n_concepts, next_action, next_ob)
+            next_history_ixs.append(history_ix_append(n_concepts, history_ix, next_branch))
+            next_dkt = dkt.copy()
+            next_dkt.advance_simulator(st.make_student_action(n_concepts, next_action), next_ob)
+            next_dkts.append(next_dkt)
+    mem_arrays[step][next_history_ixs,:] = sample_observations_batch(next_dkts)
+    for next_dkt, next_history_ix in six.moves.zip(next_dkts, next_history_ixs):
+        _memoize_recurse(n_concepts, next_dkt, horizon, step+1, next_history_ix, mem_arrays)
+
+
+def test_memoize_levels_matches_recursion(horizon=3, n_models=3):
+    '''
+    The level by level memoization gives the same tables as the depth first recursion.
+    '''
+    for seed in six.moves.range(n_models):
+        model = make_random_model(seed)
+        n_concepts = model.model_dict['n_outputdim']
+        expected = [np.zeros((num_histories(2 * n_concepts, i), n_concepts)) for i in six.moves.range(horizon + 1)]
+        _memoize_recurse(n_concepts, ssim.RnnStudentSim(model), horizon, 1, 0, expected)
+        # a small max_batch also checks the chunking of the levels
+        for max_batch in (2**16, 10):
+            mem_arrays = memoize.dkt_memoize_levels(n_concepts, model, horizon, max_batch=max_batch)
+            for step in six.moves.range(horizon + 1):
+                assert np.allclose(mem_arrays[step], expected[step], atol=1e-6), (seed, step)
+        # the sparse tables hold the same rows, and all of them without pruning
+        for threshold in (0.0, 0.01):
+            sparse_levels = memoize.dkt_memoize_sparse(n_concepts, model, horizon, threshold, max_batch=10)
+            for step in six.moves.range(1, horizon + 1):
+                history_ixs, preds = sparse_levels[step]
+                assert np.all(np.diff(history_ixs) > 0), (seed, step)
+                assert threshold > 0.0 or len(history_ixs) == expected[step].shape[0], (seed, step)
+                assert np.allclose(preds, expected[step][history_ixs], atol=1e-6), (seed, step)
+
+
+def test_sparse_mem_sim_matches_model(horizon=3, threshold=0.01, n_trajectories=30, n_steps=9):
+    '''
+    Without pruning the sparse tables are the dense ones. With pruning, RnnStudentSimSparseMem answers
+    like the model it was memoized from, also for the pruned histories and past the memoized horizon.
+    '''
+    model = make_random_model()
+    n_concepts = model.model_dict['n_outputdim']
+    mem_arrays = memoize.dkt_memoize_levels(n_concepts, model, horizon)
+    for step, (history_ixs, preds) in enumerate(memoize.dkt_memoize_sparse(n_concepts, model, horizon, 0.0)):
+        assert np.array_equal(history_ixs, np.arange(mem_arrays[step].shape[0])), step
+        if step > 0:
+            assert np.allclose(preds, mem_arrays[step], atol=1e-6), step
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'mem-sparse.npz')
+        sparse_levels = memoize.dkt_memoize_sparse(n_concepts, model, horizon, threshold)
+        save_sparse_mem_arrays(path, sparse_levels)
+        sparse_mem = load_mem_arrays(path)
+        assert isinstance(sparse_mem, SparseMemArrays)
+        # something was pruned
+        assert sparse_mem.n_histories() < sum(level.shape[0] for level in mem_arrays)
+
+        rng = np.random.RandomState(0)
+        for _ in six.moves.range(n_trajectories):
+            sim = ssim.RnnStudentSimSparseMem(n_concepts, sparse_mem, ssim.RnnStudentSim(model))
+            expected = ssim.RnnStudentSim(model)
+            for _ in six.moves.range(n_steps):
+                action = st.make_student_action(n_concepts, rng.randint(n_concepts))
+                ob = rng.randint(2)
+                sim.advance_simulator(action, ob)
+                expected.advance_simulator(action, ob)
+                assert np.allclose(sim.sample_observations(), expected.sample_observations(), atol=1e-6)
+                batch = ssim.RnnStudentSimSparseMem.sample_observations_batch([sim.copy(), sim])
+                assert np.allclose(batch, expected.sample_observations(), atol=1e-6)
+
+        # the tables don't name their model
+        try:
+            ssim.load_mem_student_sim(n_concepts, [path], horizon)
+            assert False, "expected an error"
+        except ValueError as e:
+            assert "fallback" in str(e)
+        dense_path = os.path.join(tmpdir, 'mem-dense.npz')
+        save_mem_arrays(dense_path, mem_arrays)
+        assert isinstance(ssim.load_mem_student_sim(n_concepts, [dense_path], horizon), ssim.RnnStudentSimMemEnsemble)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_history_index_overflow(n_concepts=4, horizon=21):
+    '''
+    Horizons whose history indices don't fit into int64 are refused up front.
+    '''
+    model = make_random_model()
+    memoize_fns = (lambda: memoize.dkt_memoize_levels(n_concepts, model, horizon),
+                   lambda: memoize.dkt_memoize_sparse(n_concepts, model, horizon, 1.0))
+    for memoize_fn in memoize_fns:
+        try:
+            memoize_fn()
+            assert False, "expected an error"
+        except AssertionError as e:
+            assert "overflow" in str(e)
+
+if __name__ == '__main__':
+    test_memoize_levels_matches_recursion()
+    test_sparse_mem_sim_matches_model()
+    test_history_index_overflow()
+    six.print_('All tests passed.')
@@ -27,6 +27,9 @@ import dataset_utils
 
 from simple_mdp import SimpleMDP
 from joblib import Parallel, delayed
+from inference_server import load_dynamics_model
+from memo_tables import save_mem_arrays, load_mem_arrays, save_ensemble_mem_arrays, save_sparse_mem_arrays
+from memoize import dkt_memoize_levels, dkt_memoize_sparse
 
 # helper functions
 from helpers import *
@@ -44,6 +47,25 @@ class ExtractCallback(tflearn.callbacks.Callback):
     def on_batch_end(self,ts,snapshot):
         self.tstates[-1].append(copy.copy(ts))
 
+class CheckpointCallback(tflearn.callbacks.Callback):
+    '''
+    Saves the model at the end of the given (zero-based) epochs, so that a single train call
+    can produce all the checkpoints of a run.
+    '''
+    def __init__(self, model, saved_epochs, path_fn):
+        '''
+        :param path_fn: maps a zero-based epoch to its checkpoint path
+        '''
+        self.model = model
+        self.saved_epochs = set(saved_epochs)
+        self.path_fn = path_fn
+    def on_epoch_end(self,ts):
+        # ts.epoch counts the epochs trained so far
+        ep = ts.epoch - 1
+        if ep in self.saved_epochs:
+            print('---------- Saving epoch {:2d} ----------'.format(ep))
+            self.model.save(self.path_fn(ep))
+
 def _dkt_train_models_chunk(params, runstartix, chunk_num_runs):
     '''
     Loads data and trains a batch of models.
@@ -55,9 +77,8 @@ def _dkt_train_models_chunk(params, runstartix, chunk_num_runs):
     train_losses = [[] for _ in six.moves.range(chunk_num_runs)]
     val_losses = [[] for _ in six.moves.range(chunk_num_runs)]
     
-    #load data
-    data = dataset_utils.load_data(filename='{}{}'.format(dg.SYN_DATA_DIR, params.datafile))
-    input_data_, output_mask_, target_data_ = dataset_utils.preprocess_data_for_rnn(data)
+    #load data, preprocessed once in compact form and shared between the workers through the cache
+    index_data, _ = dataset_utils.load_rnn_data_cached('{}{}'.format(dg.SYN_DATA_DIR, params.datafile), compact=True)
     
     for offset in six.moves.range(chunk_num_runs):
         r = runstartix + offset
@@ -65,36 +86,21 @@ def _dkt_train_models_chunk(params, runstartix, chunk_num_runs):
         # new model instantiation
         dkt_model = dmc.DynamicsModel(model_id=params.model_id, timesteps=params.seqlen-1, dropout=params.dropout, output_dropout=params.output_dropout, load_checkpoint=False)
         
-        epochs_trained = 0
-        for ep in params.saved_epochs:
-            print('=====================================')
-            print('---------- Rep {:2d} Epoch {:2d} ----------'.format(r, ep))
-            print('=====================================')
-            
-            # remember the epochs are given as zero-based
-            epochs_to_train = ep+1 - epochs_trained
-            assert epochs_to_train > 0
-            
-            # train
-            ecall = ExtractCallback()
-            
-            for _ in six.moves.range(epochs_to_train):
-                # add noise every epoch, so the noise is randomly different every epoch
-                processed_input_data = input_data_ + (params.noise * np.random.randn(*input_data_.shape))
-                train_data = (processed_input_data[:,:,:], output_mask_[:,:,:], target_data_[:,:,:])
-                dkt_model.train(train_data, n_epoch=1, callbacks=ecall, shuffle=params.shuffle, load_checkpoint=False)
-            
-            # save the checkpoint
-            checkpoint_name = params.checkpoint_pat.format(params.run_name, r, ep)
-            checkpoint_path = '{}/{}'.format(params.dir_name,checkpoint_name)
-            dkt_model.save(checkpoint_path)
-            
-            # update stats
-            train_losses[offset].extend([np.mean([ts.global_loss for ts in batch]) for batch in ecall.tstates])
-            val_losses[offset].extend([batch[-1].val_loss for batch in ecall.tstates])
-            
-            # update epochs_trained
-            epochs_trained = ep+1
+        print('=====================================')
+        print('---------- Rep {:2d} ----------'.format(r))
+        print('=====================================')
+        
+        # train all epochs in one go, saving the checkpoints along the way
+        # noise is added to every minibatch as it is expanded, so it is randomly different every epoch
+        # remember the epochs are given as zero-based
+        ecall = ExtractCallback()
+        ccall = CheckpointCallback(dkt_model, params.saved_epochs,
+            lambda ep: '{}/{}'.format(params.dir_name, params.checkpoint_pat.format(params.run_name, r, ep)))
+        dkt_model.train(index_data, n_epoch=max(params.saved_epochs)+1, callbacks=[ecall, ccall], shuffle=params.shuffle, load_checkpoint=False, noise=params.noise)
+        
+        # update stats
+        train_losses[offset].extend([np.mean([ts.global_loss for ts in batch]) for batch in ecall.tstates])
+        val_losses[offset].extend([batch[-1].val_loss for batch in ecall.tstates])
     return (train_losses, val_losses)
 
 def dkt_train_models(params):
@@ -132,64 +138,32 @@ def dkt_train_models(params):
 
 ################################ memoize the model predictions #####################################
 
-def dkt_memoize_single_recurse(n_concepts, dkt, horizon, step, history_ix, mem_arrays):
-    '''
-    Recursively populate mem_arrays with the predictions of the dkt.
-    :param dkt: the RnnStudentSim at the current history state
-    :param horizon: the horizon of planning
-    :param step: the next time step about to be memoized
-    :param history_ix: the index of the current history
-    :param mem_arrays: a list of memoization arrays per history length, with nothing at index 0
-    '''
-    # debugging print
-    if False:
-        six.print_('Current history: {}'.format(dkt.sequence))
-        six.print_('Prediction: {}'.format(dkt.sample_observations()))
-        six.print_('Memoized Prediction: {}'.format(mem_arrays[step-1][history_ix]))
-    
-    if step > horizon:
-        # we've finished
-        return
-    
-    # go over all possible next steps in the history and populate recursively
-    for next_action in six.moves.range(n_concepts):
-        for next_ob in (0,1):
-            next_branch = action_ob_encode(n_concepts, next_action, next_ob)
-            next_history_ix = history_ix_append(n_concepts, history_ix, next_branch)
-            # advance the DKT
-            next_dkt = dkt.copy()
-            next_dkt.advance_simulator(st.make_student_action(n_concepts,next_action),next_ob)
-            # add new entry to the mem arrays
-            mem_arrays[step][next_history_ix,:] = next_dkt.sample_observations()
-            # recurse
-            dkt_memoize_single_recurse(n_concepts, next_dkt, horizon, step+1, next_history_ix, mem_arrays)
-
-def dkt_memoize_single(n_concepts, model_id, checkpoint, horizon, outfile):
+def dkt_memoize_single(n_concepts, model_id, checkpoint, horizon, outfile, backend='tf', dtype=None, threshold=None):
     '''
     Memoize a single given model up to and including the given horizon.
     :param checkpoint: a checkpoint file with the model
     :param horizon: the horizon of planning
     :param outfile: str name of the output file for mem arrays
+    :param backend: 'tf' to run the DynamicsModel, 'numpy' to run the weights exported to numpy
+    :param dtype: storage type of the probabilities, one of memo_tables.MEM_DTYPES, None for float64
+    :param threshold: if given, only memoize the histories with at least this path probability in
+        sparse tables (see dkt_memoize_sparse), to be opened with dmc.load_mem_student_sim which answers
+        the other histories with the model of this checkpoint
     '''
     # load up the model
-    dmodel = dmc.DynamicsModel(model_id, timesteps=horizon, load_checkpoint=False)
-    dmodel.load(checkpoint)
-    # wrap
-    dkt = dmc.RnnStudentSim(dmodel)
-    
-    # compute the number of branches i.e |num actions|*2
-    index_base = n_concepts * 2
+    model = load_dynamics_model(model_id, checkpoint, timesteps=horizon, backend=backend)
     
-    # initialize all to zero
-    mem_arrays = [None] * (horizon+1)
-    for i in six.moves.range(horizon+1):
-        mem_arrays[i] = np.zeros((num_histories(index_base,i),n_concepts))
+    if threshold is not None:
+        model_args = {'model_id': model_id, 'checkpoint': checkpoint, 'backend': backend}
+        save_sparse_mem_arrays(outfile, dkt_memoize_sparse(n_concepts, model, horizon, threshold), dtype=dtype,
+                               model_args=model_args)
+        return
     
-    # start populating the mem arrays recursive
-    dkt_memoize_single_recurse(n_concepts, dkt, horizon, 1, 0, mem_arrays)
+    # populate the mem arrays level by level
+    mem_arrays = dkt_memoize_levels(n_concepts, model, horizon)
     
-    # finished so write it
-    np.savez(outfile, mem_arrays=mem_arrays)
+    # finished so write it, one file per history length
+    save_mem_arrays(outfile, mem_arrays, dtype=dtype)
 
 def dkt_memoize_chunk(params, runstartix, chunk_num_runs):
     for offset in six.moves.range(chunk_num_runs):
@@ -209,7 +183,8 @@ def dkt_memoize_chunk(params, runstartix, chunk_num_runs):
             mem_path = '{}/{}'.format(params.dir_name,mem_name)
             
             # memoize
-            dkt_memoize_single(params.n_concepts, params.model_id, checkpoint_path, params.mem_horizon, mem_path)
+            dkt_memoize_single(params.n_concepts, params.model_id, checkpoint_path, params.mem_horizon, mem_path,
+                               dtype=params.mem_dtype, threshold=params.mem_threshold)
             
             six.print_('Finished.')
 
@@ -231,6 +206,26 @@ def dkt_memoize_models(params):
         Parallel(n_jobs=n_jobs)(delayed(dkt_memoize_chunk)(params,startix,runs_per_job) 
                                 for startix in six.moves.range(0,params.num_runs,runs_per_job)))
 
+def dkt_memoize_ensemble(params, ep, runs=None, stats=('mean',)):
+    '''
+    Collapses the memoized models of the given runs into precomputed ensemble tables, saved next to
+    the member tables. The mean table can then be used like the memo file of a single model.
+    :param ep: the saved epoch of the members
+    :param runs: the runs forming the ensemble, by default all of them
+    :param stats: which of memo_tables.ENSEMBLE_STATS to save
+    :return: the memo path of the ensemble, see memo_tables.ensemble_stat_path
+    '''
+    if runs is None:
+        runs = list(six.moves.range(params.num_runs))
+    mem_array_list = []
+    for r in runs:
+        mem_name = params.mem_pat.format(params.run_name, r, ep)
+        mem_array_list.append(load_mem_arrays('{}/{}'.format(params.dir_name,mem_name)))
+    ensemble_name = params.mem_pat.format(params.run_name, '-ensemble{}'.format(len(runs)), ep)
+    ensemble_path = '{}/{}'.format(params.dir_name,ensemble_name)
+    save_ensemble_mem_arrays(ensemble_path, mem_array_list, stats=stats, dtype=params.mem_dtype)
+    return ensemble_path
+
 ############################################################################
 # multistep errors
 
@@ -246,11 +241,7 @@ def dkt_multistep_single(n_concepts, n_trajectories, model_id, checkpoints, hori
             model_list.append(model)
         dkt = dmc.RnnStudentSimEnsemble(model_list)
     else:
-        mem_array_list = []
-        for chkpt in checkpoints:
-            mem_arrays = np.load(chkpt)['mem_arrays']
-            mem_array_list.append(mem_arrays)
-        dkt = dmc.RnnStudentSimMemEnsemble(n_concepts, mem_array_list)
+        dkt = dmc.load_mem_student_sim(n_concepts, checkpoints, horizon)
     
     concept_tree = cdg.ConceptDependencyGraph()
     concept_tree.init_default_tree(n_concepts)
@@ -417,6 +408,10 @@ class TrainParams(object):
         
         # memoization horizon
         self.mem_horizon = 6
+        # storage type of the memoized probabilities, see memo_tables.MEM_DTYPES; None for float64
+        self.mem_dtype = None
+        # minimal path probability of the memoized histories, see dkt_memoize_sparse; None memoizes all of them
+        self.mem_threshold = None
 
         # these names are derived from above and should not be touched generally
         noise_str = '-noise{:.2f}'.format(self.noise) if self.noise > 0.0 else ''
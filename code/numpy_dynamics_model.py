@@ -0,0 +1,325 @@
+# numpy_dynamics_model.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Pure numpy forward pass of the DKT networks built by DynamicsModel, for all
+# four architectures (default, simple, gru, grusimple).
+# The weights are exported once from a tensorflow checkpoint (or a live
+# DynamicsModel) and saved as a .npz file; after that NumpyDynamicsModel
+# answers predict/step queries without tensorflow, so it can be plugged into
+# RnnStudentSim in place of a DynamicsModel. For the small models used in
+# planning this avoids the session and feed_dict overhead of every query.
+# NumpyEnsembleModel evaluates a whole ensemble with the member weights stacked,
+# instead of one model and session per member.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from numpy_dynamics_model import NumpyDynamicsModel, NumpyEnsembleModel
+#   model = NumpyDynamicsModel.from_checkpoint(model_id, checkpoint, timesteps)
+#   model.save(path)  /  model = NumpyDynamicsModel.load(path, timesteps)
+#   ensemble = NumpyEnsembleModel.from_checkpoints(model_id, checkpoints, timesteps)
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import six
+
+import dataset_utils as d_utils
+
+# forget gate bias added by tflearn's BasicLSTMCell
+LSTM_FORGET_BIAS = 1.0
+
+# suffixes of the variable names of each kind of layer, relative to the layer scope
+LSTM_VARIABLES = {'W': 'BasicLSTMCell/Linear/Matrix', 'b': 'BasicLSTMCell/Linear/Bias'}
+GRU_VARIABLES = {
+    'gates_W': 'GRUCell/Gates/Linear/Matrix', 'gates_b': 'GRUCell/Gates/Linear/Bias',
+    'candidate_W': 'GRUCell/Candidate/Linear/Matrix', 'candidate_b': 'GRUCell/Candidate/Linear/Bias',
+}
+OUTPUT_SCOPE = 'output_shared'
+OUTPUT_VARIABLES = {'W': 'W', 'b': 'b'}
+
+
+def recurrent_layers(architecture, n_hidden, n_outputdim):
+    '''
+    :return: list of (cell type, units, activation, scope) of the recurrent layers of an architecture,
+    as built by the DynamicsModel._build_* functions. Architectures with a single recurrent layer
+    end in a sigmoid fully connected layer with scope OUTPUT_SCOPE.
+    '''
+    return {
+        'default': [('lstm', n_hidden, 'tanh', 'lstm_1'), ('lstm', n_outputdim, 'sigmoid', 'lstm_2')],
+        'simple': [('lstm', n_hidden, 'tanh', 'lstm_1')],
+        'gru': [('gru', n_hidden, 'tanh', 'gru_1'), ('gru', n_outputdim, 'sigmoid', 'gru_2')],
+        'grusimple': [('gru', n_hidden, 'tanh', 'gru_1')],
+    }[architecture]
+
+
+def _find_variable(names, scope, suffix):
+    # the optimizer keeps slot variables next to the weights, e.g. lstm_1/.../Matrix/Adam
+    matches = [name for name in names
+               if name.startswith(scope + '/') and name.endswith('/' + suffix) and 'Adam' not in name]
+    assert len(matches) == 1, "Expected one variable {}/.../{}, found {}".format(scope, suffix, matches)
+    return matches[0]
+
+
+def collect_weights(model_dict, names, get_value):
+    '''
+    Picks the weights of the network described by model_dict out of a set of tensorflow variables.
+    :param names: the variable names
+    :param get_value: function name -> value of the variable
+    :return: dict of float32 arrays keyed by '<scope>/<weight>'
+    '''
+    names = list(names)
+    layers = recurrent_layers(model_dict['architecture'], model_dict['n_hidden'], model_dict['n_outputdim'])
+    weights = {}
+    for cell, n_units, activation, scope in layers:
+        variables = LSTM_VARIABLES if cell == 'lstm' else GRU_VARIABLES
+        for key, suffix in six.iteritems(variables):
+            weights[scope + '/' + key] = get_value(_find_variable(names, scope, suffix))
+    if len(layers) == 1:
+        for key, suffix in six.iteritems(OUTPUT_VARIABLES):
+            weights[OUTPUT_SCOPE + '/' + key] = get_value(_find_variable(names, OUTPUT_SCOPE, suffix))
+    return dict((key, np.asarray(value, dtype=np.float32)) for key, value in six.iteritems(weights))
+
+
+def export_checkpoint_weights(model_dict, checkpoint):
+    '''
+    Reads the weights of a network described by model_dict from a checkpoint saved by DynamicsModel.save.
+    Only this function needs tensorflow.
+    '''
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    return collect_weights(model_dict, reader.get_variable_to_shape_map().keys(), reader.get_tensor)
+
+
+def export_model_weights(dmodel):
+    '''
+    Reads the current weights of a DynamicsModel.
+    '''
+    with dmodel._tfgraph.as_default():
+        import tensorflow as tf
+        variables = dict((v.op.name, v) for v in tf.global_variables())
+        return collect_weights(dmodel.model_dict, variables.keys(),
+                               lambda name: dmodel._model.session.run(variables[name]))
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+ACTIVATIONS = {'tanh': np.tanh, 'sigmoid': _sigmoid}
+
+
+def lstm_step(x, c, h, W, b, activation):
+    '''
+    One step of tflearn's BasicLSTMCell on a batch. The arrays may have extra leading axes,
+    e.g. stacked ensemble members, as long as the weights broadcast with np.matmul.
+    :return: new (c, h)
+    '''
+    i, j, f, o = np.split(np.matmul(np.concatenate([x, h], axis=-1), W) + b, 4, axis=-1)
+    new_c = c * _sigmoid(f + LSTM_FORGET_BIAS) + _sigmoid(i) * activation(j)
+    new_h = activation(new_c) * _sigmoid(o)
+    return new_c, new_h
+
+
+def gru_step(x, h, gates_W, gates_b, candidate_W, candidate_b, activation):
+    '''
+    One step of tflearn's GRUCell on a batch, with the same broadcasting as lstm_step.
+    :return: new h
+    '''
+    r, u = np.split(_sigmoid(np.matmul(np.concatenate([x, h], axis=-1), gates_W) + gates_b), 2, axis=-1)
+    c = activation(np.matmul(np.concatenate([x, r * h], axis=-1), candidate_W) + candidate_b)
+    return u * h + (1.0 - u) * c
+
+
+def forward_step(layers, weights, net, states):
+    '''
+    Advances the layers of a network by one step.
+    :param layers: as returned by recurrent_layers
+    :param weights: dict of weights as returned by collect_weights, possibly stacked along leading axes
+    :param net: the inputs of the step
+    :param states: list of hidden states, as in initial_states
+    :return: (outputs, new hidden states)
+    '''
+    new_states = []
+    k = 0
+    for cell, n_units, activation, scope in layers:
+        act = ACTIVATIONS[activation]
+        if cell == 'lstm':
+            c, net = lstm_step(net, states[k], states[k+1], weights[scope + '/W'], weights[scope + '/b'], act)
+            new_states.extend([c, net])
+            k += 2
+        else:
+            net = gru_step(net, states[k], weights[scope + '/gates_W'], weights[scope + '/gates_b'],
+                           weights[scope + '/candidate_W'], weights[scope + '/candidate_b'], act)
+            new_states.append(net)
+            k += 1
+    if len(layers) == 1:
+        net = _sigmoid(np.matmul(net, weights[OUTPUT_SCOPE + '/W']) + weights[OUTPUT_SCOPE + '/b'])
+    return net, new_states
+
+
+def _state_sizes(layers):
+    # units of every hidden state array, in the order of DynamicsModel.initial_states
+    sizes = []
+    for cell, n_units, activation, scope in layers:
+        sizes.extend([n_units] * (2 if cell == 'lstm' else 1))
+    return sizes
+
+
+class NumpyDynamicsModel(object):
+    '''
+    Inference-only DynamicsModel: same predict/step/initial_states/get_timesteps interface,
+    computed with numpy from exported weights.
+    '''
+
+    def __init__(self, model_dict, weights, timesteps=1):
+        '''
+        :param model_dict: the entry of the model in models_dict.json
+        :param weights: dict of arrays as returned by collect_weights
+        :param timesteps: length of the history window, as for DynamicsModel
+        '''
+        self.model_dict = model_dict
+        self.weights = weights
+        self.timesteps = timesteps
+        self.layers = recurrent_layers(model_dict['architecture'], model_dict['n_hidden'], model_dict['n_outputdim'])
+
+    @classmethod
+    def from_checkpoint(cls, model_id, checkpoint, timesteps=1):
+        import models_dict_utils
+        model_dict = models_dict_utils.load_model_dict(model_id)
+        return cls(model_dict, export_checkpoint_weights(model_dict, checkpoint), timesteps=timesteps)
+
+    @classmethod
+    def from_model(cls, dmodel):
+        return cls(dmodel.model_dict, export_model_weights(dmodel), timesteps=dmodel.get_timesteps())
+
+    def save(self, path):
+        np.savez(path, model_dict=np.array(json.dumps(self.model_dict)), **self.weights)
+
+    @classmethod
+    def load(cls, path, timesteps=1):
+        with np.load(path) as f:
+            model_dict = json.loads(str(f['model_dict']))
+            weights = dict((key, f[key]) for key in f.files if key != 'model_dict')
+        return cls(model_dict, weights, timesteps=timesteps)
+
+    def initial_states(self, n_samples):
+        '''
+        :return: list of zero arrays of shape (n_samples, n_units), ordered as in DynamicsModel.initial_states
+        '''
+        return [np.zeros((n_samples, n_units), dtype=np.float32) for n_units in _state_sizes(self.layers)]
+
+    def step(self, inputs, states=None):
+        '''
+        Advances the model by one step for a batch of histories.
+        :param inputs: array of shape (n_samples, n_inputdim)
+        :param states: hidden states returned by the previous step, or None at the start
+        :return: (predictions of shape (n_samples, n_outputdim), new hidden states)
+        '''
+        net = np.asarray(inputs, dtype=np.float32)
+        if states is None:
+            states = self.initial_states(net.shape[0])
+        return forward_step(self.layers, self.weights, net, states)
+
+    def predict(self, input_data=None, actions=None, outcomes=None):
+        '''
+        Same semantics as DynamicsModel.predict: histories longer than timesteps are truncated.
+        :param input_data: of shape (n_samples, n_timesteps, n_inputdim), or index-encoded actions and outcomes
+        :return: array of shape (n_samples, min(n_timesteps, timesteps), n_outputdim)
+        '''
+        if input_data is None:
+            input_data = d_utils.encode_observations(actions, outcomes, self.model_dict["n_outputdim"], dtype=np.float32)
+        n_samples, n_timesteps, n_inputdim = input_data.shape
+        assert(n_inputdim == self.model_dict["n_inputdim"]), "input dimension of data doesn't match the model."
+        n_timesteps = min(n_timesteps, self.timesteps)
+        preds = np.empty((n_samples, n_timesteps, self.model_dict["n_outputdim"]), dtype=np.float32)
+        states = None
+        for t in six.moves.range(n_timesteps):
+            preds[:, t, :], states = self.step(input_data[:, t, :], states)
+        return preds
+
+    def get_timesteps(self):
+        return self.timesteps
+
+
+class NumpyEnsembleModel(object):
+    '''
+    An ensemble of networks of the same architecture evaluated together: the member weights are stacked
+    along a leading axis, so one step is one batched matmul per weight matrix for all the members.
+    Has the interface of NumpyDynamicsModel and predicts the mean of the members, so RnnStudentSim
+    can use it in place of an RnnStudentSimEnsemble.
+    The hidden states are arrays of shape (n_samples, n_members, n_units).
+    '''
+
+    def __init__(self, model_dict, weights_list, timesteps=1):
+        '''
+        :param weights_list: list of weight dicts as returned by collect_weights, one per member
+        '''
+        self.model_dict = model_dict
+        self.timesteps = timesteps
+        self.n_members = len(weights_list)
+        self.layers = recurrent_layers(model_dict['architecture'], model_dict['n_hidden'], model_dict['n_outputdim'])
+        # biases get a sample axis so they broadcast against (n_members, n_samples, n_units)
+        self.weights = {}
+        for key in weights_list[0]:
+            stacked = np.stack([weights[key] for weights in weights_list])
+            self.weights[key] = stacked[:, np.newaxis, :] if stacked.ndim == 2 else stacked
+
+    @classmethod
+    def from_checkpoints(cls, model_id, checkpoints, timesteps=1):
+        import models_dict_utils
+        model_dict = models_dict_utils.load_model_dict(model_id)
+        return cls(model_dict, [export_checkpoint_weights(model_dict, chkpt) for chkpt in checkpoints], timesteps=timesteps)
+
+    @classmethod
+    def from_models(cls, models):
+        '''
+        :param models: list of NumpyDynamicsModel or DynamicsModel of the same architecture
+        '''
+        weights_list = [m.weights if isinstance(m, NumpyDynamicsModel) else export_model_weights(m) for m in models]
+        return cls(models[0].model_dict, weights_list, timesteps=models[0].get_timesteps())
+
+    def initial_states(self, n_samples):
+        return [np.zeros((n_samples, self.n_members, n_units), dtype=np.float32) for n_units in _state_sizes(self.layers)]
+
+    def step(self, inputs, states=None, per_member=False):
+        '''
+        Advances all the members by one step for a batch of histories.
+        :param inputs: array of shape (n_samples, n_inputdim)
+        :param states: hidden states returned by the previous step, or None at the start
+        :param per_member: return the predictions of every member instead of their mean
+        :return: (predictions of shape (n_samples, n_outputdim), or (n_members, n_samples, n_outputdim)
+        with per_member, new hidden states)
+        '''
+        net = np.asarray(inputs, dtype=np.float32)
+        if states is None:
+            states = self.initial_states(net.shape[0])
+        net = np.broadcast_to(net, (self.n_members,) + net.shape)
+        preds, states = forward_step(self.layers, self.weights, net, [np.swapaxes(state, 0, 1) for state in states])
+        states = [np.swapaxes(state, 0, 1) for state in states]
+        if per_member:
+            return preds, states
+        return np.mean(preds, axis=0), states
+
+    def predict(self, input_data=None, actions=None, outcomes=None, per_member=False):
+        '''
+        Same semantics as NumpyDynamicsModel.predict.
+        :param per_member: return the predictions of every member instead of their mean
+        :return: array of shape (n_samples, min(n_timesteps, timesteps), n_outputdim), or
+        (n_members, n_samples, min(n_timesteps, timesteps), n_outputdim) with per_member
+        '''
+        if input_data is None:
+            input_data = d_utils.encode_observations(actions, outcomes, self.model_dict["n_outputdim"], dtype=np.float32)
+        n_samples, n_timesteps, n_inputdim = input_data.shape
+        assert(n_inputdim == self.model_dict["n_inputdim"]), "input dimension of data doesn't match the model."
+        n_timesteps = min(n_timesteps, self.timesteps)
+        preds = np.empty((self.n_members, n_samples, n_timesteps, self.model_dict["n_outputdim"]), dtype=np.float32)
+        states = None
+        for t in six.moves.range(n_timesteps):
+            preds[:, :, t, :], states = self.step(input_data[:, t, :], states, per_member=True)
+        if per_member:
+            return preds
+        return np.mean(preds, axis=0)
+
+    def get_timesteps(self):
+        return self.timesteps
@@ -0,0 +1,115 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests that the numpy inference engine reproduces DynamicsModel for every architecture.
+#===============================================================================
+# USAGE: python numpy_dynamics_model_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import six
+
+import dataset_utils as d_utils
+import dynamics_model_class as dmc
+import student as st
+
+from numpy_dynamics_model import NumpyDynamicsModel, NumpyEnsembleModel
+
+MODEL_IDS = ['test2_model_small', 'test2_modelsimple_small', 'test2_modelgru_small', 'test2_modelgrusimple_small']
+
+
+def _random_inputs(n_concepts, n_samples, n_timesteps):
+    actions = np.random.randint(n_concepts, size=(n_samples, n_timesteps))
+    outcomes = np.random.randint(2, size=(n_samples, n_timesteps))
+    return d_utils.encode_observations(actions, outcomes, n_concepts, dtype=np.float32)
+
+
+def test_predict_parity(timesteps=6, n_samples=50, tol=1e-5):
+    '''
+    Exports the freshly initialized weights through a checkpoint and compares predict on histories
+    shorter than, as long as and longer than the window, as well as step against the tf step graph.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for model_id in MODEL_IDS:
+            dmodel = dmc.DynamicsModel(model_id=model_id, timesteps=timesteps, load_checkpoint=False)
+            checkpoint = os.path.join(tmpdir, model_id)
+            dmodel.save(checkpoint)
+            npmodel = NumpyDynamicsModel.from_checkpoint(model_id, checkpoint, timesteps=timesteps)
+            npz_path = os.path.join(tmpdir, model_id + '.npz')
+            npmodel.save(npz_path)
+            npmodel = NumpyDynamicsModel.load(npz_path, timesteps=timesteps)
+
+            n_concepts = dmodel.model_dict['n_outputdim']
+            for n_timesteps in (1, timesteps - 2, timesteps, timesteps + 2):
+                input_data = _random_inputs(n_concepts, n_samples, n_timesteps)
+                expected = np.array(dmodel.predict(input_data))
+                assert expected.shape == (n_samples, min(n_timesteps, timesteps), n_concepts)
+                assert np.max(np.abs(npmodel.predict(input_data) - expected)) < tol, model_id
+
+            input_data = _random_inputs(n_concepts, n_samples, timesteps)
+            tf_states = np_states = None
+            for t in six.moves.range(timesteps):
+                tf_pred, tf_states = dmodel.step(input_data[:, t, :], tf_states)
+                np_pred, np_states = npmodel.step(input_data[:, t, :], np_states)
+                assert np.max(np.abs(np_pred - tf_pred)) < tol, model_id
+                for tf_state, np_state in six.moves.zip(tf_states, np_states):
+                    assert np.max(np.abs(np_state - tf_state)) < tol, model_id
+
+            # weights read from the live model are the same as the ones from the checkpoint
+            live = NumpyDynamicsModel.from_model(dmodel)
+            for key in npmodel.weights:
+                assert np.array_equal(live.weights[key], npmodel.weights[key]), model_id
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_rnn_student_sim_backend(timesteps=4, n_steps=7):
+    '''
+    RnnStudentSim gives the same predictions with either backend, including after the window slides.
+    '''
+    model_id = MODEL_IDS[-1]
+    dmodel = dmc.DynamicsModel(model_id=model_id, timesteps=timesteps, load_checkpoint=False)
+    npmodel = NumpyDynamicsModel.from_model(dmodel)
+    n_concepts = dmodel.model_dict['n_outputdim']
+
+    tf_sim = dmc.RnnStudentSim(dmodel)
+    np_sim = dmc.RnnStudentSim(npmodel)
+    for _ in six.moves.range(n_steps):
+        action = st.make_student_action(n_concepts, np.random.randint(n_concepts))
+        ob = np.random.randint(2)
+        tf_sim.advance_simulator(action, ob)
+        np_sim.advance_simulator(action, ob)
+        assert np.max(np.abs(np_sim.sample_observations() - tf_sim.sample_observations())) < 1e-5
+
+
+def test_ensemble_matches_members(timesteps=5, n_members=3, n_samples=20):
+    '''
+    The stacked ensemble predicts the mean of its members, for every architecture.
+    '''
+    for model_id in MODEL_IDS:
+        members = [NumpyDynamicsModel.from_model(dmc.DynamicsModel(model_id=model_id, timesteps=timesteps, load_checkpoint=False))
+                   for _ in six.moves.range(n_members)]
+        ensemble = NumpyEnsembleModel.from_models(members)
+        n_concepts = members[0].model_dict['n_outputdim']
+        input_data = _random_inputs(n_concepts, n_samples, timesteps - 1)
+
+        member_preds = np.array([m.predict(input_data) for m in members])
+        assert np.allclose(ensemble.predict(input_data, per_member=True), member_preds, atol=1e-6), model_id
+        assert np.allclose(ensemble.predict(input_data), np.mean(member_preds, axis=0), atol=1e-6), model_id
+
+        sim = dmc.RnnStudentSim(ensemble)
+        for t in six.moves.range(timesteps - 1):
+            sim.advance_simulator(st.make_student_action(n_concepts, np.argmax(input_data[0, t]) % n_concepts),
+                                  int(np.argmax(input_data[0, t]) < n_concepts))
+            assert np.allclose(sim.sample_observations(), np.mean(member_preds[:, 0, t], axis=0), atol=1e-6), model_id
+
+
+if __name__ == '__main__':
+    test_predict_parity()
+    test_rnn_student_sim_backend()
+    test_ensemble_matches_members()
+    six.print_('All tests passed.')
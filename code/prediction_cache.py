@@ -0,0 +1,117 @@
+# prediction_cache.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Bounded LRU cache for the predictions of the DKT models, keyed by compact
+# integer history keys (see helpers.history_key_append). Replaces the plain
+# dicts the experiment drivers used to share, which grew without bound.
+# Keeps hit/miss/eviction counters so the effect of the cache can be checked.
+# PredictionCacheManager serves one cache to several processes, like
+# dynamics_model_class.DMCManager does for models.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from prediction_cache import PredictionCache
+#   cache = PredictionCache(max_bytes=2**28)
+#   probs = cache.get(key)  /  cache.put(key, probs)  /  cache.stats()
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+# rough per entry cost of the ordered dict itself, on top of key and value
+ENTRY_OVERHEAD_BYTES = 100
+
+
+def _entry_nbytes(key, value):
+    return sys.getsizeof(key) + np.asarray(value).nbytes + ENTRY_OVERHEAD_BYTES
+
+
+class PredictionCache(object):
+    '''
+    LRU cache of model predictions, bounded by number of entries and/or (approximate) memory.
+    Thread safe, and can be shared across processes through PredictionCacheManager.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        '''
+        :param max_entries: the maximal number of cached predictions, None for no limit
+        :param max_bytes: the maximal approximate memory used by the cache, None for no limit
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''
+        :return: the cached prediction for key, or default. A hit makes the entry the most recently used.
+        '''
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        '''
+        Caches value for key, evicting the least recently used entries over the limits.
+        '''
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= _entry_nbytes(key, old)
+            self._entries[key] = value
+            self.nbytes += _entry_nbytes(key, value)
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                     (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                old_key, old_value = self._entries.popitem(last=False)
+                self.nbytes -= _entry_nbytes(old_key, old_value)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        :return: dict with the hits, misses, evictions, hit rate, number of entries and approximate size in bytes
+        '''
+        with self._lock:
+            queries = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / queries if queries else 0.0,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+            }
+
+
+class PredictionCacheManager(BaseManager):
+    '''
+    Allows to share a PredictionCache between processes.
+    '''
+    pass
+
+PredictionCacheManager.register('PredictionCache', PredictionCache)
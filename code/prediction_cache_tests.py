@@ -0,0 +1,109 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests for the bounded LRU cache of DKT predictions and the compact history keys.
+#===============================================================================
+# USAGE: python prediction_cache_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import numpy as np
+import six
+
+import concept_dependency_graph as cdg
+import student_sim as ssim
+import student as st
+from helpers import action_ob_encode, history_key_append
+from prediction_cache import PredictionCache, PredictionCacheManager
+from random_dynamics_model import MODEL_DICT, make_random_model
+
+
+def test_lru_eviction(n_concepts=4):
+    cache = PredictionCache(max_entries=3)
+    for key in six.moves.range(3):
+        cache.put(key, np.full((n_concepts,), key, dtype=np.float32))
+    # touch 0 so that 1 is the least recently used
+    assert cache.get(0)[0] == 0
+    cache.put(3, np.zeros((n_concepts,)))
+    assert 1 not in cache and 0 in cache and 3 in cache
+    assert cache.get(1) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (1, 1, 1, 3)
+    assert stats['hit_rate'] == 0.5
+
+
+def test_memory_limit(n_concepts=4, n_entries=1000):
+    cache = PredictionCache(max_bytes=20000)
+    for key in six.moves.range(n_entries):
+        cache.put(key, np.random.rand(n_concepts))
+        assert cache.nbytes <= 20000
+    assert cache.stats()['evictions'] == n_entries - len(cache)
+    # the most recent entries survive
+    assert n_entries - 1 in cache
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_history_keys_unique(n_concepts=3, horizon=3, window=2):
+    '''
+    Every history up to the horizon gets its own key, and the key modulo base**window is the key of the window.
+    '''
+    base = 2 * n_concepts + 1
+    branches = [action_ob_encode(n_concepts, a, ob) for a in six.moves.range(n_concepts) for ob in (0, 1)]
+    keys = {}
+    for length in six.moves.range(horizon + 1):
+        for history in itertools.product(branches, repeat=length):
+            key = 0
+            for branch in history:
+                key = history_key_append(n_concepts, key, branch)
+            assert key not in keys
+            keys[key] = history
+    for key, history in six.iteritems(keys):
+        if len(history) >= window:
+            window_key = key % base ** window
+            assert keys[window_key] == history[-window:]
+
+
+def test_student_dkt_sim_cache(n_trajectories=20, horizon=10):
+    '''
+    The StudentDKTSim answers from its cache like the model, also past the window of the model.
+    '''
+    n_concepts = MODEL_DICT['n_outputdim']
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    model = make_random_model()
+    cache = PredictionCache(max_entries=10000)
+    rng = np.random.RandomState(0)
+    for _ in six.moves.range(n_trajectories):
+        sim = st.StudentDKTSim(dgraph, model, cache)
+        uncached = ssim.RnnStudentSim(model)
+        for _ in six.moves.range(horizon):
+            concept = rng.randint(n_concepts)
+            action = st.StudentAction(concept, np.eye(n_concepts, dtype=int)[concept])
+            ob, _ = sim.advance_simulator(action)
+            uncached.advance_simulator(action, ob)
+            assert np.allclose(sim.get_probs(), uncached.sample_observations())
+            assert np.allclose(st.StudentDKTSim.get_probs_batch([sim.copy()])[0], sim.get_probs())
+    assert cache.stats()['hits'] > 0
+
+
+def test_shared_across_processes():
+    manager = PredictionCacheManager()
+    manager.start()
+    try:
+        cache = manager.PredictionCache(max_entries=10)
+        cache.put(5, np.ones((2,)))
+        assert np.array_equal(cache.get(5), np.ones((2,)))
+        assert cache.get(6) is None
+        assert cache.stats()['hits'] == 1
+    finally:
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    test_lru_eviction()
+    test_memory_limit()
+    test_history_keys_unique()
+    test_student_dkt_sim_cache()
+    test_shared_across_processes()
+    six.print_('All tests passed.')
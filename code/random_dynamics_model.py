@@ -0,0 +1,36 @@
+#===============================================================================
+# DESCRIPTION:
+# Small numpy dynamics models with random weights, shared by the tests that
+# need a model but not a trained checkpoint or tensorflow.
+#===============================================================================
+# USAGE: from random_dynamics_model import MODEL_DICT, TIMESTEPS, make_random_model
+#   model = make_random_model(seed)
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import six
+
+import numpy_dynamics_model as ndm
+
+MODEL_DICT = {'architecture': 'grusimple', 'n_hidden': 5, 'n_inputdim': 8, 'n_outputdim': 4}
+TIMESTEPS = 6
+
+
+def make_random_model(seed=0):
+    '''
+    A grusimple NumpyDynamicsModel of MODEL_DICT with random weights and a window of TIMESTEPS.
+    :param seed: seed of the weights, the same seed gives the same model
+    '''
+    rng = np.random.RandomState(seed)
+    n_in, n_hidden, n_out = MODEL_DICT['n_inputdim'], MODEL_DICT['n_hidden'], MODEL_DICT['n_outputdim']
+    weights = {
+        'gru_1/gates_W': rng.randn(n_in + n_hidden, 2 * n_hidden),
+        'gru_1/gates_b': rng.randn(2 * n_hidden),
+        'gru_1/candidate_W': rng.randn(n_in + n_hidden, n_hidden),
+        'gru_1/candidate_b': rng.randn(n_hidden),
+        'output_shared/W': rng.randn(n_hidden, n_out),
+        'output_shared/b': rng.randn(n_out),
+    }
+    weights = dict((key, value.astype(np.float32)) for key, value in six.iteritems(weights))
+    return ndm.NumpyDynamicsModel(MODEL_DICT, weights, timesteps=TIMESTEPS)
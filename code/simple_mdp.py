@@ -18,6 +18,7 @@ import six
 from concept_dependency_graph import *
 from data_generator import *
 from student import Student, Student2
+from trajectory_dataset import TrajectoryDataset
 import itertools
 
 class SimpleMDP(object):
@@ -26,20 +27,11 @@ class SimpleMDP(object):
     
     def _k2i(self, knowledge):
         # converts a knowledge numpy array to a state index
-        ix = 0
-        acc = 1
-        for i in six.moves.range(self.n_concepts):
-            ix += acc * knowledge[i]
-            acc *= 2
-        return int(ix)
+        return knowledge_to_mask(knowledge[:self.n_concepts])
     
     def _i2k(self, ix):
         # converts a state index to a knowledge numpy array
-        knowledge = np.zeros((self.n_concepts,))
-        for i in six.moves.range(self.n_concepts):
-            knowledge[i] = ix % 2
-            ix //= 2
-        return knowledge
+        return mask_to_knowledge(ix, self.n_concepts)
     
     def _a2i(self, conceptvec):
         # gets the index of a conceptvec
@@ -51,9 +43,12 @@ class SimpleMDP(object):
     
     def train(self, data):
         '''
-        :param data: this is the output from generate_data
+        :param data: this is the output from generate_data, or a TrajectoryDataset
         '''
-        self.n_concepts = data[0][0][2].shape[0]
+        if isinstance(data, TrajectoryDataset):
+            self.n_concepts = data.n_concepts
+        else:
+            self.n_concepts = data[0][0][2].shape[0]
         self.n_states = 2**self.n_concepts
         # transition_count[state][action][state] = count
         # visit_count[state][action] = count
@@ -62,18 +57,27 @@ class SimpleMDP(object):
         # reward will be based on the knowledge state
         
         # now let's go through the data and accumulate the stats
-        for i in six.moves.range(len(data)):
-            # each trajectory
+        if isinstance(data, TrajectoryDataset):
+            # state index of the knowledge after every step
+            next_s = data.knowledge().dot(1 << np.arange(self.n_concepts))
             # assume students start with concept 0 learned
-            curr_s = 1
-            for t in six.moves.range(len(data[i])):
-                # each timestep and next timestep
-                curr_a = self._a2i(data[i][t][0])
-                next_s = self._k2i(data[i][t][2])
-                self.transition_count[curr_s,curr_a,next_s] += 1
-                self.visit_count[curr_s,curr_a] += 1
-                # update state tracking
-                curr_s = next_s
+            curr_s = np.hstack([np.ones((len(data), 1), dtype=next_s.dtype), next_s[:, :-1]])
+            curr_a = np.asarray(data.actions, dtype=int)
+            np.add.at(self.transition_count, (curr_s, curr_a, next_s), 1)
+            np.add.at(self.visit_count, (curr_s, curr_a), 1)
+        else:
+            for i in six.moves.range(len(data)):
+                # each trajectory
+                # assume students start with concept 0 learned
+                curr_s = 1
+                for t in six.moves.range(len(data[i])):
+                    # each timestep and next timestep
+                    curr_a = self._a2i(data[i][t][0])
+                    next_s = self._k2i(data[i][t][2])
+                    self.transition_count[curr_s,curr_a,next_s] += 1
+                    self.visit_count[curr_s,curr_a] += 1
+                    # update state tracking
+                    curr_s = next_s
         
         # make the transition matrix
         self.transition = np.zeros((self.n_states, self.n_concepts, self.n_states))
@@ -114,20 +118,11 @@ class SimpleFMDP(object):
     
     def _b2i(self, knowledge):
         # converts a binary numpy array to a state index
-        ix = 0
-        acc = 1
-        for i in six.moves.range(knowledge.shape[0]):
-            ix += acc * knowledge[i]
-            acc *= 2
-        return int(ix)
+        return knowledge_to_mask(knowledge)
     
     def _i2b(self, ix):
         # converts a state index to a binary numpy array
-        state = np.zeros((self.n_features,))
-        for i in six.moves.range(self.n_features):
-            state[i] = ix % 2
-            ix //= 2
-        return state
+        return mask_to_knowledge(ix, self.n_features)
     
     def _a2i(self, conceptvec):
         # gets the index of a conceptvec
@@ -262,19 +257,7 @@ def create_custom_dependency():
               3       4
     '''
     dgraph = ConceptDependencyGraph()
-    dgraph.n = 5
-    dgraph.root = 0
-    
-    dgraph.children[0] = [1,2]
-    dgraph.children[1] = [3]
-    dgraph.children[2] = [4]
-    
-    dgraph.parents[4] = [2]
-    dgraph.parents[3] = [1]
-    dgraph.parents[2] = [0]
-    dgraph.parents[1] = [0]
-    
-    dgraph._create_prereq_map()
+    dgraph.init_from_edges(5, [(0,1), (0,2), (1,3), (2,4)])
     #print(dgraph.prereq_map)
     
     return dgraph
@@ -284,6 +267,8 @@ def expected_reward(data):
     :param data: output from generate_data
     :return: the sample mean of the posttest reward
     '''
+    if isinstance(data, TrajectoryDataset):
+        return float(np.mean(data.final_knowledge()))
     avg = 0.0
     for i in six.moves.range(len(data)):
         avg += np.mean(data[i][-1][2])
@@ -294,6 +279,8 @@ def expected_sparse_reward(data):
     :param data: output from generate_data
     :return: the sample mean of the sparse reward
     '''
+    if isinstance(data, TrajectoryDataset):
+        return float(np.mean(np.all(data.final_knowledge(), axis=1)))
     avg = 0.0
     for i in six.moves.range(len(data)):
         avg += np.prod(data[i][-1][2])
@@ -304,6 +291,8 @@ def percent_complete(data):
     :param data: output from generate_data
     :return: the percentage of trajectories with perfect posttest
     '''
+    if isinstance(data, TrajectoryDataset):
+        return float(np.mean(np.all(data.final_knowledge(), axis=1)))
     count = 0.0
     for i in six.moves.range(len(data)):
         if int(np.sum(data[i][-1][2])) == data[i][-1][2].shape[0]:
@@ -314,6 +303,11 @@ def percent_all_seen(data):
     '''
     Return the percentage of trajectories where all skills other than skill 0 have been tested
     '''
+    if isinstance(data, TrajectoryDataset):
+        seen = np.zeros((len(data), data.n_concepts), dtype=bool)
+        seen[:, 0] = True
+        seen[np.arange(len(data))[:, np.newaxis], np.asarray(data.actions, dtype=int)] = True
+        return float(np.mean(np.all(seen, axis=1)))
     count = 0.0
     for i in six.moves.range(len(data)):
         seen = data[i][0][0].astype(np.int)
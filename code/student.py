@@ -29,11 +29,17 @@ import six
 
 # Custom Modules
 from constants import *
+import concept_dependency_graph as cdg
 
-import dynamics_model_class as dmc
+import student_sim as ssim
 
 
 class Student(object):
+    '''
+    Knowledge is stored as an integer bitmask (bit c set iff concept c is learned), so prerequisite
+    checks are a single AND/compare and the state index is free. The knowledge array is a read-only
+    view on top of the bitmask; assign a new array or call learn() to change it.
+    '''
     def __init__(self, n=None, p_trans_satisfied=0.5, p_trans_not_satisfied=0.0, p_get_ex_correct_if_concepts_learned=1.0, initial_knowledge=0):
         self.p_trans_satisfied = p_trans_satisfied
         self.p_trans_not_satisfied = p_trans_not_satisfied
@@ -43,22 +49,45 @@ class Student(object):
             self.knowledge = initial_knowledge
         else:
             self.knowledge = np.zeros((n_concepts,))
-    
+
+    @property
+    def knowledge(self):
+        if self._knowledge is None:
+            self._knowledge = cdg.mask_to_knowledge(self.kmask, self.n_concepts)
+            self._knowledge.flags.writeable = False
+        return self._knowledge
+
+    @knowledge.setter
+    def knowledge(self, knowledge):
+        self.n_concepts = knowledge.shape[0]
+        self._set_kmask(cdg.knowledge_to_mask(knowledge))
+
+    def _set_kmask(self, kmask):
+        self.kmask = kmask
+        # invalidate the cached array view
+        self._knowledge = None
+
+    def learn(self, c):
+        '''
+        Marks concept c as learned.
+        '''
+        self._set_kmask(self.kmask | (1 << c))
+
     def reset(self):
         '''
         Reset to initial condition so that we can start simulating from the beginning again.
         '''
-        self.knowledge = np.zeros(self.knowledge.shape[0])
+        self._set_kmask(0)
     
     def copy(self):
         '''
         Copies this generator.
         '''
-        new_student = Student()
+        new_student = Student(n=self.n_concepts)
         new_student.p_trans_satisfied = self.p_trans_satisfied
         new_student.p_trans_not_satisfied = self.p_trans_not_satisfied
         new_student.p_get_ex_correct_if_concepts_learned = self.p_get_ex_correct_if_concepts_learned
-        new_student.knowledge = np.copy(self.knowledge)
+        new_student._set_kmask(self.kmask)
         return new_student
     
     def get_state(self):
@@ -73,14 +102,16 @@ class Student(object):
         :param ex: a StudentAction object.
         :return: Returns 1 if student solved it correctly, 0 otherwise.
         '''
-        # if self._fulfilled_prereqs(ex.concepts):
-        if self.fulfilled_prereqs(concept_tree, ex.conceptvec):
+        ex_mask = cdg.knowledge_to_mask(ex.conceptvec)
+        if self.fulfilled_prereqs_mask(concept_tree, ex_mask):
             # print("P trans satisfied_{}".format(self.p_trans_satisfied))
-            for c in xrange(len(ex.conceptvec)):
-                if ex.conceptvec[c] == 1 and np.random.random() <= self.p_trans_satisfied:
+            kmask = self.kmask
+            for c in cdg.iter_mask_bits(ex_mask):
+                if np.random.random() <= self.p_trans_satisfied:
                     # update latent knowledge state
-                    self.knowledge[c] = 1
-            if self.learned_all_concepts_in_ex(ex.conceptvec) and np.random.random() <= self.p_get_ex_correct_if_concepts_learned:
+                    kmask |= 1 << c
+            self._set_kmask(kmask)
+            if kmask & ex_mask == ex_mask and np.random.random() <= self.p_get_ex_correct_if_concepts_learned:
                 return 1
             else:
                 return 0
@@ -94,23 +125,151 @@ class Student(object):
         if prereqs for at least one concept are not fulfilled, then function returns False.
         :return: bool
         '''
-        for i in xrange(len(concepts)):
-            c = concepts[i]
-            if c == 1:
-                prereqs = concept_tree.get_prereqs(i)
-                if np.sum(np.multiply(self.knowledge, prereqs)) != np.sum(prereqs):
-                    return False
-        return True
+        return self.fulfilled_prereqs_mask(concept_tree, cdg.knowledge_to_mask(concepts))
 
-    def learned_all_concepts_in_ex(self, concepts):
-        for c in xrange(len(concepts)):
-            if concepts[c] == 1 and self.knowledge[c] == 0:
+    def fulfilled_prereqs_mask(self, concept_tree, ex_mask):
+        '''
+        Same as fulfilled_prereqs, with the concepts of the exercise given as a bitmask.
+        '''
+        for c in cdg.iter_mask_bits(ex_mask):
+            if not concept_tree.fulfilled_prereqs_mask(self.kmask, c):
                 return False
         return True
 
+    def learned_all_concepts_in_ex(self, concepts):
+        ex_mask = cdg.knowledge_to_mask(concepts)
+        return self.kmask & ex_mask == ex_mask
+
     # END OF class Student
 
 
+def fulfilled_prereqs_batch(concept_tree, knowledge, concepts):
+    '''
+    Vectorized prerequisite check for a whole cohort.
+    :param knowledge: array of shape (n_students, n_concepts)
+    :param concepts: int array of shape (n_students,), the concept each student practices
+    :return: bool array of shape (n_students,)
+    '''
+    prereqs = concept_tree.get_prereq_matrix()[concepts]
+    return np.all(knowledge >= prereqs, axis=1)
+
+
+def learnable_concepts_batch(concept_tree, knowledge):
+    '''
+    For every student and concept, whether the concept is not learned yet but all its prereqs are.
+    :param knowledge: array of shape (n_students, n_concepts)
+    :return: bool array of shape (n_students, n_concepts)
+    '''
+    prereq_matrix = concept_tree.get_prereq_matrix()
+    # knowledge is binary, so the prereqs of c are fulfilled iff all of them are counted
+    fulfilled = np.dot(knowledge, prereq_matrix.T) == np.sum(prereq_matrix, axis=1)
+    return fulfilled & (knowledge == 0)
+
+
+class CohortPrereqs(object):
+    '''
+    Learnability of every concept for every student of a cohort, maintained incrementally.
+    missing[s, c] counts the prerequisites of c that student s has not learned. Learning a concept
+    only decrements the counts of the concepts depending on it, so the prerequisite checks and the
+    learnable concepts cost nothing per step, and O(n_concepts) per learned concept.
+    '''
+    def __init__(self, concept_tree, knowledge):
+        self.concept_tree = concept_tree
+        self.prereq_matrix = concept_tree.get_prereq_matrix()
+        self.missing = np.dot((knowledge < 0.5).astype(int), self.prereq_matrix.T)
+        self.learnable = (self.missing == 0) & (knowledge < 0.5)
+
+    def fulfilled(self, rows, concepts):
+        '''
+        :return: bool array, whether the prereqs of concepts[i] are fulfilled for student rows[i]
+        '''
+        return self.missing[rows, concepts] == 0
+
+    def learned(self, knowledge, rows, concepts):
+        '''
+        Updates the counts after student rows[i] learned the new concept concepts[i], every row at most once.
+        :param knowledge: the knowledge of the cohort, already updated
+        '''
+        dependents = self.prereq_matrix[:, concepts].T
+        self.missing[rows] -= dependents
+        self.learnable[rows, concepts] = False
+        # only the dependents of the learned concepts can have become learnable
+        self.learnable[rows] |= (dependents > 0) & (self.missing[rows] == 0) & (knowledge[rows] < 0.5)
+
+
+def _cohort_prereqs(cohort, concept_tree):
+    '''
+    The CohortPrereqs of the cohort for concept_tree, built from its knowledge when first needed.
+    '''
+    if cohort._prereqs is None or cohort._prereqs.concept_tree is not concept_tree:
+        cohort._prereqs = CohortPrereqs(concept_tree, cohort.knowledge)
+    return cohort._prereqs
+
+
+class StudentCohort(object):
+    '''
+    Vectorized version of Student which simulates n_students independent students at once.
+    Knowledge is kept as an (n_students, n_concepts) array, so one exercise step for the
+    whole cohort is a handful of array operations instead of a python loop per student.
+    The prerequisites are tracked by a CohortPrereqs, so change knowledge only through reset and do_exercise.
+    '''
+    def __init__(self, n_students, n_concepts, p_trans_satisfied=0.5, p_trans_not_satisfied=0.0, p_get_ex_correct_if_concepts_learned=1.0, rng=None):
+        '''
+        :param rng: np.random.RandomState to draw from, or None to use the global numpy stream
+        '''
+        self.n_students = n_students
+        self.rng = rng if rng is not None else np.random
+        self.p_trans_satisfied = p_trans_satisfied
+        self.p_trans_not_satisfied = p_trans_not_satisfied
+        self.p_get_ex_correct_if_concepts_learned = p_get_ex_correct_if_concepts_learned
+        self.knowledge = np.zeros((n_students, n_concepts))
+        self._prereqs = None
+
+    def reset(self, initial_knowledge=None):
+        '''
+        Reset all students to the initial condition.
+        :param initial_knowledge: knowledge vector of shape (n_concepts,) shared by all students, or None for all zeros
+        '''
+        self.knowledge = np.zeros(self.knowledge.shape)
+        if initial_knowledge is not None:
+            self.knowledge[:, :] = initial_knowledge
+        self._prereqs = None
+
+    def learnable_concepts(self, concept_tree):
+        '''
+        Same as learnable_concepts_batch(concept_tree, self.knowledge), without recomputing it.
+        :return: bool array of shape (n_students, n_concepts), shared, don't modify it
+        '''
+        return _cohort_prereqs(self, concept_tree).learnable
+
+    def get_state(self):
+        '''
+        Return the MDP states of all students, shape (n_students, n_concepts)
+        '''
+        return self.knowledge.astype(int)
+
+    def do_exercise(self, concept_tree, concepts):
+        '''
+        Simulates every student solving the exercise for its given concept.
+        Same semantics as Student.do_exercise with a one-hot exercise.
+        :param concepts: int array of shape (n_students,)
+        :return: int array of shape (n_students,), 1 where the student solved it correctly
+        '''
+        rows = np.arange(self.n_students)
+        prereqs = _cohort_prereqs(self, concept_tree)
+        fulfilled = prereqs.fulfilled(rows, concepts)
+        learn = fulfilled & (self.rng.random_sample(self.n_students) <= self.p_trans_satisfied)
+        learn &= self.knowledge[rows, concepts] == 0
+        self.knowledge[rows[learn], concepts[learn]] = 1
+        prereqs.learned(self.knowledge, rows[learn], concepts[learn])
+        learned = self.knowledge[rows, concepts] == 1
+        correct = fulfilled & learned & (self.rng.random_sample(self.n_students) <= self.p_get_ex_correct_if_concepts_learned)
+        guessed = ~fulfilled & (self.rng.random_sample(self.n_students) <= self.p_trans_not_satisfied)
+        return (correct | guessed).astype(int)
+
+    # END OF class StudentCohort
+
+
 class Student2(object):
     '''
     Special Deterministic Student to facilitate testing. Should be easier to learn than probabilistic student.
@@ -120,24 +279,59 @@ class Student2(object):
     
     Can either transition before the observation or after the observation.
     This means either the second try is always a pass, or it's a fail and the 3rd try is a pass.
+
+    Like Student, knowledge and visited are stored as bitmasks with read-only array views on top.
     '''
     def __init__(self, n_concepts, transition_after):
         self.knowledge = np.zeros((n_concepts,))
         self.visited = np.zeros((n_concepts,),dtype=np.int)
         self.transition_after = transition_after
 
+    @property
+    def knowledge(self):
+        if self._knowledge is None:
+            self._knowledge = cdg.mask_to_knowledge(self.kmask, self.n_concepts)
+            self._knowledge.flags.writeable = False
+        return self._knowledge
+
+    @knowledge.setter
+    def knowledge(self, knowledge):
+        self.n_concepts = knowledge.shape[0]
+        self._set_masks(cdg.knowledge_to_mask(knowledge), getattr(self, 'vmask', 0))
+
+    @property
+    def visited(self):
+        if self._visited is None:
+            self._visited = cdg.mask_to_knowledge(self.vmask, self.n_concepts).astype(np.int)
+            self._visited.flags.writeable = False
+        return self._visited
+
+    @visited.setter
+    def visited(self, visited):
+        self._set_masks(self.kmask, cdg.knowledge_to_mask(visited))
+
+    def _set_masks(self, kmask, vmask):
+        self.kmask = kmask
+        self.vmask = vmask
+        # invalidate the cached array views
+        self._knowledge = None
+        self._visited = None
+
+    def learn(self, c):
+        '''
+        Marks concept c as learned.
+        '''
+        self._set_masks(self.kmask | (1 << c), self.vmask)
+
     def reset(self):
-        self.knowledge = np.zeros(self.knowledge.shape)
-        self.visited = np.zeros(self.knowledge.shape,dtype=np.int)
+        self._set_masks(0, 0)
 
     def copy(self):
         '''
         Copies this generator.
         '''
-        new_student = Student2(1, False)
-        new_student.knowledge = np.copy(self.knowledge)
-        new_student.visited = np.copy(self.visited)
-        new_student.transition_after = self.transition_after
+        new_student = Student2(self.n_concepts, self.transition_after)
+        new_student._set_masks(self.kmask, self.vmask)
         return new_student
     
     def get_state(self):
@@ -152,17 +346,19 @@ class Student2(object):
         This can be called before, or after the observation.
         '''
         if self.fulfilled_prereqs(concept_tree, c):
-            if self.visited[c] >= 1:
+            bit = 1 << c
+            kmask = self.kmask
+            if self.vmask & bit:
                 # if yes, then this is second time visited so yes mastery
-                self.knowledge[c] = 1
+                kmask |= bit
             # concept has been visited
-            self.visited[c] = 1
+            self._set_masks(kmask, self.vmask | bit)
     
     def try_exercise(self, concept_tree, concept):
         '''
         Get an observation of whether the student gets the question correct without updating the knowledge.
         '''
-        return self.knowledge[concept] > 0.99
+        return (self.kmask >> concept) & 1 == 1
     
     def do_exercise(self, concept_tree, ex):
         '''
@@ -186,9 +382,7 @@ class Student2(object):
         if prereqs for at least one concept are not fulfilled, then function returns False.
         :return: bool
         '''
-        prereqs = concept_tree.get_prereqs(c)
-        return np.all(self.knowledge >= prereqs)
-        #return np.sum(np.multiply(self.knowledge, prereqs)) == np.sum(prereqs)
+        return concept_tree.fulfilled_prereqs_mask(self.kmask, c)
 
     def _learned_all_concepts_in_ex(self, concepts):
         '''
@@ -198,6 +392,103 @@ class Student2(object):
 
     # END OF class Student2
 
+
+class Student2Cohort(object):
+    '''
+    Vectorized version of Student2 which simulates n_students independent students at once.
+    knowledge and visited are kept as (n_students, n_concepts) arrays, and the prerequisites by a CohortPrereqs.
+    Supports both transitioning before and after the observation, with the same two-try semantics as Student2.
+    '''
+    def __init__(self, n_students, n_concepts, transition_after, rng=None):
+        '''
+        :param rng: unused since Student2 is deterministic, kept for the same interface as StudentCohort
+        '''
+        self.n_students = n_students
+        self.rng = rng if rng is not None else np.random
+        self.knowledge = np.zeros((n_students, n_concepts))
+        self.visited = np.zeros((n_students, n_concepts), dtype=int)
+        self.transition_after = transition_after
+        self._prereqs = None
+
+    def reset(self, initial_knowledge=None):
+        '''
+        Reset all students to the initial condition.
+        :param initial_knowledge: knowledge vector of shape (n_concepts,) shared by all students, or None for all zeros
+        '''
+        self.knowledge = np.zeros(self.knowledge.shape)
+        self.visited = np.zeros(self.knowledge.shape, dtype=int)
+        if initial_knowledge is not None:
+            self.knowledge[:, :] = initial_knowledge
+        self._prereqs = None
+
+    def learnable_concepts(self, concept_tree):
+        '''
+        Same as learnable_concepts_batch(concept_tree, self.knowledge), without recomputing it.
+        :return: bool array of shape (n_students, n_concepts), shared, don't modify it
+        '''
+        return _cohort_prereqs(self, concept_tree).learnable
+
+    def get_state(self):
+        '''
+        Return the MDP states of all students, shape (n_students, 2*n_concepts)
+        '''
+        return np.concatenate((self.knowledge, self.visited), axis=1).astype(int)
+
+    def update_knowledge(self, concept_tree, concepts):
+        '''
+        Half of an update for every student, see Student2.update_knowledge.
+        :param concepts: int array of shape (n_students,)
+        '''
+        rows = np.arange(self.n_students)
+        prereqs = _cohort_prereqs(self, concept_tree)
+        fulfilled = prereqs.fulfilled(rows, concepts)
+        # second visit with fulfilled prereqs means mastery
+        mastered = fulfilled & (self.visited[rows, concepts] >= 1) & (self.knowledge[rows, concepts] == 0)
+        self.knowledge[rows[mastered], concepts[mastered]] = 1
+        prereqs.learned(self.knowledge, rows[mastered], concepts[mastered])
+        self.visited[rows[fulfilled], concepts[fulfilled]] = 1
+
+    def try_exercise(self, concept_tree, concepts):
+        '''
+        Get the observations of all students without updating the knowledge.
+        '''
+        return self.knowledge[np.arange(self.n_students), concepts] > 0.99
+
+    def do_exercise(self, concept_tree, concepts):
+        '''
+        Simulates every student solving the exercise for its given concept.
+        :param concepts: int array of shape (n_students,)
+        :return: int array of shape (n_students,), 1 where the student solved it correctly
+        '''
+        if not self.transition_after:
+            self.update_knowledge(concept_tree, concepts)
+            ob = self.try_exercise(concept_tree, concepts)
+        else:
+            ob = self.try_exercise(concept_tree, concepts)
+            self.update_knowledge(concept_tree, concepts)
+        return ob.astype(int)
+
+    # END OF class Student2Cohort
+
+
+def make_student_cohort(student, n_students, n_concepts, rng=None):
+    '''
+    Creates the vectorized cohort simulator with the same parameters as the given student.
+    :param student: a Student or Student2 object
+    :param rng: np.random.RandomState for the cohort to draw from, or None to use the global numpy stream
+    :return: a StudentCohort or Student2Cohort, or None if there is no vectorized version of the student
+    '''
+    if type(student) is Student:
+        return StudentCohort(n_students, n_concepts,
+                             p_trans_satisfied=student.p_trans_satisfied,
+                             p_trans_not_satisfied=student.p_trans_not_satisfied,
+                             p_get_ex_correct_if_concepts_learned=student.p_get_ex_correct_if_concepts_learned,
+                             rng=rng)
+    elif type(student) is Student2:
+        return Student2Cohort(n_students, n_concepts, student.transition_after, rng=rng)
+    return None
+
+
 class StudentAction(object):
     '''
     Represents an action of the tutor, i.e. a problem to give to the student.
@@ -231,6 +522,20 @@ class StudentExactSim(object):
     def __init__(self, student, dgraph):
         self.student = student
         self.dgraph = dgraph
+        self._frontier = cdg.ConceptFrontier(dgraph, student.kmask)
+
+    @property
+    def frontier(self):
+        '''
+        The cdg.ConceptFrontier of the student, e.g. for helpers.compute_optimal_actions.
+        '''
+        kmask = self.student.kmask
+        if kmask & self._frontier.kmask != self._frontier.kmask:
+            # the student was reset
+            self._frontier.reset(kmask)
+        else:
+            self._frontier.update(kmask)
+        return self._frontier
 
     def advance_simulator(self, action):
         '''
@@ -250,8 +555,10 @@ class StudentExactSim(object):
         '''
         Make a copy of the current simulator.
         '''
-        new_student = self.student.copy()
-        new_copy = StudentExactSim(new_student, self.dgraph)
+        new_copy = StudentExactSim.__new__(StudentExactSim)
+        new_copy.student = self.student.copy()
+        new_copy.dgraph = self.dgraph
+        new_copy._frontier = self._frontier.copy()
         return new_copy
 
 class RnnStudent2SimExact(object):
@@ -263,7 +570,7 @@ class RnnStudent2SimExact(object):
     def __init__(self, dgraph):
         self.student = Student2(dgraph.n, True)
         # initial skill 0 to be known
-        self.student.knowledge[0] = 1.0
+        self.student.learn(0)
         
         self.dgraph = dgraph
 
@@ -297,32 +604,34 @@ class StudentDKTSim(object):
     A model-based simulator for a student. Maintains its own internal history. This wraps around a DKT, which is maintained in a separate process in order to not conflict with stuff in the current thread. Also uses a cache to help speed things up.
     '''
 
-    def __init__(self, dgraph, dmcmodel, dktcache, histhash=''):
+    def __init__(self, dgraph, dmcmodel, dktcache):
         '''
         Wraps around a given model (could be a proxy from a Manager or not)
+        :param dktcache: a prediction_cache.PredictionCache (or a proxy of one) shared by the copies,
+        used by the RnnStudentSim for the predictions of its history window
         '''
         self.dgraph = dgraph
-        self.dkt = dmc.RnnStudentSim(dmcmodel)
+        self.dkt = ssim.RnnStudentSim(dmcmodel, cache=dktcache)
         self.dktcache = dktcache
-        self.histhash = histhash
-    
-    def _next_histhash(self, new_act, new_ob):
-        return self.histhash + '{}{};'.format(new_act, new_ob)
 
     def get_probs(self):
-        # computes and caches the probs for the current state
-        # try the dktcache
-        trycache = self.dktcache.get(self.histhash, None)
-
-        if trycache is None:
-            # actually run it and update the cache
-            trycache = self.dkt.sample_observations()
-            if trycache is None:
-                trycache = np.array([0.0] * self.dgraph.n)
-                trycache[0] = 1.0
-                # cache back
-                self.dktcache[self.histhash] = trycache
-        return trycache
+        # computes the probs for the current state, or finds them in the dktcache
+        return self._default_probs(self.dkt.sample_observations())
+
+    def _default_probs(self, probs):
+        if probs is None:
+            probs = np.array([0.0] * self.dgraph.n)
+            probs[0] = 1.0
+        return probs
+
+    @staticmethod
+    def get_probs_batch(sims):
+        '''
+        get_probs for many simulators at once: the histories missing from the caches are
+        answered with one batched query of the DKT.
+        '''
+        preds = ssim.RnnStudentSim.sample_observations_batch([sim.dkt for sim in sims])
+        return [sim._default_probs(pred) for sim, pred in six.moves.zip(sims, preds)]
     
     def get_knowledge(self):
         return self.get_probs()
@@ -338,7 +647,6 @@ class StudentDKTSim(object):
         reward = np.sum(probs)
         ob = 1 if np.random.random() < probs[action.concept] else 0
         # advance the simulator
-        self.histhash = self._next_histhash(action.concept,ob)
         self.dkt.advance_simulator(action,ob)
         return (ob, reward)
 
@@ -346,6 +654,6 @@ class StudentDKTSim(object):
         '''
         Make a copy of the current simulator.
         '''
-        new_copy = StudentDKTSim(self.dgraph, self.dkt.model, self.dktcache, self.histhash)
+        new_copy = StudentDKTSim(self.dgraph, self.dkt.model, self.dktcache)
         new_copy.dkt = self.dkt.copy()
         return new_copy
\ No newline at end of file
@@ -0,0 +1,440 @@
+# student_sim.py
+# @author: Lisa Wang
+# @created: Apr 25 2017
+#
+#===============================================================================
+# DESCRIPTION:
+# Model-based student simulators used by the planners: RnnStudentSim queries
+# one dynamics model, RnnStudentSimEnsemble averages several, and
+# RnnStudentSimMemEnsemble / RnnStudentSimSparseMem look the predictions up in
+# memo tables. Nothing here imports tensorflow, so the simulators can run on
+# a NumpyDynamicsModel or an inference_server client in processes without it.
+# They are re-exported by dynamics_model_class.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: import student_sim as ssim
+#   dkt = ssim.RnnStudentSim(model)
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import six
+import numpy as np
+
+from helpers import *
+import dataset_utils as d_utils
+from memo_tables import quantize_mem_arrays, dequantize_probs, load_mem_arrays, SparseMemArrays
+
+
+class RnnStudentSim(object):
+    '''
+    A model-based simulator for a student. Maintains its own internal hidden state.
+    Currently model can be shared because only the history matters
+    '''
+
+    def __init__(self, model, cache=None):
+        '''
+        :param model: a DynamicsModel or anything with its predict/step interface
+        :param cache: optional prediction_cache.PredictionCache for the predictions of this model, shared by the copies
+        '''
+        self.model = model
+        self.cache = cache
+        self.seq_max_len = model.get_timesteps()
+        self.sequence = () # will store up to seq_max_len, immutable so that copies can share it
+        # compact key of the history in the window, see history_key_append
+        self.history_key = 0
+        # hidden state of the model after the first n_stepped inputs of the sequence and the last prediction,
+        # so a query only has to step through the inputs added since. None once the sequence window has slid,
+        # since the state of a window that dropped its first input cannot be derived incrementally.
+        self.state = None
+        self.n_stepped = 0
+        self.last_pred = None
+
+
+    def sample_observations(self):
+        """
+        Returns list of probabilities
+        """
+        # special case when self.sequence is empty
+        if not self.sequence:
+            return None
+        if self.cache is not None:
+            pred = self.cache.get(self.history_key)
+            if pred is None:
+                pred = self._sample_observations()
+                self.cache.put(self.history_key, pred)
+            return pred
+        return self._sample_observations()
+
+    def _sample_observations(self):
+        if self.n_stepped is None:
+            # turns the list of input vectors, into a numpy matrix of shape (1, n_timesteps, 2*n_concepts)
+            # We need the first dimension since the network expects a batch.
+            rnn_input_sequence = np.expand_dims(np.array(self.sequence), axis=0)
+            pred = self.model.predict(rnn_input_sequence)
+            t = len(self.sequence)
+
+            prob_success_action = pred[0][t-1]
+            # observation is a probability
+            return prob_success_action
+        else:
+            for input in self.sequence[self.n_stepped:]:
+                self.last_pred, self.state = self.model.step(np.expand_dims(input, axis=0), self.state)
+            self.n_stepped = len(self.sequence)
+            return self.last_pred[0]
+
+
+    @staticmethod
+    def sample_observations_batch(sims):
+        '''
+        sample_observations for many simulators at once. Histories that can be stepped advance in
+        lockstep with one step call per input, the others are padded into one predict call per model.
+        :return: list of probabilities (None for empty histories), in the order of sims
+        '''
+        results = [None] * len(sims)
+        by_model = {}
+        for i, sim in enumerate(sims):
+            if sim.sequence:
+                if sim.cache is not None:
+                    results[i] = sim.cache.get(sim.history_key)
+                    if results[i] is not None:
+                        continue
+                by_model.setdefault(id(sim.model), []).append(i)
+        for ixs in six.itervalues(by_model):
+            model = sims[ixs[0]].model
+            windowed = [i for i in ixs if sims[i].n_stepped is None]
+            if windowed:
+                lengths = [len(sims[i].sequence) for i in windowed]
+                rnn_input_sequence = np.zeros((len(windowed), max(lengths), len(sims[windowed[0]].sequence[0])))
+                for row, i in enumerate(windowed):
+                    rnn_input_sequence[row, :lengths[row], :] = sims[i].sequence
+                pred = model.predict(rnn_input_sequence)
+                for row, i in enumerate(windowed):
+                    results[i] = pred[row][lengths[row]-1]
+
+            stepping = [i for i in ixs if sims[i].n_stepped is not None]
+            pending = [i for i in stepping if sims[i].n_stepped < len(sims[i].sequence)]
+            while pending:
+                inputs = np.array([sims[i].sequence[sims[i].n_stepped] for i in pending])
+                states = [sims[i].state if sims[i].state is not None else model.initial_states(1) for i in pending]
+                states = [np.concatenate(parts, axis=0) for parts in zip(*states)]
+                pred, states = model.step(inputs, states)
+                for row, i in enumerate(pending):
+                    sims[i].last_pred = pred[row:row+1]
+                    sims[i].state = [state[row:row+1] for state in states]
+                    sims[i].n_stepped += 1
+                pending = [i for i in pending if sims[i].n_stepped < len(sims[i].sequence)]
+            for i in stepping:
+                results[i] = sims[i].last_pred[0]
+            for i in ixs:
+                if sims[i].cache is not None:
+                    sims[i].cache.put(sims[i].history_key, results[i])
+        return results
+
+
+    def advance_simulator(self, action, observation):
+        '''
+        Given next action and observation, advance the internal hidden state of the simulator.
+        '''
+        input = d_utils.convert_to_rnn_input(action, observation)
+        n_concepts = len(action.conceptvec)
+        next_branch = action_ob_encode(n_concepts, int(action.concept), observation)
+        self.history_key = history_key_append(n_concepts, self.history_key, next_branch)
+        if len(self.sequence) == self.seq_max_len:
+            # only the window matters to the model
+            self.history_key %= (2 * n_concepts + 1) ** self.seq_max_len
+            self.sequence = self.sequence[1:] + (input,)
+            self.state = None
+            self.n_stepped = None
+            self.last_pred = None
+        else:
+            self.sequence = self.sequence + (input,)
+
+
+    def copy(self):
+        '''
+        Make a copy of the current simulator.
+        The history and hidden states are never modified in place, so they are shared.
+        '''
+        sim_copy = RnnStudentSim(self.model, self.cache)
+        sim_copy.sequence = self.sequence
+        sim_copy.history_key = self.history_key
+        sim_copy.state = self.state
+        sim_copy.n_stepped = self.n_stepped
+        sim_copy.last_pred = self.last_pred
+        return sim_copy
+
+class RnnStudentSimMemEnsemble(object):
+    '''
+    A model-based simulator for a student. Maintains its own internal hidden state.
+    Currently model can be shared because only the history matters
+    Uses an ensemble of memoized models.
+    '''
+
+    def __init__(self, n_concepts, mem_arrays_list, dtype=None, stat_arrays=None):
+        '''
+        :param mem_arrays_list: the memo arrays of every model, e.g. lazily mapped memo_tables.load_mem_arrays.
+            Quantized tables are dequantized on lookup. A fixed ensemble can be passed as the single table
+            of its precomputed mean (memo_tables.save_ensemble_mem_arrays), which makes a query as cheap
+            as for one model.
+        :param dtype: one of memo_tables.MEM_DTYPES to keep the tables quantized in memory, None to use them as given
+        :param stat_arrays: optional dict from memo_tables.ENSEMBLE_STATS to the precomputed ensemble tables,
+            e.g. memo_tables.load_ensemble_mem_arrays, queried with sample_observation_stats
+        '''
+        self.n_concepts = n_concepts
+        if dtype is not None:
+            mem_arrays_list = [quantize_mem_arrays(mem_arrays, dtype) for mem_arrays in mem_arrays_list]
+        self.mem_arrays_list = mem_arrays_list
+        self.stat_arrays = stat_arrays if stat_arrays is not None else {}
+        self.seq_max_len = len(mem_arrays_list[0])-1
+        # story the current state
+        self.step = 0
+        self.history_ix = 0
+
+
+    def sample_observations(self):
+        """
+        Returns next probabilities
+        """
+        # special case when self.sequence is empty
+        if self.step == 0:
+            return None
+        elif len(self.mem_arrays_list) == 1:
+            return dequantize_probs(self.mem_arrays_list[0][self.step][self.history_ix,:])
+        else:
+            pred_list = []
+            for mem_arrays in self.mem_arrays_list:
+                pred_list.append(dequantize_probs(mem_arrays[self.step][self.history_ix,:]))
+            return np.mean(pred_list,axis=0)
+
+    def sample_observation_stats(self, stat):
+        '''
+        :param stat: one of the precomputed statistics passed as stat_arrays, e.g. 'var'
+        :return: the statistic over the ensemble of the next probabilities, None for the empty history
+        '''
+        if self.step == 0:
+            return None
+        return dequantize_probs(self.stat_arrays[stat][self.step][self.history_ix,:])
+
+    @staticmethod
+    def sample_observations_batch(sims):
+        '''
+        sample_observations for many simulators at once, with one table lookup per model and history length.
+        The simulators must share their memo arrays, e.g. be copies of one simulator.
+        '''
+        results = [None] * len(sims)
+        by_step = {}
+        for i, sim in enumerate(sims):
+            if sim.step > 0:
+                by_step.setdefault(sim.step, []).append(i)
+        for step, ixs in six.iteritems(by_step):
+            history_ixs = [sims[i].history_ix for i in ixs]
+            mem_arrays_list = sims[ixs[0]].mem_arrays_list
+            if len(mem_arrays_list) == 1:
+                preds = dequantize_probs(mem_arrays_list[0][step][history_ixs, :])
+            else:
+                preds = np.mean([dequantize_probs(mem_arrays[step][history_ixs, :]) for mem_arrays in mem_arrays_list], axis=0)
+            for row, i in enumerate(ixs):
+                results[i] = preds[row]
+        return results
+
+
+    def advance_simulator(self, action, observation):
+        '''
+        Given next action and observation, advance the internal hidden state of the simulator.
+        action is StudentAction
+        observation is 0 or 1
+        '''
+        self.step += 1
+        next_branch = action_ob_encode(self.n_concepts, action.concept, observation)
+        self.history_ix = history_ix_append(self.n_concepts, self.history_ix, next_branch)
+
+
+    def copy(self):
+        '''
+        Make a copy of the current simulator.
+        '''
+        sim_copy = RnnStudentSimMemEnsemble(self.n_concepts, self.mem_arrays_list, stat_arrays=self.stat_arrays)
+        sim_copy.step = self.step
+        sim_copy.history_ix = self.history_ix
+        return sim_copy
+
+class RnnStudentSimSparseMem(object):
+    '''
+    A model-based simulator for a student using sparse memoized predictions (memo_tables.SparseMemArrays).
+    Histories that were not memoized, e.g. pruned or longer than the memoized horizon, are answered
+    by a live simulator advanced alongside.
+    '''
+
+    def __init__(self, n_concepts, sparse_mem, fallback):
+        '''
+        :param sparse_mem: a memo_tables.SparseMemArrays
+        :param fallback: an RnnStudentSim-like simulator at the empty history, queried on a miss
+        '''
+        self.n_concepts = n_concepts
+        self.sparse_mem = sparse_mem
+        self.fallback = fallback
+        self.seq_max_len = fallback.seq_max_len
+        self.step = 0
+        self.history_ix = 0
+
+    def sample_observations(self):
+        """
+        Returns next probabilities
+        """
+        if self.step == 0:
+            return None
+        probs = self.sparse_mem.get(self.step, self.history_ix)
+        if probs is None:
+            return self.fallback.sample_observations()
+        return probs
+
+    @staticmethod
+    def sample_observations_batch(sims):
+        '''
+        sample_observations for many simulators at once, with one lookup per history length,
+        and the misses answered by one batch of their fallback simulators.
+        '''
+        results = [None] * len(sims)
+        by_step = {}
+        for i, sim in enumerate(sims):
+            if 0 < sim.step < len(sim.sparse_mem):
+                by_step.setdefault(sim.step, []).append(i)
+        misses = [i for i, sim in enumerate(sims) if sim.step >= len(sim.sparse_mem)]
+        for step, ixs in six.iteritems(by_step):
+            preds, found = sims[ixs[0]].sparse_mem.lookup(step, [sims[i].history_ix for i in ixs])
+            for row, i in enumerate(ixs):
+                if found[row]:
+                    results[i] = preds[row]
+                else:
+                    misses.append(i)
+        for i, probs in six.moves.zip(misses, sample_observations_batch([sims[i].fallback for i in misses])):
+            results[i] = probs
+        return results
+
+    def advance_simulator(self, action, observation):
+        '''
+        Given next action and observation, advance the internal hidden state of the simulator.
+        action is StudentAction
+        observation is 0 or 1
+        '''
+        self.step += 1
+        # past the memoized horizon only the fallback is used, so stop growing the index
+        if self.step < len(self.sparse_mem):
+            next_branch = action_ob_encode(self.n_concepts, action.concept, observation)
+            self.history_ix = history_ix_append(self.n_concepts, self.history_ix, next_branch)
+        self.fallback.advance_simulator(action, observation)
+
+    def copy(self):
+        '''
+        Make a copy of the current simulator.
+        '''
+        sim_copy = RnnStudentSimSparseMem(self.n_concepts, self.sparse_mem, self.fallback.copy())
+        sim_copy.step = self.step
+        sim_copy.history_ix = self.history_ix
+        return sim_copy
+
+def load_mem_student_sim(n_concepts, mem_paths, timesteps):
+    '''
+    Opens the memo tables of an ensemble as a simulator.
+    Dense tables give a RnnStudentSimMemEnsemble. Sparse tables (model_training.dkt_memoize_single with a threshold)
+    give a RnnStudentSimSparseMem, whose misses are answered by the model the tables were memoized from.
+    :param mem_paths: the memo path of every model, see memo_tables.load_mem_arrays
+    :param timesteps: the window of the model loaded for sparse tables
+    '''
+    mem_arrays_list = [load_mem_arrays(path) for path in mem_paths]
+    if not any(isinstance(mem_arrays, SparseMemArrays) for mem_arrays in mem_arrays_list):
+        return RnnStudentSimMemEnsemble(n_concepts, mem_arrays_list)
+    if len(mem_arrays_list) > 1:
+        raise ValueError('Sparse memo tables cannot be used in an ensemble: {}'.format(mem_paths))
+    sparse_mem = mem_arrays_list[0]
+    if sparse_mem.model_args is None:
+        raise ValueError('The sparse memo tables at {} do not name their model; build a RnnStudentSimSparseMem '
+                         'with the model as fallback instead.'.format(sparse_mem.path))
+    from inference_server import load_dynamics_model
+    model = load_dynamics_model(timesteps=timesteps, **sparse_mem.model_args)
+    return RnnStudentSimSparseMem(n_concepts, sparse_mem, RnnStudentSim(model))
+
+class RnnStudentSimEnsemble(object):
+    '''
+    A model-based simulator for a student.
+    It's an ensemble of many models and averages their predictions.
+    '''
+
+    def __init__(self, model_list):
+        self.model_list = model_list
+        self.seq_max_len = model_list[0].get_timesteps()
+        self.sequence = [] # will store up to seq_max_len
+        pass
+
+
+    def sample_observations(self):
+        """
+        Returns list of probabilities
+        """
+        # special case when self.sequence is empty
+        if not self.sequence:
+            return None
+        else:
+            # turns the list of input vectors, into a numpy matrix of shape (1, n_timesteps, 2*n_concepts)
+            # We need the first dimension since the network expects a batch.
+            rnn_input_sequence = np.expand_dims(np.array(self.sequence), axis=0)
+            t = len(self.sequence)
+            
+            # average the predictions
+            pred_list = []
+            for curr_model in self.model_list:
+                pred_list.append(curr_model.predict(rnn_input_sequence)[0][t-1])
+            
+            prob_success_action = np.mean(pred_list,axis=0)
+            #six.print_('prob success action shape {}'.format(prob_success_action.shape))
+            
+            # observation is a probability
+            return prob_success_action
+
+    @staticmethod
+    def sample_observations_batch(sims):
+        '''
+        sample_observations for many simulators at once: the histories are padded into one batch
+        and every model of the ensemble is queried once.
+        The simulators must share their models, e.g. be copies of one simulator.
+        '''
+        results = [None] * len(sims)
+        ixs = [i for i, sim in enumerate(sims) if sim.sequence]
+        if not ixs:
+            return results
+        lengths = np.array([len(sims[i].sequence) for i in ixs])
+        rnn_input_sequence = np.zeros((len(ixs), np.max(lengths), len(sims[ixs[0]].sequence[0])))
+        for row, i in enumerate(ixs):
+            rnn_input_sequence[row, :lengths[row], :] = sims[i].sequence
+        rows = np.arange(len(ixs))
+        pred_list = []
+        for curr_model in sims[ixs[0]].model_list:
+            pred_list.append(np.asarray(curr_model.predict(rnn_input_sequence))[rows, lengths-1])
+        preds = np.mean(pred_list, axis=0)
+        for row, i in enumerate(ixs):
+            results[i] = preds[row]
+        return results
+
+
+    def advance_simulator(self, action, observation):
+        '''
+        Given next action and observation, advance the internal hidden state of the simulator.
+        '''
+        input = d_utils.convert_to_rnn_input(action, observation)
+        if len(self.sequence) == self.seq_max_len:
+            self.sequence = self.sequence[1:] + [input]
+        else:
+            self.sequence.append(input)
+
+
+    def copy(self):
+        '''
+        Make a copy of the current simulator.
+
+        '''
+        sim_copy = RnnStudentSimEnsemble(self.model_list) #list of models is shared
+        sim_copy.sequence = self.sequence[:] # deep copy
+        return sim_copy
@@ -0,0 +1,264 @@
+#===============================================================================
+# DESCRIPTION:
+# Tests that the vectorized cohort simulators behave like the per-student ones.
+#===============================================================================
+# USAGE: python student_tests.py
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import six
+
+import concept_dependency_graph as cdg
+import data_generator as dg
+import student as st
+
+from helpers import expected_reward, compute_optimal_actions
+
+
+def test_student2_cohort_matches_single(n_concepts=4, n_students=200, seqlen=8):
+    '''
+    Student2 is deterministic given the actions, so feeding the same random action sequences
+    through Student2Cohort and through one Student2 per student should give identical trajectories.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    initial_knowledge = np.zeros((n_concepts,))
+    initial_knowledge[0] = 1
+
+    for transition_after in (False, True):
+        actions = np.random.randint(n_concepts, size=(n_students, seqlen))
+        cohort = st.Student2Cohort(n_students, n_concepts, transition_after)
+        cohort.reset(initial_knowledge)
+        students = []
+        for i in six.moves.range(n_students):
+            s = st.Student2(n_concepts, transition_after)
+            s.knowledge = np.copy(initial_knowledge)
+            students.append(s)
+
+        for t in six.moves.range(seqlen):
+            states = cohort.get_state()
+            obs = cohort.do_exercise(dgraph, actions[:, t])
+            for i in six.moves.range(n_students):
+                assert np.array_equal(states[i], students[i].get_state())
+                ob = students[i].do_exercise(dgraph, st.make_student_action(n_concepts, actions[i, t]))
+                assert int(ob) == obs[i]
+                assert np.array_equal(cohort.knowledge[i], students[i].knowledge)
+                assert np.array_equal(cohort.visited[i], students[i].visited)
+
+
+def test_student2_cohort_distribution(n_concepts=4, n_students=5000, seqlen=6, tol=0.03):
+    '''
+    generate_data with a Student2 goes through the cohort simulator; compare its outcome statistics
+    against the per-student generate_student_sample for both transition modes and behavior policies.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+
+    for transition_after in (False, True):
+        student = st.Student2(n_concepts, transition_after)
+        for policy in ('random', 'expert'):
+            batch_data = dg.generate_data(dgraph, student=student, n_students=n_students, seqlen=seqlen, policy=policy)
+            single_data = [dg.generate_student_sample(dgraph, seqlen=seqlen, student=student, policy=policy)
+                           for _ in six.moves.range(n_students)]
+
+            assert len(batch_data) == len(single_data)
+            assert abs(expected_reward(batch_data) - expected_reward(single_data)) < tol
+            # per-step probability of a correct answer
+            batch_correct = np.mean([[step[1] for step in traj] for traj in batch_data], axis=0)
+            single_correct = np.mean([[step[1] for step in traj] for traj in single_data], axis=0)
+            assert np.max(np.abs(batch_correct - single_correct)) < tol
+
+
+def test_student_cohort_matches_single(n_concepts=4, n_students=200, seqlen=8):
+    '''
+    With transition and guess probabilities of 0 or 1 Student is deterministic, so StudentCohort and one
+    Student per student should give identical trajectories for the same actions.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    initial_knowledge = np.zeros((n_concepts,))
+    initial_knowledge[0] = 1
+
+    for p_trans_satisfied, p_trans_not_satisfied, p_correct in ((1.0, 0.0, 1.0), (0.0, 1.0, 1.0), (1.0, 0.0, 0.0)):
+        params = dict(p_trans_satisfied=p_trans_satisfied, p_trans_not_satisfied=p_trans_not_satisfied,
+                      p_get_ex_correct_if_concepts_learned=p_correct)
+        actions = np.random.randint(n_concepts, size=(n_students, seqlen))
+        cohort = st.StudentCohort(n_students, n_concepts, **params)
+        cohort.reset(initial_knowledge)
+        students = [st.Student(n=n_concepts, **params) for _ in six.moves.range(n_students)]
+        for s in students:
+            s.knowledge = np.copy(initial_knowledge)
+
+        for t in six.moves.range(seqlen):
+            states = cohort.get_state()
+            obs = cohort.do_exercise(dgraph, actions[:, t])
+            for i in six.moves.range(n_students):
+                assert np.array_equal(states[i], students[i].get_state())
+                ob = students[i].do_exercise(dgraph, st.make_student_action(n_concepts, actions[i, t]))
+                assert int(ob) == obs[i], params
+                assert np.array_equal(cohort.knowledge[i], students[i].knowledge)
+
+
+def test_student_cohort_distribution(n_concepts=4, n_students=5000, seqlen=6, tol=0.03):
+    '''
+    For the stochastic Student, compare the per-step correct rate and the learned concepts of the cohort
+    against per-student simulation under the same random action sequences.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    initial_knowledge = np.zeros((n_concepts,))
+    initial_knowledge[0] = 1
+    params = dict(p_trans_satisfied=0.5, p_trans_not_satisfied=0.2, p_get_ex_correct_if_concepts_learned=0.8)
+    # Student draws from the global stream, seed it so that the comparison doesn't fail by chance
+    np.random.seed(0)
+
+    actions = np.random.randint(n_concepts, size=(n_students, seqlen))
+    cohort = st.StudentCohort(n_students, n_concepts, rng=np.random.RandomState(0), **params)
+    cohort.reset(initial_knowledge)
+    batch_correct = np.array([cohort.do_exercise(dgraph, actions[:, t]) for t in six.moves.range(seqlen)]).T
+
+    single_correct = np.zeros((n_students, seqlen))
+    single_knowledge = np.zeros((n_students, n_concepts))
+    for i in six.moves.range(n_students):
+        s = st.Student(n=n_concepts, **params)
+        s.knowledge = np.copy(initial_knowledge)
+        for t in six.moves.range(seqlen):
+            single_correct[i, t] = s.do_exercise(dgraph, st.make_student_action(n_concepts, actions[i, t]))
+        single_knowledge[i] = s.knowledge
+
+    assert np.max(np.abs(np.mean(batch_correct, axis=0) - np.mean(single_correct, axis=0))) < tol
+    assert np.max(np.abs(np.mean(cohort.knowledge, axis=0) - np.mean(single_knowledge, axis=0))) < tol
+
+
+def _random_knowledge(n_concepts, n_students, rng):
+    '''
+    Knowledge states reachable under the default tree, including the fully learned one.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    cohort = st.StudentCohort(n_students, n_concepts, p_trans_satisfied=0.5, rng=rng)
+    initial_knowledge = np.zeros((n_concepts,))
+    initial_knowledge[0] = 1
+    cohort.reset(initial_knowledge)
+    for _ in six.moves.range(3 * n_concepts):
+        cohort.do_exercise(dgraph, rng.randint(n_concepts, size=n_students))
+    knowledge = cohort.knowledge.copy()
+    # one student knows everything, where the expert falls back to random actions
+    knowledge[0] = 1
+    return dgraph, knowledge
+
+
+def test_batch_action_selectors(n_concepts=4, n_students=300, n_samples=2000, tol=0.06):
+    '''
+    Every batch selector picks from the same actions as its per-student counterpart, with the same frequencies.
+    '''
+    rng = np.random.RandomState(1)
+    dgraph, knowledge = _random_knowledge(n_concepts, n_students, rng)
+
+    def single_frequencies(select, k):
+        counts = np.zeros((n_concepts,))
+        for _ in six.moves.range(n_samples):
+            counts[select(k).concept] += 1
+        return counts / n_samples
+
+    def batch_frequencies(select, k):
+        actions = select(np.tile(k, (n_samples, 1)))
+        return np.bincount(actions, minlength=n_concepts) / n_samples
+
+    # a handful of distinct knowledge states is enough for the frequencies
+    distinct = np.unique(knowledge, axis=0)
+    for k in distinct:
+        for epsilon in (0.0, 0.3, 1.0):
+            single = single_frequencies(lambda kk: dg.egreedy_expert(dgraph, kk, epsilon), k)
+            batch = batch_frequencies(lambda kk: dg.egreedy_expert_batch(dgraph, kk, epsilon, rng=rng), k)
+            assert np.max(np.abs(single - batch)) < tol, (k, epsilon)
+        single = single_frequencies(lambda kk: dg.sample_expert_action(dgraph, kk), k)
+        batch = batch_frequencies(lambda kk: dg.select_actions_batch(dgraph, kk, 'expert', 0, rng=rng), k)
+        assert np.max(np.abs(single - batch)) < tol, k
+        # the support is exactly the optimal actions
+        assert np.array_equal(batch > 0, single > 0), k
+
+    # the expert actions of the whole cohort are among the optimal ones of each student
+    actions = dg.sample_expert_actions_batch(dgraph, knowledge, rng=rng)
+    for i in six.moves.range(n_students):
+        assert actions[i] in compute_optimal_actions(dgraph, knowledge[i])
+
+    assert np.array_equal(dg.select_actions_batch(dgraph, knowledge, 'modulo', 6), np.full((n_students,), 6 % n_concepts))
+    random_actions = dg.select_actions_batch(dgraph, knowledge, 'random', 0, rng=rng)
+    assert random_actions.shape == (n_students,) and set(random_actions) == set(six.moves.range(n_concepts))
+
+
+def test_concept_frontier(n_concepts=8, n_orders=50):
+    '''
+    The incremental frontier agrees with a full rescan of the graph after every learned concept,
+    and its sorted list is only rebuilt when it changed.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_from_edges(n_concepts, [(0, 1), (0, 2), (1, 3), (2, 3), (3, 4), (1, 5), (5, 6), (4, 7), (6, 7)])
+    for _ in six.moves.range(n_orders):
+        frontier = cdg.ConceptFrontier(dgraph, 1)
+        kmask = 1
+        for c in np.random.permutation(n_concepts):
+            concepts = frontier.sorted_concepts()
+            assert frontier.sorted_concepts() is concepts
+            assert concepts == list(cdg.iter_mask_bits(dgraph.learnable_mask(kmask)))
+            kmask |= 1 << int(c)
+            frontier.learn(int(c))
+        assert frontier.sorted_concepts() == []
+
+
+def test_cohort_learnable_concepts(n_concepts=8, n_students=200, seqlen=30):
+    '''
+    The learnable concepts maintained by the cohorts agree with a full recomputation after every step.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_from_edges(n_concepts, [(0, 1), (0, 2), (1, 3), (2, 3), (3, 4), (1, 5), (5, 6), (4, 7), (6, 7)])
+    initial_knowledge = np.zeros((n_concepts,))
+    initial_knowledge[0] = 1
+    rng = np.random.RandomState(0)
+    for cohort in (st.StudentCohort(n_students, n_concepts, p_trans_not_satisfied=0.3, rng=np.random.RandomState(1)),
+                   st.Student2Cohort(n_students, n_concepts, True), st.Student2Cohort(n_students, n_concepts, False)):
+        cohort.reset(initial_knowledge)
+        for _ in six.moves.range(seqlen):
+            assert np.array_equal(cohort.learnable_concepts(dgraph), st.learnable_concepts_batch(dgraph, cohort.knowledge))
+            # mostly learnable concepts, so that the students progress
+            concepts = dg.sample_expert_actions_batch(dgraph, cohort.knowledge, rng=rng)
+            explore = rng.random_sample(n_students) < 0.3
+            concepts[explore] = rng.randint(n_concepts, size=np.sum(explore))
+            cohort.do_exercise(dgraph, concepts)
+        assert np.any(cohort.knowledge[:, -1])
+
+
+def test_exact_sim_frontier(n_concepts=7, horizon=20):
+    '''
+    StudentExactSim keeps the frontier of its student, also in copies and after the student is reset.
+    '''
+    dgraph = cdg.ConceptDependencyGraph()
+    dgraph.init_default_tree(n_concepts)
+    student = st.Student2(n_concepts, True)
+    student.learn(0)
+    sim = st.StudentExactSim(student, dgraph)
+    copies = []
+    for _ in six.moves.range(horizon):
+        assert compute_optimal_actions(dgraph, sim.get_knowledge(), frontier=sim.frontier) == \
+            compute_optimal_actions(dgraph, sim.get_knowledge())
+        copies.append((sim.copy(), sim.get_knowledge().copy()))
+        sim.advance_simulator(st.make_student_action(n_concepts, compute_optimal_actions(dgraph, sim.get_knowledge())[0]))
+    for sim_copy, knowledge in copies:
+        assert np.array_equal(sim_copy.get_knowledge(), knowledge)
+        assert sim_copy.frontier.sorted_concepts() == list(cdg.iter_mask_bits(dgraph.learnable_mask(sim_copy.student.kmask)))
+    sim.student.reset()
+    assert sim.frontier.sorted_concepts() == [0]
+
+
+if __name__ == '__main__':
+    test_student2_cohort_matches_single()
+    test_student2_cohort_distribution()
+    test_student_cohort_matches_single()
+    test_student_cohort_distribution()
+    test_batch_action_selectors()
+    test_concept_frontier()
+    test_cohort_learnable_concepts()
+    test_exact_sim_frontier()
+    six.print_('All tests passed.')
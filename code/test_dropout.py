@@ -46,7 +46,7 @@ def main():
     print('Average posttest: {}'.format(sm.expected_reward(data)))
     print('Percent of full posttest score: {}'.format(sm.percent_complete(data)))
     print('Percent of all seen: {}'.format(sm.percent_all_seen(data)))
-    input_data_, output_mask_, target_data_ = dataset_utils.preprocess_data_for_rnn(data)
+    input_data_, output_mask_, target_data_ = dataset_utils.load_rnn_data_cached('{}{}'.format(dg.SYN_DATA_DIR, filename))
 
     train_data = (input_data_[:,:,:], output_mask_[:,:,:], target_data_[:,:,:])
     print(input_data_.shape)
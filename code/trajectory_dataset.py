@@ -0,0 +1,203 @@
+# trajectory_dataset.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Columnar on-disk format for the trajectories produced by generate_data.
+# A dataset is a directory holding one raw file per column plus meta.json:
+#   actions    int8/int16 (n_students, seqlen)         index of the exercised concept
+#   outcomes   uint8 (n_students, ceil(seqlen/8))        bit-packed 0/1 results
+#   knowledge  uint8 (n_students, seqlen, ceil(n/8))     bit-packed knowledge after each exercise
+#   states     uint8 (n_students, seqlen, ceil(d/8))     bit-packed student state before each exercise
+# The columns are opened with np.memmap, so opening is instant and only the
+# touched rows are read from disk.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE: from trajectory_dataset import TrajectoryDataset, TrajectoryDatasetWriter
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import numpy as np
+import six
+
+DATASET_VERSION = 1
+META_FILE = 'meta.json'
+
+
+def _packed_len(n_bits):
+    return (n_bits + 7) // 8
+
+
+def _action_dtype(n_concepts):
+    return np.int8 if n_concepts <= np.iinfo(np.int8).max else np.int16
+
+
+def _unpack(packed, n_bits):
+    return np.unpackbits(packed, axis=-1)[..., :n_bits]
+
+
+class TrajectoryDataset(object):
+    '''
+    Read-only view of a trajectory dataset directory.
+    Indexing with an int returns the trajectory in the tuple format of generate_data, so code written
+    for the pickled lists keeps working; the column accessors are the fast path.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        assert meta['version'] == DATASET_VERSION, "Unknown trajectory dataset version {}".format(meta['version'])
+        self.n_students = meta['n_students']
+        self.seqlen = meta['seqlen']
+        self.n_concepts = meta['n_concepts']
+        self.state_dim = meta['state_dim']
+
+        n, t = self.n_students, self.seqlen
+        self.actions = self._open('actions', _action_dtype(self.n_concepts), (n, t))
+        self.packed_outcomes = self._open('outcomes', np.uint8, (n, _packed_len(t)))
+        self.packed_knowledge = self._open('knowledge', np.uint8, (n, t, _packed_len(self.n_concepts)))
+        self.packed_states = None
+        if self.state_dim > 0:
+            self.packed_states = self._open('states', np.uint8, (n, t, _packed_len(self.state_dim)))
+
+    def _open(self, column, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, column), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return self.n_students
+
+    def outcomes(self, ix=slice(None)):
+        '''
+        :return: uint8 array (students, seqlen) of results for the students selected by ix
+        '''
+        return _unpack(self.packed_outcomes[ix], self.seqlen)
+
+    def knowledge(self, ix=slice(None)):
+        '''
+        :return: uint8 array (students, seqlen, n_concepts) of knowledge after each exercise
+        '''
+        return _unpack(self.packed_knowledge[ix], self.n_concepts)
+
+    def states(self, ix=slice(None)):
+        '''
+        :return: uint8 array (students, seqlen, state_dim) of student states before each exercise
+        '''
+        return _unpack(self.packed_states[ix], self.state_dim)
+
+    def final_knowledge(self):
+        '''
+        :return: uint8 array (n_students, n_concepts) of the knowledge at the end of each trajectory (the posttest)
+        '''
+        return _unpack(self.packed_knowledge[:, -1], self.n_concepts)
+
+    def exercises(self, ix=slice(None)):
+        '''
+        :return: one-hot int array (students, seqlen, n_concepts) of the exercised concepts
+        '''
+        actions = np.asarray(self.actions[ix], dtype=int)
+        return (actions[..., np.newaxis] == np.arange(self.n_concepts)).astype(int)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in six.moves.range(*i.indices(self.n_students))]
+        if i < 0:
+            i += self.n_students
+        exercises = self.exercises(i)
+        outcomes = self.outcomes(i).tolist()
+        knowledge = self.knowledge(i).astype(float)
+        if self.packed_states is None:
+            return tuple(six.moves.zip(exercises, outcomes, knowledge))
+        return tuple(six.moves.zip(exercises, outcomes, knowledge, self.states(i).astype(int)))
+
+    def __iter__(self):
+        for i in six.moves.range(self.n_students):
+            yield self[i]
+
+
+class TrajectoryDatasetWriter(object):
+    '''
+    Appends trajectories to a new dataset directory chunk by chunk.
+    meta.json is rewritten after every chunk, so the directory can be opened as soon as a chunk is written.
+    '''
+    def __init__(self, path, n_concepts, seqlen, state_dim):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.n_concepts = n_concepts
+        self.seqlen = seqlen
+        self.state_dim = state_dim
+        self.n_students = 0
+        columns = ['actions', 'outcomes', 'knowledge'] + (['states'] if state_dim > 0 else [])
+        self._files = dict((c, open(os.path.join(path, c), 'wb')) for c in columns)
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {
+            'version': DATASET_VERSION,
+            'n_students': self.n_students,
+            'seqlen': self.seqlen,
+            'n_concepts': self.n_concepts,
+            'state_dim': self.state_dim,
+        }
+        tmp = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(self.path, META_FILE))
+
+    def append_arrays(self, actions, outcomes, knowledge, states=None):
+        '''
+        Appends a chunk given as arrays.
+        :param actions: int array (students, seqlen) of concept indices
+        :param outcomes: 0/1 array (students, seqlen)
+        :param knowledge: 0/1 array (students, seqlen, n_concepts)
+        :param states: 0/1 array (students, seqlen, state_dim), required iff state_dim > 0
+        '''
+        actions = np.asarray(actions)
+        if actions.shape[0] == 0:
+            return
+        assert actions.shape[1] == self.seqlen, "Trajectories must all have length {}".format(self.seqlen)
+        columns = {
+            'actions': actions.astype(_action_dtype(self.n_concepts)),
+            'outcomes': np.packbits(np.asarray(outcomes) > 0.5, axis=-1),
+            'knowledge': np.packbits(np.asarray(knowledge) > 0.5, axis=-1),
+        }
+        if self.state_dim > 0:
+            columns['states'] = np.packbits(np.asarray(states) > 0.5, axis=-1)
+        for c, f in six.iteritems(self._files):
+            f.write(np.ascontiguousarray(columns[c]).tobytes())
+            f.flush()
+        self.n_students += actions.shape[0]
+        self._write_meta()
+
+    def append(self, trajectories):
+        '''
+        Appends a list of trajectories in the format returned by generate_data.
+        '''
+        if len(trajectories) == 0:
+            return
+        exercises = np.array([[step[0] for step in traj] for traj in trajectories])
+        outcomes = np.array([[step[1] for step in traj] for traj in trajectories])
+        knowledge = np.array([[step[2] for step in traj] for traj in trajectories])
+        states = None
+        if self.state_dim > 0:
+            states = np.array([[step[3] for step in traj] for traj in trajectories])
+        self.append_arrays(np.argmax(exercises, axis=-1), outcomes, knowledge, states)
+
+    def close(self):
+        for f in six.itervalues(self._files):
+            f.close()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_trajectory_dataset(path):
+    return os.path.isfile(os.path.join(path, META_FILE))